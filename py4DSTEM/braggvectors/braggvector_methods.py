@@ -5,7 +5,7 @@ from warnings import warn
 
 import matplotlib.pyplot as plt
 import numpy as np
-from emdfile import Array, Metadata, _read_metadata, tqdmnd
+from emdfile import Array, Metadata, _read_metadata
 from py4DSTEM import show
 from py4DSTEM.datacube import VirtualImage
 from scipy.ndimage import gaussian_filter
@@ -74,13 +74,11 @@ class BraggVectorMethods:
             x, y = np.nonzero(weights)
             vects = np.concatenate([v[i, j].data for i, j in zip(x, y)])
         else:
-            l = []
+            # weight the concatenated copy, leaving the stored vectors untouched
             x, y = np.nonzero(weights > weights_thresh)
-            for i, j in zip(x, y):
-                d = v[i, j].data
-                d["intensity"] *= weights[i, j]
-                l.append(d)
+            l = [v[i, j].data for i, j in zip(x, y)]
             vects = np.concatenate(l)
+            vects["intensity"] *= np.repeat(weights[x, y], [len(d) for d in l])
         # get the vectors
         qx = vects["qx"]
         qy = vects["qy"]
@@ -264,35 +262,26 @@ class BraggVectorMethods:
             else:
                 qxy_center = np.array(geometry[0])
 
-        # allocate space
-        im_virtual = np.zeros(self.shape)
-
-        # generate image
-        for rx, ry in tqdmnd(
-            self.shape[0],
-            self.shape[1],
-        ):
-            # Get user-specified Bragg vectors
-            p = self.get_vectors(
-                rx,
-                ry,
-                center=center,
-                ellipse=ellipse,
-                pixel=pixel,
-                rotate=rotate,
-            )
-
-            if p.data.shape[0] > 0:
-                if radial_range is None:
-                    im_virtual[rx, ry] = np.sum(p.I)
-                else:
-                    if qxy_center is None:
-                        qr = np.hypot(p.qx, p.qy)
-                    else:
-                        qr = np.hypot(p.qx - qxy_center[0], p.qy - qxy_center[1])
-                    sub = np.logical_and(qr >= radial_range[0], qr < radial_range[1])
-                    if np.sum(sub) > 0:
-                        im_virtual[rx, ry] = np.sum(p.I[sub])
+        # generate image, from the vectors of all scan positions at once
+        qx, qy, I, offsets = self.get_vectors_flat(
+            center=center,
+            ellipse=ellipse,
+            pixel=pixel,
+            rotate=rotate,
+        )
+        if radial_range is not None:
+            if qxy_center is None:
+                qr = np.hypot(qx, qy)
+            else:
+                qr = np.hypot(qx - qxy_center[0], qy - qxy_center[1])
+            sub = np.logical_and(qr >= radial_range[0], qr < radial_range[1])
+            I = np.where(sub, I, 0)
+        num_positions = len(offsets) - 1
+        im_virtual = np.bincount(
+            np.repeat(np.arange(num_positions), np.diff(offsets)),
+            weights=I,
+            minlength=num_positions,
+        ).reshape(self.shape)
 
         # wrap in Virtual Image class
         ans = VirtualImage(data=im_virtual, name=name)
@@ -262,6 +262,44 @@ class BraggVectors(Custom, BraggVectorMethods, Data):
         )
         return BVects(ans)
 
+    def get_vectors_flat(self, center, ellipse, pixel, rotate):
+        """
+        Returns the bragg vectors of every scan position with the specified
+        calibration state, as flat, contiguous arrays (qx, qy, I, offsets).
+        The vectors at scan position (x,y) are at indices
+        offsets[i]:offsets[i+1], where i = x*Rshape[1] + y.
+
+        Parameters
+        ----------
+        center : bool
+        ellipse : bool
+        pixel : bool
+        rotate : bool
+
+        Returns
+        -------
+        qx, qy, I, offsets : ndarrays
+        """
+        qx, qy, I, offsets = _get_vectors_flat(self._v_uncal)
+        if not (center or ellipse or pixel or rotate):
+            return qx, qy, I, offsets
+        m00, m01, m10, m11, b0, b1 = _get_calibration_transform(
+            self.calibration,
+            center=center,
+            ellipse=ellipse,
+            pixel=pixel,
+            rotate=rotate,
+        )
+
+        # expand any per-scan-position components to one value per vector
+        counts = np.diff(offsets)
+        m00, m01, m10, m11, b0, b1 = (
+            np.repeat(np.ravel(m), counts) if np.ndim(m) > 0 else m
+            for m in (m00, m01, m10, m11, b0, b1)
+        )
+
+        return m00 * qx + m01 * qy + b0, m10 * qx + m11 * qy + b1, I, offsets
+
     # copy
     def copy(self, name=None):
         name = name if name is not None else self.name + "_copy"
@@ -430,13 +468,118 @@ class RawVectorGetter:
         ans = self._data[x, y].data
         return BVects(ans)
 
+    def all(self):
+        """
+        Returns the raw vectors of every scan position as flat, contiguous
+        arrays (qx, qy, I, offsets). The vectors at scan position (x,y) are
+        at indices offsets[i]:offsets[i+1] of qx, qy and I, where
+        i = x*Rshape[1] + y. The arrays are a snapshot of the vectors,
+        and do not share memory with them.
+        """
+        return _get_vectors_flat(self._data)
+
     def __repr__(self):
         space = " " * len(self.__class__.__name__) + "  "
         string = f"{self.__class__.__name__}( "
-        string += "Retrieves raw bragg vectors. Get vectors for scan position x,y with [x,y]. )"
+        string += (
+            "Retrieves raw bragg vectors. Get vectors for scan position x,y with [x,y]."
+        )
+        string += "\n" + space + "Get all vectors as flat arrays with .all(). )"
         return string
 
 
+def _get_calibration_transform(
+    cal,
+    center,
+    ellipse,
+    pixel,
+    rotate,
+    rx=None,
+    ry=None,
+):
+    """
+    Composes the requested calibrations into a single affine transform,
+    returned as its components (m00, m01, m10, m11, b0, b1), such that the
+    calibrated vectors are
+
+        qx' = m00*qx + m01*qy + b0
+        qy' = m10*qx + m11*qy + b1
+
+    The calibrations are applied in the order origin, ellipse, pixel size,
+    then Q/R rotation and flip. If rx and ry are given, the components are
+    numbers for that scan position. Otherwise, any component depending on a
+    calibration which varies over the scan is an Rshape array.
+    """
+    m00, m01, m10, m11 = 1.0, 0.0, 0.0, 1.0
+
+    # ellipse
+    if ellipse:
+        ell = cal.get_ellipse(rx, ry)
+        assert ell is not None, "Requested calibration was not found!"
+        a, b, theta = ell
+        e = b / a
+        sint, cost = np.sin(theta - np.pi / 2.0), np.cos(theta - np.pi / 2.0)
+        m00 = e * sint**2 + cost**2
+        m01 = sint * cost * (1 - e)
+        m10 = m01
+        m11 = sint**2 + e * cost**2
+
+    # pixel size
+    if pixel:
+        qpix = cal.get_Q_pixel_size()
+        assert qpix is not None, "Requested calibration was not found!"
+        m00, m01, m10, m11 = m00 * qpix, m01 * qpix, m10 * qpix, m11 * qpix
+
+    # Q/R rotation
+    if rotate:
+        theta = cal.get_QR_rotation()
+        assert theta is not None, "Requested calibration was not found!"
+        flip = cal.get_QR_flip()
+        flip = False if flip is None else flip
+        # flip swaps qx and qy before rotating
+        if flip:
+            m00, m01, m10, m11 = m10, m11, m00, m01
+        cost, sint = np.cos(theta), np.sin(theta)
+        m00, m01, m10, m11 = (
+            cost * m00 - sint * m10,
+            cost * m01 - sint * m11,
+            sint * m00 + cost * m10,
+            sint * m01 + cost * m11,
+        )
+
+    # origin, subtracted before the linear transform
+    b0, b1 = 0.0, 0.0
+    if center:
+        origin = cal.get_origin(rx, ry)
+        assert origin is not None, "Requested calibration was not found!"
+        qx0, qy0 = origin
+        b0 = -(m00 * qx0 + m01 * qy0)
+        b1 = -(m10 * qx0 + m11 * qy0)
+
+    return m00, m01, m10, m11, b0, b1
+
+
+def _get_vectors_flat(pointlistarray):
+    """
+    Gathers the 'qx', 'qy' and 'intensity' fields of all PointLists of a
+    PointListArray into three contiguous float64 arrays, in C order over the
+    scan, and returns them with the (Rshape[0]*Rshape[1]+1,) offsets array
+    delimiting each scan position.
+    """
+    data = [
+        pointlistarray[x, y].data
+        for x in range(pointlistarray.shape[0])
+        for y in range(pointlistarray.shape[1])
+    ]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([d.shape[0] for d in data], out=offsets[1:])
+    data = np.concatenate(data)
+    qx = np.ascontiguousarray(data["qx"], dtype=np.float64)
+    qy = np.ascontiguousarray(data["qy"], dtype=np.float64)
+    I = np.ascontiguousarray(data["intensity"], dtype=np.float64)
+    return qx, qy, I, offsets
+
+
 class CalibratedVectorGetter:
     def __init__(
         self,
@@ -459,10 +602,25 @@ class CalibratedVectorGetter:
         )
         return BVects(ans)
 
+    def all(self):
+        """
+        Returns the calibrated vectors of every scan position as flat,
+        contiguous arrays (qx, qy, I, offsets), laid out as for raw.all().
+        The calibrations set with braggvectors.setcal(...) are applied to all
+        vectors at once, rather than position by position.
+        """
+        return self._bvects.get_vectors_flat(
+            center=self._bvects.calstate["center"],
+            ellipse=self._bvects.calstate["ellipse"],
+            pixel=self._bvects.calstate["pixel"],
+            rotate=self._bvects.calstate["rotate"],
+        )
+
     def __repr__(self):
         space = " " * len(self.__class__.__name__) + "  "
         string = f"{self.__class__.__name__}( "
         string += "Retrieves calibrated Bragg vectors. Get vectors for scan position x,y with [x,y]."
+        string += "\n" + space + "Get all vectors as flat arrays with .all()."
         string += (
             "\n"
             + space
@@ -485,64 +643,37 @@ class CalibratedVectorGetter:
         with fields 'qx','qy','intensity', applying calibrating transforms
         according to the values of center, ellipse, pixel, using the
         measurements found in Calibration instance cal for scan position scanxy.
+        If no calibrations are requested a read-only view of `data` is
+        returned, sharing memory with the raw vectors.
         """
 
-        ans = data.copy()
-        x, y = scanxy
-
-        # origin
+        # nothing to apply; guard the raw vectors against writes through the view
+        if not (center or ellipse or pixel or rotate):
+            ans = data.view()
+            ans.flags.writeable = False
+            return ans
 
-        if center:
-            origin = cal.get_origin(x, y)
-            assert origin is not None, "Requested calibration was not found!"
-            ans["qx"] -= origin[0]
-            ans["qy"] -= origin[1]
+        x, y = scanxy
 
-        # ellipse
-        if ellipse:
-            ell = cal.get_ellipse(x, y)
-            assert ell is not None, "Requested calibration was not found!"
-            a, b, theta = ell
-            # Get the transformation matrix
-            e = b / a
-            sint, cost = np.sin(theta - np.pi / 2.0), np.cos(theta - np.pi / 2.0)
-            T = np.array(
-                [
-                    [e * sint**2 + cost**2, sint * cost * (1 - e)],
-                    [sint * cost * (1 - e), sint**2 + e * cost**2],
-                ]
-            )
-            # apply it
-            xyar_i = np.vstack([ans["qx"], ans["qy"]])
-            xyar_f = np.matmul(T, xyar_i)
-            ans["qx"] = xyar_f[0, :]
-            ans["qy"] = xyar_f[1, :]
-
-        # pixel size
-        if pixel:
-            qpix = cal.get_Q_pixel_size()
-            assert qpix is not None, "Requested calibration was not found!"
-            ans["qx"] *= qpix
-            ans["qy"] *= qpix
+        # the combined affine transform at this scan position
+        m00, m01, m10, m11, b0, b1 = _get_calibration_transform(
+            cal,
+            center=center,
+            ellipse=ellipse,
+            pixel=pixel,
+            rotate=rotate,
+            rx=x,
+            ry=y,
+        )
 
-        # Q/R rotation
-        if rotate:
-            theta = cal.get_QR_rotation()
-            assert theta is not None, "Requested calibration was not found!"
-            flip = cal.get_QR_flip()
-            flip = False if flip is None else flip
-            # rotation matrix
-            R = np.array(
-                [[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]
-            )
-            # rotate and flip
-            if flip:
-                positions = R @ np.vstack((ans["qy"], ans["qx"]))
-            else:
-                positions = R @ np.vstack((ans["qx"], ans["qy"]))
-            # update
-            ans["qx"] = positions[0, :]
-            ans["qy"] = positions[1, :]
+        # only the uncalibrated fields are copied, qx and qy are written once
+        ans = np.empty_like(data)
+        for name in data.dtype.names:
+            if name not in ("qx", "qy"):
+                ans[name] = data[name]
+        qx, qy = data["qx"], data["qy"]
+        ans["qx"] = m00 * qx + m01 * qy + b0
+        ans["qy"] = m10 * qx + m11 * qy + b1
 
         # return
         return ans
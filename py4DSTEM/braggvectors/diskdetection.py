@@ -1,16 +1,23 @@
 # Functions for finding Bragg scattering by cross correlative template matching
 # with a vacuum probe.
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+
 import numpy as np
-from scipy.ndimage import gaussian_filter
+from scipy import fft as sp_fft
+from tqdm import tqdm
 
-from emdfile import tqdmnd
 from py4DSTEM import is_package_lite
 from py4DSTEM.braggvectors.braggvectors import BraggVectors
 from py4DSTEM.data import QPoints
 from py4DSTEM.datacube import DataCube
-from py4DSTEM.preprocess.utils import get_maxima_2D
-from py4DSTEM.process.utils.cross_correlate import get_cross_correlation_FT
+from py4DSTEM.preprocess.utils import gaussian_filter_2D, get_maxima_2D
+from py4DSTEM.process.utils.cross_correlate import (
+    apply_correlation_power,
+    get_cross_correlation_FT,
+)
 
 try:
     from py4DSTEM.braggvectors.diskdetection_aiml import find_Bragg_disks_aiml
@@ -19,6 +26,16 @@ except (ImportError, ModuleNotFoundError) as exc:
         raise exc
 
 
+# Target size, in bytes, of the complex-valued stack of cross correlations
+# computed at once when batching FFTs over many diffraction patterns
+FFT_BATCH_NBYTES = 2**27
+
+# Number of template Fourier transforms kept in memory, so that repeated disk
+# detection calls with the same probe skip recomputing the FFT
+TEMPLATE_FT_CACHE_SIZE = 4
+_template_FT_cache = OrderedDict()
+
+
 def find_Bragg_disks(
     data,
     template,
@@ -38,6 +55,7 @@ def find_Bragg_disks(
     maxNumPeaks=70,
     CUDA=False,
     CUDA_batched=True,
+    num_jobs=1,
     distributed=None,
     ML=False,
     ml_model_path=None,
@@ -156,6 +174,10 @@ def find_Bragg_disks(
     CUDA_batched : bool
         If True, and CUDA is selected, the FFT and IFFT steps of disk detection
         are performed in batches to better utilize GPU resources.
+    num_jobs : int or None
+        For disk detection on a full DataCube on the CPU, the number of
+        worker processes to distribute batches of diffraction patterns over.
+        If None, uses all CPU cores. Defaults to 1, i.e. serial processing.
     distributed : dict
         contains information for parallel processing using an IPyParallel or
         Dask distributed cluster.  Valid keys are:
@@ -205,15 +227,26 @@ def find_Bragg_disks(
             # h5py datasets have different rules for slicing than
             # numpy arrays, so we have to do this manually
             if "h5py" in str(type(dc.data)):
-                data = np.zeros((len(rx), dc.Q_Nx, dc.Q_Ny))
-                # no background subtraction
-                if not radial_bksb:
-                    for i, (x, y) in enumerate(zip(rx, ry)):
-                        data[i] = dc.data[x, y]
+                rx, ry = np.asarray(rx), np.asarray(ry)
+                # a single position
+                if rx.ndim == 0:
+                    if not radial_bksb:
+                        data = np.asarray(dc.data[rx, ry], dtype=float)
+                    else:
+                        data = dc.get_radial_bksb_dp(rx, ry)
+                # no background subtraction - read all the requested
+                # patterns in each scan row with a single read
+                elif not radial_bksb:
+                    data = np.empty((len(rx), dc.Q_Nx, dc.Q_Ny))
+                    for x in np.unique(rx):
+                        inds = np.nonzero(rx == x)[0]
+                        ys, inv = np.unique(ry[inds], return_inverse=True)
+                        data[inds] = dc.data[x, ys][inv]
                 # with bksubtr
                 else:
+                    data = np.zeros((len(rx), dc.Q_Nx, dc.Q_Ny))
                     for i, (x, y) in enumerate(zip(rx, ry)):
-                        data[i] = dc.get_radial_bksb_dp(rx, ry)
+                        data[i] = dc.get_radial_bksb_dp(x, y)
             else:
                 # no background subtraction
                 if not radial_bksb:
@@ -286,6 +319,9 @@ def find_Bragg_disks(
     # if radial background subtraction is requested, add to args
     if radial_bksb and mode == "dc_CPU":
         kws["radial_bksb"] = radial_bksb
+    # parallel CPU processing
+    if num_jobs != 1 and mode == "dc_CPU":
+        kws["num_jobs"] = num_jobs
 
     # run and return
     ans = fn(
@@ -342,13 +378,13 @@ def _find_Bragg_disks_single(
         # fourier transform the template
         assert _template_space in ("real", "fourier")
         if _template_space == "real":
-            template_FT = np.conj(np.fft.fft2(template))
+            template_FT = _get_template_FT(template)
         else:
             template_FT = template
 
         # apply any smoothing to the data
         if sigma_dp > 0:
-            DP = gaussian_filter(DP, sigma_dp)
+            DP = gaussian_filter_2D(DP, sigma_dp)
 
         # Compute cross correlation
         # _returnval = 'fourier' if subpixel == 'multicorr' else 'real'
@@ -420,34 +456,163 @@ def _find_Bragg_disks_stack(
     edgeBoundary=1,
     maxNumPeaks=100,
     _template_space="real",
+    _fft_workers=-1,
 ):
+    # without a template there are no FFTs to batch
+    if template is None:
+        ans = []
+        for idx in range(dp_stack.shape[0]):
+            dp = dp_stack[idx, :, :]
+            peaks = _find_Bragg_disks_single(
+                dp,
+                template,
+                filter_function=filter_function,
+                corrPower=corrPower,
+                sigma_dp=sigma_dp,
+                sigma_cc=sigma_cc,
+                subpixel=subpixel,
+                upsample_factor=upsample_factor,
+                minAbsoluteIntensity=minAbsoluteIntensity,
+                minRelativeIntensity=minRelativeIntensity,
+                relativeToPeak=relativeToPeak,
+                minPeakSpacing=minPeakSpacing,
+                edgeBoundary=edgeBoundary,
+                maxNumPeaks=maxNumPeaks,
+                _template_space=_template_space,
+                _return_cc=False,
+            )
+            ans.append(peaks)
+        return ans
+
+    # fourier transform the template
+    assert _template_space in ("real", "fourier")
+    if _template_space == "real":
+        template_FT = _get_template_FT(template)
+    else:
+        template_FT = template
+
+    # apply filter function
+    er = "filter_function must be callable"
+    if filter_function:
+        assert callable(filter_function), er
+
+    # compute the cross correlations in batches, reusing one real-valued
+    # scratch buffer for the clipped and smoothed correlations
+    batch_size = _get_FFT_batch_size(template_FT.shape)
+    cc_real_scratch = np.empty(
+        (min(batch_size, dp_stack.shape[0]),) + template_FT.shape
+    )
     ans = []
+    for i0 in range(0, dp_stack.shape[0], batch_size):
+        dps = dp_stack[i0 : i0 + batch_size]
+        if filter_function is not None:
+            dps = np.array([filter_function(dp) for dp in dps])
 
-    for idx in range(dp_stack.shape[0]):
-        dp = dp_stack[idx, :, :]
-        peaks = _find_Bragg_disks_single(
-            dp,
-            template,
-            filter_function=filter_function,
-            corrPower=corrPower,
-            sigma_dp=sigma_dp,
-            sigma_cc=sigma_cc,
-            subpixel=subpixel,
-            upsample_factor=upsample_factor,
-            minAbsoluteIntensity=minAbsoluteIntensity,
-            minRelativeIntensity=minRelativeIntensity,
-            relativeToPeak=relativeToPeak,
-            minPeakSpacing=minPeakSpacing,
-            edgeBoundary=edgeBoundary,
-            maxNumPeaks=maxNumPeaks,
-            _template_space=_template_space,
-            _return_cc=False,
+        # apply any smoothing to the data
+        if sigma_dp > 0:
+            dps = gaussian_filter_2D(dps, sigma_dp)
+
+        # Compute cross correlations
+        # The full complex correlations are only needed again for multicorr
+        # subpixel fitting. Otherwise, as the data and template are real,
+        # only half of each spectrum is computed and the inverse FFT may
+        # overwrite it
+        cc = _get_cross_correlation_FT_stack(
+            dps,
+            template_FT,
+            corrPower,
+            workers=_fft_workers,
+            real=subpixel != "multicorr",
         )
-        ans.append(peaks)
+        cc_real = cc_real_scratch[: cc.shape[0]]
+        if subpixel == "multicorr":
+            cc_ifft = sp_fft.ifft2(cc, workers=_fft_workers).real
+        else:
+            cc_ifft = sp_fft.irfft2(
+                cc, s=template_FT.shape, workers=_fft_workers, overwrite_x=True
+            )
+        np.maximum(cc_ifft, 0, out=cc_real)
+        if sigma_cc > 0:
+            gaussian_filter_2D(cc_real, sigma_cc, output=cc_real)
+
+        # Get maxima
+        for idx in range(cc.shape[0]):
+            maxima = get_maxima_2D(
+                cc_real[idx],
+                subpixel=subpixel,
+                upsample_factor=upsample_factor,
+                sigma=0,
+                minAbsoluteIntensity=minAbsoluteIntensity,
+                minRelativeIntensity=minRelativeIntensity,
+                relativeToPeak=relativeToPeak,
+                minSpacing=minPeakSpacing,
+                edgeBoundary=edgeBoundary,
+                maxNumPeaks=maxNumPeaks,
+                _ar_FT=cc[idx] if subpixel == "multicorr" else None,
+            )
+            ans.append(QPoints(maxima))
 
     return ans
 
 
+def _get_cross_correlation_FT_stack(
+    dp_stack, template_FT, corrPower=1, workers=-1, real=False
+):
+    """
+    Computes the complex valued cross/phase/hybrid correlations of each
+    slice dp_stack[i,:,:] with `template_FT`, with a single batched FFT
+    over the whole stack using `workers` threads.
+
+    `template_FT` is always the full spectrum np.conj(np.fft.fft2(template)).
+    If `real` is True, returns only the non-negative frequencies along the
+    last axis, as computed by a real-input FFT (i.e. rfft2), to be inverted
+    with irfft2.
+
+    As for np.fft, the transforms are always computed in double precision.
+    """
+    dp_stack = np.asarray(dp_stack, dtype=np.float64)
+    if real:
+        m = sp_fft.rfft2(dp_stack, workers=workers)
+        m *= template_FT[None, :, : m.shape[-1]]
+    else:
+        m = sp_fft.fft2(dp_stack, workers=workers)
+        m *= template_FT[None, :, :]
+    return apply_correlation_power(m, corrPower)
+
+
+def _get_FFT_batch_size(shape):
+    """
+    The number of `shape`-shaped diffraction patterns to cross correlate
+    at once, such that their complex FFTs take up about FFT_BATCH_NBYTES.
+    """
+    nbytes = np.dtype(np.complex128).itemsize * np.prod(shape)
+    return int(max(1, FFT_BATCH_NBYTES // nbytes))
+
+
+def _get_template_FT(template):
+    """
+    Returns np.conj(np.fft.fft2(template)), from a small LRU cache keyed by
+    the template's shape, dtype, and contents. The returned array is shared
+    between calls, and is therefore read-only.
+    """
+    template = np.asarray(template)
+    key = (
+        template.shape,
+        template.dtype.str,
+        blake2b(np.ascontiguousarray(template).data, digest_size=16).digest(),
+    )
+    template_FT = _template_FT_cache.get(key)
+    if template_FT is None:
+        template_FT = np.conj(np.fft.fft2(template))
+        template_FT.flags.writeable = False
+        _template_FT_cache[key] = template_FT
+        if len(_template_FT_cache) > TEMPLATE_FT_CACHE_SIZE:
+            _template_FT_cache.popitem(last=False)
+    else:
+        _template_FT_cache.move_to_end(key)
+    return template_FT
+
+
 # Whole datacube, CPU
 
 
@@ -467,56 +632,167 @@ def _find_Bragg_disks_CPU(
     edgeBoundary=20,
     maxNumPeaks=70,
     radial_bksb=False,
+    num_jobs=1,
 ):
     # Make the BraggVectors instance
     braggvectors = BraggVectors(datacube.Rshape, datacube.Qshape)
 
     # Get the template's Fourier Transform
-    probe_kernel_FT = np.conj(np.fft.fft2(probe)) if probe is not None else None
+    probe_kernel_FT = _get_template_FT(probe) if probe is not None else None
+
+    Qshape = probe.shape if probe is not None else datacube.Qshape
+    batch_size = _get_FFT_batch_size(Qshape)
+    kwargs = {
+        "template": probe_kernel_FT,
+        "filter_function": filter_function,
+        "corrPower": corrPower,
+        "sigma_dp": sigma_dp,
+        "sigma_cc": sigma_cc,
+        "subpixel": subpixel,
+        "upsample_factor": upsample_factor,
+        "minAbsoluteIntensity": minAbsoluteIntensity,
+        "minRelativeIntensity": minRelativeIntensity,
+        "relativeToPeak": relativeToPeak,
+        "minPeakSpacing": minPeakSpacing,
+        "edgeBoundary": edgeBoundary,
+        "maxNumPeaks": maxNumPeaks,
+        "_template_space": "fourier",
+    }
 
-    # Loop over all diffraction patterns
+    # Distribute batches of diffraction patterns over a pool of workers
+    if num_jobs != 1:
+        _find_Bragg_disks_CPU_distributed(
+            datacube,
+            braggvectors,
+            batch_size=batch_size,
+            radial_bksb=radial_bksb,
+            num_jobs=num_jobs,
+            kwargs=kwargs,
+        )
+        return braggvectors
+
+    # Loop over blocks of diffraction patterns, reading the next block in a
+    # background thread while the current one is processed, so that reads
+    # from disk overlap with the (GIL-releasing) FFTs
     # Compute and populate BraggVectors data
-    for rx, ry in tqdmnd(
-        datacube.R_Nx,
-        datacube.R_Ny,
+    blocks = _get_scan_blocks(datacube.R_Nx, datacube.R_Ny, batch_size)
+    with ThreadPoolExecutor(max_workers=1) as reader, tqdm(
+        total=datacube.R_N,
         desc="Finding Bragg Disks",
         unit="DP",
         unit_scale=True,
-    ):
-        # Get a diffraction pattern
+    ) as pbar:
+        next_read = reader.submit(_get_scan_block_dps, datacube, blocks[0], radial_bksb)
+        for i in range(len(blocks)):
+            positions, dps = next_read.result()
+            if i + 1 < len(blocks):
+                next_read = reader.submit(
+                    _get_scan_block_dps, datacube, blocks[i + 1], radial_bksb
+                )
+            peaks = _find_Bragg_disks_stack(dps, **kwargs)
+
+            # Populate data
+            for (rx, ry), p in zip(positions, peaks):
+                braggvectors._v_uncal[rx, ry] = p
+            pbar.update(len(positions))
 
-        # without background subtraction
-        if not radial_bksb:
-            dp = datacube.data[rx, ry, :, :]
-        # and with
-        else:
-            dp = datacube.get_radial_bksb_dp(rx, ry)
-
-        # Compute
-        peaks = _find_Bragg_disks_single(
-            dp,
-            template=probe_kernel_FT,
-            filter_function=filter_function,
-            corrPower=corrPower,
-            sigma_dp=sigma_dp,
-            sigma_cc=sigma_cc,
-            subpixel=subpixel,
-            upsample_factor=upsample_factor,
-            minAbsoluteIntensity=minAbsoluteIntensity,
-            minRelativeIntensity=minRelativeIntensity,
-            relativeToPeak=relativeToPeak,
-            minPeakSpacing=minPeakSpacing,
-            edgeBoundary=edgeBoundary,
-            maxNumPeaks=maxNumPeaks,
-            _return_cc=False,
-            _template_space="fourier",
+    # Return
+    return braggvectors
+
+
+def _get_scan_blocks(R_Nx, R_Ny, batch_size):
+    """
+    Splits an (R_Nx,R_Ny) scan into blocks of at most `batch_size` positions,
+    each of which is a rectangular (rx slice, ry slice) region that is
+    contiguous in C order, i.e. several whole rows or part of one row.
+    """
+    if batch_size >= R_Ny:
+        nrows = batch_size // R_Ny
+        return [
+            (slice(rx, min(rx + nrows, R_Nx)), slice(0, R_Ny))
+            for rx in range(0, R_Nx, nrows)
+        ]
+    return [
+        (slice(rx, rx + 1), slice(ry, min(ry + batch_size, R_Ny)))
+        for rx in range(R_Nx)
+        for ry in range(0, R_Ny, batch_size)
+    ]
+
+
+def _get_scan_block_dps(datacube, block, radial_bksb=False):
+    """
+    Returns the scan positions in `block`, a (rx slice, ry slice) 2-tuple,
+    and the (N,Q_Nx,Q_Ny) stack of their diffraction patterns. Without
+    background subtraction the block is read with a single slice of
+    datacube.data, which for h5py-backed data is one hyperslab read.
+    """
+    sx, sy = block
+    positions = [
+        (rx, ry) for rx in range(sx.start, sx.stop) for ry in range(sy.start, sy.stop)
+    ]
+    if not radial_bksb:
+        dps = np.asarray(datacube.data[sx, sy, :, :])
+        dps = dps.reshape((-1,) + dps.shape[2:])
+    else:
+        dps = np.array([datacube.get_radial_bksb_dp(rx, ry) for rx, ry in positions])
+    return positions, dps
+
+
+def _find_Bragg_disks_CPU_distributed(
+    datacube,
+    braggvectors,
+    batch_size,
+    radial_bksb,
+    num_jobs,
+    kwargs,
+):
+    """
+    Runs _find_Bragg_disks_stack on batches of the diffraction patterns in
+    `datacube` in a pool of `num_jobs` worker processes, and populates
+    `braggvectors` with the results. Each worker is limited to a single
+    thread, to avoid oversubscribing the cores.
+    """
+    from mpire import WorkerPool, cpu_count
+
+    num_jobs = num_jobs or cpu_count()
+
+    # keep enough batches around to balance the load across workers
+    batch_size = max(1, min(batch_size, datacube.R_N // (4 * num_jobs)))
+    blocks = [
+        (block,) for block in _get_scan_blocks(datacube.R_Nx, datacube.R_Ny, batch_size)
+    ]
+
+    with WorkerPool(
+        n_jobs=num_jobs,
+        shared_objects=(datacube, radial_bksb, kwargs),
+    ) as pool:
+        results = pool.map(
+            _find_Bragg_disks_CPU_block,
+            blocks,
+            progress_bar=True,
+            progress_bar_options={"desc": "Finding Bragg Disks", "unit": "batch"},
         )
 
-        # Populate data
-        braggvectors._v_uncal[rx, ry] = peaks
+    # Populate data
+    for positions, peaks in results:
+        for (rx, ry), p in zip(positions, peaks):
+            braggvectors._v_uncal[rx, ry] = QPoints(p)
 
-    # Return
-    return braggvectors
+
+def _find_Bragg_disks_CPU_block(shared, block):
+    """
+    Worker function for _find_Bragg_disks_CPU_distributed. Finds the disks in
+    one scan block, with the datacube, radial_bksb and detection kwargs passed
+    as the pool's shared objects. Defined at module level so it can be pickled
+    when the worker processes are spawned rather than forked.
+    """
+    from threadpoolctl import threadpool_limits
+
+    datacube, radial_bksb, kwargs = shared
+    with threadpool_limits(limits=1):
+        positions, dps = _get_scan_block_dps(datacube, block, radial_bksb)
+        peaks = _find_Bragg_disks_stack(dps, **kwargs, _fft_workers=1)
+        return positions, [p.data for p in peaks]
 
 
 # CUDA - unbatched
@@ -12,6 +12,7 @@ from emdfile import PointList, PointListArray
 from py4DSTEM.data import QPoints
 from py4DSTEM.braggvectors.kernels import kernels
 from py4DSTEM.braggvectors.diskdetection_aiml import _get_latest_model
+from py4DSTEM.preprocess.utils import get_spaced_maxima_mask
 
 # from py4DSTEM.braggvectors.diskdetection import universal_threshold
 
@@ -492,32 +493,31 @@ def get_maxima_2D_cp(
     maxima = np.sort(maxima, order="intensity")[::-1]
 
     if len(maxima) > 0:
-        # Remove maxima which are too close
+        # Remove maxima which are too close, stopping once maxNumPeaks are
+        # kept, since all later maxima are discarded below anyway
         if minSpacing > 0:
-            deletemask = np.zeros(len(maxima), dtype=bool)
-            for i in range(len(maxima)):
-                if deletemask[i] == False:  # noqa: E712
-                    tooClose = (
-                        (maxima["x"] - maxima["x"][i]) ** 2
-                        + (maxima["y"] - maxima["y"][i]) ** 2
-                    ) < minSpacing**2
-                    tooClose[: i + 1] = False
-                    deletemask[tooClose] = True
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
-
-        # Remove maxima which are too dim
+            keepmask = get_spaced_maxima_mask(
+                maxima["x"],
+                maxima["y"],
+                minSpacing,
+                maxNumPeaks=(
+                    maxNumPeaks if maxNumPeaks is not None and maxNumPeaks > 0 else None
+                ),
+            )
+            maxima = maxima[keepmask]
+
+        # Remove maxima which are too dim, relative to the relativeToPeak'th
+        # maximum or on an absolute scale, with a single compaction
+        keepmask = np.ones(len(maxima), dtype=bool)
         if (minRelativeIntensity > 0) & (len(maxima) > relativeToPeak):
             assert isinstance(relativeToPeak, (int, np.integer))
-            deletemask = (
+            keepmask &= ~(
                 maxima["intensity"] / maxima["intensity"][relativeToPeak]
                 < minRelativeIntensity
             )
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
-
-        # Remove maxima which are too dim, absolute scale
         if minAbsoluteIntensity > 0:
-            deletemask = maxima["intensity"] < minAbsoluteIntensity
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
+            keepmask &= ~(maxima["intensity"] < minAbsoluteIntensity)
+        maxima = maxima[keepmask]
 
         # Remove maxima in excess of maxNumPeaks
         if maxNumPeaks > 0:
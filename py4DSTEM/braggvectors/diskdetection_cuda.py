@@ -3,10 +3,13 @@ Functions for finding Braggdisks using cupy
 
 """
 
+import functools
+
 import numpy as np
 
 import cupy as cp
-from cupyx.scipy.ndimage import gaussian_filter
+import cupyx
+from cupyx.scipy.ndimage import gaussian_filter, maximum_filter
 import cupyx.scipy.fft as cufft
 from time import time
 import numba
@@ -14,6 +17,7 @@ import numba
 from emdfile import tqdmnd
 from py4DSTEM import PointList, PointListArray
 from py4DSTEM.braggvectors.kernels import kernels
+from py4DSTEM.preprocess.utils import get_spaced_maxima_mask
 
 
 def find_Bragg_disks_CUDA(
@@ -104,8 +108,8 @@ def find_Bragg_disks_CUDA(
         DP.shape == probe.shape
     ), "Probe kernel shape must match filtered DP shape"
 
-    # Get the probe kernel FT as a cupy array
-    probe_kernel_FT = cp.conj(cp.fft.fft2(cp.array(probe))).astype(cp.complex64)
+    # Get the probe kernel FT as a cupy array, uploaded once for all patterns
+    probe_kernel_FT = prepare_probe_kernel(probe)
     bytes_per_pattern = probe_kernel_FT.nbytes
 
     # get the maximal array kernel
@@ -131,92 +135,166 @@ def find_Bragg_disks_CUDA(
         max_num_bytes = cp.cuda.Device().mem_info[0]
         # use a fudge factor to leave room for the fourier transformed data
         # I have set this at 10, which results in underutilization of
-        # VRAM, because this yielded better performance in my testing
-        batch_size = max_num_bytes // (bytes_per_pattern * 10)
-        num_batches = datacube.R_N // batch_size + 1
+        # VRAM, because this yielded better performance in my testing.
+        # Two batches are kept on the device at once, hence the extra factor 2
+        batch_size = max_num_bytes // (bytes_per_pattern * 10 * 2)
+        num_batches = -(-datacube.R_N // batch_size)
 
         print(f"Using {num_batches} batches of {batch_size} patterns each...")
 
-        # allocate array for batch of DPs
-        batched_subcube = cp.zeros(
-            (batch_size, datacube.Q_Nx, datacube.Q_Ny), dtype=cp.float32
-        )
-
-        for batch_idx in tqdmnd(
-            range(num_batches), desc="Finding Bragg disks in batches", unit="batch"
-        ):
-            # the final batch may be smaller than the other ones:
-            probes_remaining = datacube.R_N - (batch_idx * batch_size)
-            this_batch_size = (
-                probes_remaining if probes_remaining < batch_size else batch_size
-            )
-
-            # fill in diffraction patterns, with filtering
+        # allocate two batches of DPs, each with its own stream and pinned
+        # host-side staging buffer. While the patterns of one batch are searched
+        # for peaks, the next batch is filled, copied to the device and
+        # correlated on the other stream. The complex device arrays let the
+        # FFTs be done in place
+        shape = (batch_size, datacube.Q_Nx, datacube.Q_Ny)
+        streams = [cp.cuda.Stream(non_blocking=True) for _ in range(2)]
+        batched_subcube_host = [
+            cupyx.empty_pinned(shape, dtype=np.float32) for _ in range(2)
+        ]
+        batched_subcube_real = [cp.empty(shape, dtype=cp.float32) for _ in range(2)]
+        batched_subcube = [cp.zeros(shape, dtype=cp.complex64) for _ in range(2)]
+        uploaded = [None, None]
+        correlated = None
+
+        def correlate_batch(batch_idx):
+            nonlocal correlated
+            slot = batch_idx % 2
+            this_batch_size = min(batch_size, datacube.R_N - batch_idx * batch_size)
+
+            # fill in diffraction patterns, with filtering, once the previous
+            # copy out of this pinned buffer has finished
+            if uploaded[slot] is not None:
+                uploaded[slot].synchronize()
             for subbatch_idx in range(this_batch_size):
                 patt_idx = batch_idx * batch_size + subbatch_idx
                 rx, ry = np.unravel_index(patt_idx, (datacube.R_Nx, datacube.R_Ny))
-                batched_subcube[subbatch_idx, :, :] = cp.array(
-                    (
-                        datacube.data[rx, ry, :, :]
-                        if filter_function is None
-                        else filter_function(datacube.data[rx, ry, :, :])
-                    ),
-                    dtype=cp.float32,
+                batched_subcube_host[slot][subbatch_idx, :, :] = (
+                    datacube.data[rx, ry, :, :]
+                    if filter_function is None
+                    else filter_function(datacube.data[rx, ry, :, :])
                 )
 
-            # Perform the FFT and multiplication by probe_kernel on the batched array
-            batched_crosscorr = (
-                cufft.fft2(batched_subcube, overwrite_x=True)
-                * probe_kernel_FT[None, :, :]
-            )
-
-            # Iterate over the patterns in the batch and do the Bragg disk stuff
-            for subbatch_idx in range(this_batch_size):
-                patt_idx = batch_idx * batch_size + subbatch_idx
-                rx, ry = np.unravel_index(patt_idx, (datacube.R_Nx, datacube.R_Ny))
-
-                subFFT = batched_crosscorr[subbatch_idx]
-                ccc = cp.abs(subFFT) ** corrPower * cp.exp(1j * cp.angle(subFFT))
-                cc = cp.maximum(cp.real(cp.fft.ifft2(ccc)), 0)
+            with streams[slot]:
+                batched_subcube_real[slot][:this_batch_size].set(
+                    batched_subcube_host[slot][:this_batch_size], stream=streams[slot]
+                )
+                uploaded[slot] = streams[slot].record()
+                batched_subcube[slot][:this_batch_size] = batched_subcube_real[slot][
+                    :this_batch_size
+                ]
 
-                _find_Bragg_disks_single_DP_FK_CUDA(
-                    None,
-                    None,
-                    ccc=ccc,
-                    cc=cc,
+                # Get the hybrid correlations and their smoothed, real space
+                # counterparts for the whole batch at once. The cached cuFFT plans
+                # share their workspace, so the correlations of consecutive
+                # batches are kept from running concurrently
+                if correlated is not None:
+                    streams[slot].wait_event(correlated)
+                batched_crosscorr, batched_cc = _get_cross_correlation_fk_batch(
+                    batched_subcube[slot][:this_batch_size],
+                    probe_kernel_FT,
                     corrPower=corrPower,
                     sigma=sigma,
-                    edgeBoundary=edgeBoundary,
-                    minRelativeIntensity=minRelativeIntensity,
-                    minAbsoluteIntensity=minAbsoluteIntensity,
-                    relativeToPeak=relativeToPeak,
-                    minPeakSpacing=minPeakSpacing,
-                    maxNumPeaks=maxNumPeaks,
-                    subpixel=subpixel,
-                    upsample_factor=upsample_factor,
-                    filter_function=filter_function,
-                    peaks=peaks.get_pointlist(rx, ry),
-                    get_maximal_points=get_maximal_points,
-                    blocks=blocks,
-                    threads=threads,
                 )
+                correlated = streams[slot].record()
+
+            return this_batch_size, batched_crosscorr, batched_cc
+
+        next_batch = correlate_batch(0)
+        for batch_idx in tqdmnd(
+            range(num_batches), desc="Finding Bragg disks in batches", unit="batch"
+        ):
+            this_batch_size, batched_crosscorr, batched_cc = next_batch
 
-        # clean up
-        del batched_subcube, batched_crosscorr, subFFT, cc, ccc
+            # start on the next batch before searching this one for peaks
+            if batch_idx + 1 < num_batches:
+                next_batch = correlate_batch(batch_idx + 1)
+
+            # Iterate over the patterns in the batch and do the Bragg disk stuff
+            with streams[batch_idx % 2]:
+                for subbatch_idx in range(this_batch_size):
+                    patt_idx = batch_idx * batch_size + subbatch_idx
+                    rx, ry = np.unravel_index(patt_idx, (datacube.R_Nx, datacube.R_Ny))
+
+                    _find_Bragg_disks_single_DP_FK_CUDA(
+                        None,
+                        None,
+                        ccc=batched_crosscorr[subbatch_idx],
+                        cc=batched_cc[subbatch_idx],
+                        corrPower=corrPower,
+                        sigma=0,
+                        edgeBoundary=edgeBoundary,
+                        minRelativeIntensity=minRelativeIntensity,
+                        minAbsoluteIntensity=minAbsoluteIntensity,
+                        relativeToPeak=relativeToPeak,
+                        minPeakSpacing=minPeakSpacing,
+                        maxNumPeaks=maxNumPeaks,
+                        subpixel=subpixel,
+                        upsample_factor=upsample_factor,
+                        filter_function=filter_function,
+                        peaks=peaks.get_pointlist(rx, ry),
+                        get_maximal_points=get_maximal_points,
+                        blocks=blocks,
+                        threads=threads,
+                    )
+
+        # clean up, including the cached batch sized cuFFT plans' workspace
+        for stream in streams:
+            stream.synchronize()
+        del batched_subcube, batched_subcube_real, batched_crosscorr, batched_cc
+        del next_batch
+        _get_fft_plan.cache_clear()
         cp.get_default_memory_pool().free_all_blocks()
 
     else:
+        # Stage the diffraction patterns through two pinned host buffers, copying
+        # them to the device asynchronously, so that the copy of the next
+        # pattern overlaps the work on the current one
+        positions = list(np.ndindex(datacube.R_Nx, datacube.R_Ny))
+        DP_pinned = [cupyx.empty_pinned(DP.shape, dtype=np.float32) for _ in range(2)]
+        DP_device = [cp.empty(DP.shape, dtype=cp.float32) for _ in range(2)]
+        DP_copied = [None, None]
+        DP_used = [None, None]
+        copy_stream = cp.cuda.Stream(non_blocking=True)
+
+        def stage_DP(ind):
+            slot = ind % 2
+            rx, ry = positions[ind]
+            # block the host until the previous copy out of this pinned buffer
+            # has finished, before overwriting it
+            if DP_copied[slot] is not None:
+                DP_copied[slot].synchronize()
+            np.copyto(
+                DP_pinned[slot],
+                (
+                    datacube.data[rx, ry, :, :]
+                    if filter_function is None
+                    else filter_function(datacube.data[rx, ry, :, :])
+                ),
+            )
+            # and keep the copy into the device buffer from starting until the
+            # pattern previously staged there has been processed
+            if DP_used[slot] is not None:
+                copy_stream.wait_event(DP_used[slot])
+            DP_device[slot].set(DP_pinned[slot], stream=copy_stream)
+            DP_copied[slot] = copy_stream.record()
+
         # Loop over all diffraction patterns
-        for Rx, Ry in tqdmnd(
-            datacube.R_Nx,
-            datacube.R_Ny,
-            desc="Finding Bragg Disks",
-            unit="DP",
-            unit_scale=True,
+        stage_DP(0)
+        for ind, (Rx, Ry) in enumerate(
+            tqdmnd(
+                datacube.R_Nx,
+                datacube.R_Ny,
+                desc="Finding Bragg Disks",
+                unit="DP",
+                unit_scale=True,
+            )
         ):
-            DP = datacube.data[Rx, Ry, :, :]
+            if ind + 1 < len(positions):
+                stage_DP(ind + 1)
+            cp.cuda.get_current_stream().wait_event(DP_copied[ind % 2])
             _find_Bragg_disks_single_DP_FK_CUDA(
-                DP,
+                DP_device[ind % 2],
                 probe_kernel_FT,
                 corrPower=corrPower,
                 sigma=sigma,
@@ -228,12 +306,12 @@ def find_Bragg_disks_CUDA(
                 maxNumPeaks=maxNumPeaks,
                 subpixel=subpixel,
                 upsample_factor=upsample_factor,
-                filter_function=filter_function,
                 peaks=peaks.get_pointlist(Rx, Ry),
                 get_maximal_points=get_maximal_points,
                 blocks=blocks,
                 threads=threads,
             )
+            DP_used[ind % 2] = cp.cuda.get_current_stream().record()
     t = time() - t0
     print(
         f"Analyzed {datacube.R_N} diffraction patterns in {t//3600}h {t % 3600 // 60}m {t % 60:.2f}s\n(avg. speed {datacube.R_N/t:0.4f} patterns per second)".format()
@@ -329,8 +407,12 @@ def _find_Bragg_disks_single_DP_FK_CUDA(
 
     # if we are in batching mode, cc and ccc will be provided. else, compute it
     if ccc is None:
+        assert isinstance(
+            probe_kernel_FT, cp.ndarray
+        ), "probe_kernel_FT must be a cupy array; see prepare_probe_kernel"
+
         # Perform any prefiltering
-        DP = cp.array(
+        DP = cp.asarray(
             DP if filter_function is None else filter_function(DP), dtype=cp.float32
         )
 
@@ -375,6 +457,24 @@ def _find_Bragg_disks_single_DP_FK_CUDA(
         return peaks
 
 
+def prepare_probe_kernel(probe, dtype=cp.complex64):
+    """
+    Returns the probe kernel in Fourier space, probe_kernel_FT = F(probe)*, as
+    a cupy array of the given complex dtype, to be uploaded once and reused for
+    all the cross correlations of a datacube.
+
+    complex64 (default) halves the memory traffic of the elementwise multiply
+    with each pattern's FFT relative to complex128, and is ample for locating
+    the correlation peaks. Lower precision complex types are not supported by
+    cupy's arithmetic, so are not offered here.
+    """
+    assert dtype in (
+        cp.complex64,
+        cp.complex128,
+    ), "dtype must be cp.complex64 or cp.complex128"
+    return cp.conj(cp.fft.fft2(cp.asarray(probe))).astype(dtype, copy=False)
+
+
 def get_cross_correlation_fk(ar, fourierkernel, corrPower=1, returnval="cc"):
     """
     Calculates the cross correlation of ar with fourierkernel.
@@ -389,12 +489,50 @@ def get_cross_correlation_fk(ar, fourierkernel, corrPower=1, returnval="cc"):
         if return=='fourier', returns the output in Fourier space, before taking the
         inverse transform.
     """
-    m = cp.fft.fft2(ar) * fourierkernel
-    ccc = cp.abs(m) ** (corrPower) * cp.exp(1j * cp.angle(m))
+    # transform a complex copy of ar in place, with a cached cuFFT plan
+    m = ar.astype(cp.result_type(ar.dtype, cp.complex64))
+    plan = _get_fft_plan(m.shape, m.dtype.str)
+    m = cufft.fft2(m, overwrite_x=True, plan=plan)
+    m *= fourierkernel
+    if corrPower != 1:
+        kernels["hybrid_correlation"](m, corrPower, m)
+    ccc = m
     if returnval == "fourier":
         return ccc
     else:
-        return cp.real(cp.fft.ifft2(ccc))
+        return cp.real(cufft.ifft2(ccc, overwrite_x=True, plan=plan))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_fft_plan(shape, dtype):
+    """
+    Returns a cuFFT plan for 2D complex transforms over the last two axes of
+    arrays of the given shape and dtype, cached so that repeated calls on
+    same-shaped diffraction patterns reuse the plan and its workspace.
+    """
+    return cufft.get_fft_plan(cp.empty(shape, dtype=dtype), axes=(-2, -1))
+
+
+def _get_cross_correlation_fk_batch(ar, fourierkernel, corrPower=1, sigma=0):
+    """
+    Calculates the cross correlations of a stack of diffraction patterns ar, of
+    shape (N,Qx,Qy) and dtype complex64, with fourierkernel, as in
+    get_cross_correlation_fk. The forward FFT is done in place, overwriting ar.
+
+    Returns the correlations in Fourier space, ccc, and their real space
+    counterparts clipped at zero and smoothed by a gaussian of standard deviation
+    sigma, cc.
+    """
+    plan = _get_fft_plan(ar.shape, ar.dtype.str)
+    ccc = cufft.fft2(ar, overwrite_x=True, plan=plan)
+    ccc *= fourierkernel[None, :, :]
+    if corrPower != 1:
+        kernels["hybrid_correlation"](ccc, corrPower, ccc)
+    cc = cufft.ifft2(ccc, plan=plan)
+    cc = cp.maximum(cp.real(cc), 0)
+    if sigma > 0:
+        cc = gaussian_filter(cc, (0, sigma, sigma))
+    return ccc, cc
 
 
 def get_maxima_2D(
@@ -438,6 +576,10 @@ def get_maxima_2D(
                                 passed here as a complex array.  Otherwise, if ar_FT is None,
                                 it is computed
         upsample_factor         (int) required iff subpixel=='multicorr'
+        get_maximal_points      (RawKernel or None) one of the maximal_pts kernels, launched
+                                with blocks and threads, marking the pixels of ar greater
+                                than all 8 neighbors. If None, the same mask is computed
+                                with cupyx.scipy.ndimage.maximum_filter, for any dtype of ar
 
     Returns
         maxima_x                (ndarray) x-coords of the local maximum, sorted by intensity.
@@ -446,14 +588,25 @@ def get_maxima_2D(
     """
 
     # Get maxima
-    ar = gaussian_filter(ar, sigma)
-    maxima_bool = cp.zeros_like(ar, dtype=bool)
+    if sigma > 0:
+        ar = gaussian_filter(ar, sigma)
     sizex = ar.shape[0]
     sizey = ar.shape[1]
-    N = sizex * sizey
-    get_maximal_points(
-        blocks, threads, (ar, maxima_bool, minAbsoluteIntensity, sizex, sizey, N)
-    )
+    if get_maximal_points is None:
+        # strictly greater than all 8 neighbors, excluding the frame edge,
+        # as in the maximal_pts kernels
+        footprint = cp.ones((3, 3), dtype=bool)
+        footprint[1, 1] = False
+        maxima_bool = ar > maximum_filter(ar, footprint=footprint)
+        maxima_bool &= ar >= minAbsoluteIntensity
+        maxima_bool[[0, -1], :] = False
+        maxima_bool[:, [0, -1]] = False
+    else:
+        maxima_bool = cp.zeros_like(ar, dtype=bool)
+        N = sizex * sizey
+        get_maximal_points(
+            blocks, threads, (ar, maxima_bool, minAbsoluteIntensity, sizex, sizey, N)
+        )
 
     # Remove edges
     if edgeBoundary > 0:
@@ -467,83 +620,81 @@ def get_maxima_2D(
         maxima_bool[:, :1] = False
         maxima_bool[:, -1:] = False
 
-    # Get indices, sorted by intensity
+    # Get indices, sorted by decreasing intensity, then x, then y, on the
+    # device. Only the sorted maxima are copied to the host, in one transfer
     maxima_x, maxima_y = cp.nonzero(maxima_bool)
-    maxima_x = maxima_x.get()
-    maxima_y = maxima_y.get()
-    dtype = np.dtype([("x", float), ("y", float), ("intensity", float)])
-    maxima = np.zeros(len(maxima_x), dtype=dtype)
-    maxima["x"] = maxima_x
-    maxima["y"] = maxima_y
-
-    ar = ar.get()
-    maxima["intensity"] = ar[maxima_x, maxima_y]
-    maxima = np.sort(maxima, order="intensity")[::-1]
-
-    if len(maxima) > 0:
-        # Remove maxima which are too close
+    maxima_dev = cp.stack((maxima_y, maxima_x, ar[maxima_x, maxima_y])).astype(
+        cp.float64
+    )
+    my, mx, mI = maxima_dev[:, cp.lexsort(maxima_dev)[::-1]].get()
+
+    if len(mx) > 0:
+        # Remove maxima which are too close, stopping once maxNumPeaks are
+        # kept, since all later maxima are discarded below anyway
         if minSpacing > 0:
-            deletemask = np.zeros(len(maxima), dtype=bool)
-            for i in range(len(maxima)):
-                if deletemask[i] == False:  # noqa: E712
-                    tooClose = (
-                        (maxima["x"] - maxima["x"][i]) ** 2
-                        + (maxima["y"] - maxima["y"][i]) ** 2
-                    ) < minSpacing**2
-                    tooClose[: i + 1] = False
-                    deletemask[tooClose] = True
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
-
-        # Remove maxima which are too dim
-        if (minRelativeIntensity > 0) & (len(maxima) > relativeToPeak):
-            deletemask = (
-                maxima["intensity"] / maxima["intensity"][relativeToPeak]
-                < minRelativeIntensity
+            keepmask = get_spaced_maxima_mask(
+                mx,
+                my,
+                minSpacing,
+                maxNumPeaks=(
+                    maxNumPeaks if maxNumPeaks is not None and maxNumPeaks > 0 else None
+                ),
             )
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
-
-        # Remove maxima which are too dim, absolute scale
+            mx, my, mI = mx[keepmask], my[keepmask], mI[keepmask]
+
+        # Remove maxima which are too dim, relative to the relativeToPeak'th
+        # maximum or on an absolute scale, and those in excess of maxNumPeaks,
+        # with a single compaction
+        keepmask = np.ones(len(mx), dtype=bool)
+        if (minRelativeIntensity > 0) & (len(mx) > relativeToPeak):
+            keepmask &= ~(mI / mI[relativeToPeak] < minRelativeIntensity)
         if minAbsoluteIntensity > 0:
-            deletemask = maxima["intensity"] < minAbsoluteIntensity
-            maxima = np.delete(maxima, np.nonzero(deletemask)[0])
-
-        # Remove maxima in excess of maxNumPeaks
+            keepmask &= ~(mI < minAbsoluteIntensity)
+        keep = np.flatnonzero(keepmask)
         if maxNumPeaks is not None and maxNumPeaks > 0:
-            if len(maxima) > maxNumPeaks:
-                maxima = maxima[:maxNumPeaks]
+            keep = keep[:maxNumPeaks]
+        mx, my, mI = mx[keep], my[keep], mI[keep]
 
         # Subpixel fitting
         # For all subpixel fitting, first fit 1D parabolas in x and y to 3 points (maximum, +/- 1 pixel)
-        if subpixel != "none":
-            for i in range(len(maxima)):
-                Ix1_ = ar[int(maxima["x"][i]) - 1, int(maxima["y"][i])]
-                Ix0 = ar[int(maxima["x"][i]), int(maxima["y"][i])]
-                Ix1 = ar[int(maxima["x"][i]) + 1, int(maxima["y"][i])]
-                Iy1_ = ar[int(maxima["x"][i]), int(maxima["y"][i]) - 1]
-                Iy0 = ar[int(maxima["x"][i]), int(maxima["y"][i])]
-                Iy1 = ar[int(maxima["x"][i]), int(maxima["y"][i]) + 1]
-                deltax = (Ix1 - Ix1_) / (4 * Ix0 - 2 * Ix1 - 2 * Ix1_)
-                deltay = (Iy1 - Iy1_) / (4 * Iy0 - 2 * Iy1 - 2 * Iy1_)
-                maxima["x"][i] += deltax if np.abs(deltax) <= 1.0 else 0.0
-                maxima["y"][i] += deltay if np.abs(deltay) <= 1.0 else 0.0
-                maxima["intensity"][i] = linear_interpolation_2D(
-                    ar, maxima["x"][i], maxima["y"][i]
-                )
+        if subpixel != "none" and len(mx) > 0:
+            # shifts and intensities, from one thread per maximum
+            num_maxima = len(mx)
+            refined = cp.empty((3, num_maxima), dtype=cp.float64)
+            kernels["parabolic_subpix_float32"](
+                ((num_maxima + 31) // 32,),
+                (32,),
+                (
+                    cp.ascontiguousarray(ar, dtype=cp.float32),
+                    cp.asarray(mx.astype(np.int64)),
+                    cp.asarray(my.astype(np.int64)),
+                    refined[0],
+                    refined[1],
+                    refined[2],
+                    sizex,
+                    sizey,
+                    num_maxima,
+                ),
+            )
+            refined = refined.get()
+            mx = mx + refined[0]
+            my = my + refined[1]
+            mI = refined[2]
         # Further refinement with fourier upsampling
         if subpixel == "multicorr":
             ar_FT = cp.conj(ar_FT)
 
-            xyShift = np.vstack((maxima["x"], maxima["y"])).T
+            xyShift = np.vstack((mx, my)).T
             # we actually have to lose some precision and go down to half-pixel
             # accuracy. this could also be done by a single upsampling at factor 2
             # instead of get_maxima_2D.
             xyShift = cp.array(np.round(xyShift * 2.0) / 2)
 
             subShift = upsampled_correlation(ar_FT, upsample_factor, xyShift).get()
-            maxima["x"] = subShift[:, 0]
-            maxima["y"] = subShift[:, 1]
+            mx = subShift[:, 0]
+            my = subShift[:, 1]
 
-    return maxima["x"], maxima["y"], maxima["intensity"]
+    return mx, my, mI
 
 
 def upsampled_correlation(imageCorr, upsampleFactor, xyShift):
@@ -605,33 +756,33 @@ def upsampled_correlation(imageCorr, upsampleFactor, xyShift):
         imageCorrUpsample.shape[1:3],
     )
 
-    # add a subpixel shift via parabolic fitting, serially for each peak
-    for idx in range(xSubShift.shape[0]):
-        try:
-            icc = np.real(
-                imageCorrUpsample[
-                    idx,
-                    xSubShift[idx] - 1 : xSubShift[idx] + 2,
-                    ySubShift[idx] - 1 : ySubShift[idx] + 2,
-                ]
-            )
-            dx = (icc[2, 1] - icc[0, 1]) / (
-                4 * icc[1, 1] - 2 * icc[2, 1] - 2 * icc[0, 1]
-            )
-            dy = (icc[1, 2] - icc[1, 0]) / (
-                4 * icc[1, 1] - 2 * icc[1, 2] - 2 * icc[1, 0]
-            )
-        except:
-            dx, dy = (
-                0,
-                0,
-            )  # this is the case when the peak is near the edge and one of the above values does not exist
-
-        xyShift[idx] = (
-            xyShift[idx]
-            + (cp.array([xSubShift[idx] + dx, ySubShift[idx] + dy]) - globalShift)
-            / upsampleFactor
-        )
+    # add a subpixel shift via parabolic fitting, for all peaks at once. Peaks on
+    # the edge of the upsampled region, where the fit is not possible, are not shifted
+    num_pts, sizex, sizey = imageCorrUpsample.shape
+    icc = np.real(imageCorrUpsample).astype(np.float64)
+    fit = np.nonzero(
+        (xSubShift > 0)
+        & (xSubShift < sizex - 1)
+        & (ySubShift > 0)
+        & (ySubShift < sizey - 1)
+    )[0]
+    x, y = xSubShift[fit], ySubShift[fit]
+    icc_0, icc_xm, icc_xp, icc_ym, icc_yp = (
+        icc[fit, x, y],
+        icc[fit, x - 1, y],
+        icc[fit, x + 1, y],
+        icc[fit, x, y - 1],
+        icc[fit, x, y + 1],
+    )
+    dx = np.zeros(num_pts)
+    dy = np.zeros(num_pts)
+    dx[fit] = (icc_xp - icc_xm) / (4 * icc_0 - 2 * icc_xp - 2 * icc_xm)
+    dy[fit] = (icc_yp - icc_ym) / (4 * icc_0 - 2 * icc_yp - 2 * icc_ym)
+
+    xyShift += cp.asarray(
+        (np.stack((xSubShift + dx, ySubShift + dy), axis=1) - globalShift)
+        / upsampleFactor
+    )
 
     return xyShift
 
@@ -704,10 +855,14 @@ def dftUpsample(imageCorr, upsampleFactor, xyShift):
 def linear_interpolation_2D(ar, x, y):
     """
     Calculates the 2D linear interpolation of array ar at position x,y using the four
-    nearest array elements.
+    nearest array elements. x and y may be numbers or same-shaped arrays.
     """
-    x0, x1 = int(np.floor(x)), int(np.ceil(x))
-    y0, y1 = int(np.floor(y)), int(np.ceil(y))
+    if np.ndim(x) == 0:
+        x0, x1 = int(np.floor(x)), int(np.ceil(x))
+        y0, y1 = int(np.floor(y)), int(np.ceil(y))
+    else:
+        x0, x1 = np.floor(x).astype(int), np.ceil(x).astype(int)
+        y0, y1 = np.floor(y).astype(int), np.ceil(y).astype(int)
     dx = x - x0
     dy = y - y0
     return (
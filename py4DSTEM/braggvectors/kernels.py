@@ -95,3 +95,80 @@ void edge_boundary(bool *ar, const long long edgeBoundary,
 """
 
 kernels["edge_boundary"] = cp.RawKernel(edge_boundary, "edge_boundary")
+
+
+############################## hybrid_correlation ####################################
+
+"""
+Computes the hybrid correlation |m|**p * exp(i*angle(m)) = m * |m|**(p-1) of a complex
+array m in a single pass, in the precision of m. Zero valued elements map to zero for
+every p, including phase correlations (p=0), matching the CPU apply_correlation_power
+in process/utils/cross_correlate.
+Call as kernels["hybrid_correlation"](m, corrPower[, out]).
+"""
+
+hybrid_correlation = r"""
+T::value_type r = abs(m);
+out = (r > 0) ? m * pow(r, (T::value_type)(p - 1)) : T(0);
+"""
+
+kernels["hybrid_correlation"] = cp.ElementwiseKernel(
+    "T m, float32 p", "T out", hybrid_correlation, "hybrid_correlation"
+)
+
+
+############################## parabolic_subpix ######################################
+
+"""
+Subpixel refinement of N maxima at integer positions (xi,yi) of a float32 array ar, one
+thread per maximum. Fits 1D parabolas in x and y through each maximum and its two
+neighbors, discarding shifts larger than one pixel, then linearly interpolates ar at the
+shifted position. The shifts and intensities are written to dx, dy and I. Maxima on the
+edge of ar, which lack a neighbor to fit, are left unrefined, with zero shifts and their
+own intensity.
+"""
+
+parabolic_subpix_float32 = r"""
+extern "C" __global__
+void parabolic_subpix(const float *ar, const long long *xi, const long long *yi,
+                double *dx, double *dy, double *I, const long long sizex,
+                const long long sizey, const long long N){
+    int tid = blockDim.x * blockIdx.x + threadIdx.x;
+    if (tid < N) {
+        long long i = xi[tid] * sizey + yi[tid];
+        if (xi[tid] < 1 || xi[tid] >= sizex - 1 || yi[tid] < 1 || yi[tid] >= sizey - 1) {
+            dx[tid] = 0.0;
+            dy[tid] = 0.0;
+            I[tid] = ar[i];
+            return;
+        }
+        float Ix1_ = ar[i - sizey];
+        float Ix0 = ar[i];
+        float Ix1 = ar[i + sizey];
+        float Iy1_ = ar[i - 1];
+        float Iy1 = ar[i + 1];
+        float deltax = (Ix1 - Ix1_) / (4 * Ix0 - 2 * Ix1 - 2 * Ix1_);
+        float deltay = (Iy1 - Iy1_) / (4 * Ix0 - 2 * Iy1 - 2 * Iy1_);
+        double ddx = (fabsf(deltax) <= 1.0f) ? (double)deltax : 0.0;
+        double ddy = (fabsf(deltay) <= 1.0f) ? (double)deltay : 0.0;
+
+        // linear interpolation at the refined position
+        double x = xi[tid] + ddx;
+        double y = yi[tid] + ddy;
+        long long x0 = floor(x), x1 = ceil(x);
+        long long y0 = floor(y), y1 = ceil(y);
+        double fx = x - x0;
+        double fy = y - y0;
+        dx[tid] = ddx;
+        dy[tid] = ddy;
+        I[tid] = (1 - fx) * (1 - fy) * ar[x0 * sizey + y0]
+               + (1 - fx) * fy * ar[x0 * sizey + y1]
+               + fx * (1 - fy) * ar[x1 * sizey + y0]
+               + fx * fy * ar[x1 * sizey + y1];
+    }
+}
+"""
+
+kernels["parabolic_subpix_float32"] = cp.RawKernel(
+    parabolic_subpix_float32, "parabolic_subpix"
+)
@@ -730,6 +730,7 @@ class DataCube(
         maxNumPeaks=70,
         CUDA=False,
         CUDA_batched=True,
+        num_jobs=1,
         distributed=None,
         ML=False,
         ml_model_path=None,
@@ -851,6 +852,10 @@ class DataCube(
         CUDA_batched : bool
             If True, and CUDA is selected, the FFT and IFFT steps of disk detection
             are performed in batches to better utilize GPU resources.
+        num_jobs : int or None
+            For disk detection on the CPU, the number of worker processes to
+            distribute batches of diffraction patterns over. If None, uses all
+            CPU cores. Defaults to 1, i.e. serial processing.
         distributed : dict
             contains information for parallel processing using an IPyParallel or
             Dask distributed cluster.  Valid keys are:
@@ -910,6 +915,7 @@ class DataCube(
             maxNumPeaks=maxNumPeaks,
             CUDA=CUDA,
             CUDA_batched=CUDA_batched,
+            num_jobs=num_jobs,
             distributed=distributed,
             ML=ML,
             ml_model_path=ml_model_path,
@@ -2,7 +2,32 @@
 
 import h5py
 import numpy as np
-from py4DSTEM.io.legacy.read_utils import is_py4DSTEM_file
+from bisect import bisect_right
+from py4DSTEM.io.legacy.read_utils import (
+    is_py4DSTEM_file,
+    get_dataobject_listing,
+    get_dataobject_shape,
+)
+
+
+# Groups holding each type of dataobject, in the order they're indexed, and the
+# corresponding type names
+GROUP_NAMES = (
+    "datacubes",
+    "counted_datacubes",
+    "diffractionslices",
+    "realslices",
+    "pointlists",
+    "pointlistarrays",
+)
+TYPE_NAMES = (
+    "DataCube",
+    "CountedDataCube",
+    "DiffractionSlice",
+    "RealSlice",
+    "PointList",
+    "PointListArray",
+)
 
 
 def get_py4DSTEM_dataobject_info(fp, topgroup="4DSTEM_experiment"):
@@ -12,48 +37,16 @@ def get_py4DSTEM_dataobject_info(fp, topgroup="4DSTEM_experiment"):
     assert is_py4DSTEM_file(fp), "Error: not recognized as a py4DSTEM file"
     with h5py.File(fp, "r") as f:
         assert topgroup in f.keys(), "Error: unrecognized topgroup"
-    i = 0
-    l_md = []
+    names, Ns, group_paths = get_dataobject_listing(fp, topgroup, GROUP_NAMES)
+    info = np.zeros(
+        len(names),
+        dtype=[("index", int), ("type", "U16"), ("shape", tuple), ("name", "U64")],
+    )
     with h5py.File(fp, "r") as f:
-        grp_dc = f[topgroup + "/data/datacubes/"]
-        grp_ds = f[topgroup + "/data/diffractionslices/"]
-        grp_rs = f[topgroup + "/data/realslices/"]
-        grp_pl = f[topgroup + "/data/pointlists/"]
-        grp_pla = f[topgroup + "/data/pointlistarrays/"]
-        N = len(grp_dc) + len(grp_ds) + len(grp_rs) + len(grp_pl) + len(grp_pla)
-        info = np.zeros(
-            N,
-            dtype=[("index", int), ("type", "U16"), ("shape", tuple), ("name", "U64")],
-        )
-        for name in sorted(grp_dc.keys()):
-            shape = grp_dc[name + "/data/"].shape
-            dtype = "DataCube"
-            info[i] = i, dtype, shape, name
-            i += 1
-        for name in sorted(grp_ds.keys()):
-            shape = grp_ds[name + "/data/"].shape
-            dtype = "DiffractionSlice"
-            info[i] = i, dtype, shape, name
-            i += 1
-        for name in sorted(grp_rs.keys()):
-            shape = grp_rs[name + "/data/"].shape
-            dtype = "RealSlice"
-            info[i] = i, dtype, shape, name
-            i += 1
-        for name in sorted(grp_pl.keys()):
-            coordinates = list(grp_pl[name].keys())
-            length = grp_pl[name + "/" + coordinates[0] + "/data"].shape[0]
-            shape = (len(coordinates), length)
-            dtype = "PointList"
-            info[i] = i, dtype, shape, name
-            i += 1
-        for name in sorted(grp_pla.keys()):
-            ar = np.array(grp_pla[name + "/data"])
-            ar_shape = ar.shape
-            N_coords = len(ar[0, 0].dtype)
-            shape = (ar_shape[0], ar_shape[1], N_coords, -1)
-            dtype = "PointListArray"
+        for i, name in enumerate(names):
+            i_grp = bisect_right(Ns, i)
+            dtype = TYPE_NAMES[i_grp]
+            shape = get_dataobject_shape(f[group_paths[i_grp] + "/" + name], dtype)
             info[i] = i, dtype, shape, name
-            i += 1
 
     return info
@@ -2,14 +2,25 @@
 
 import h5py
 import numpy as np
+from bisect import bisect_right
 from os.path import splitext, exists
 from py4DSTEM.io.legacy.read_utils import (
     is_py4DSTEM_file,
     get_py4DSTEM_topgroups,
     get_py4DSTEM_version,
     version_is_geq,
+    open_py4DSTEM_file,
+    read_dataset,
+    READ_WORKERS,
+    memmap_dataset,
+    read_dim3_labels,
+    read_binned_datacube,
+    get_dataobject_listing,
+)
+from py4DSTEM.io.legacy.legacy12.read_utils_v0_12 import (
+    get_py4DSTEM_dataobject_info,
+    GROUP_NAMES,
 )
-from py4DSTEM.io.legacy.legacy12.read_utils_v0_12 import get_py4DSTEM_dataobject_info
 from emdfile import PointList, PointListArray
 from py4DSTEM.data import (
     DiffractionSlice,
@@ -149,134 +160,97 @@ def get_data(filepath, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
 def get_data_from_int(filepath, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
     """Accepts a filepath to a valid py4DSTEM file and an integer specifying data, and returns the data."""
     assert isinstance(data_id, (int, np.int_))
-    with h5py.File(filepath, "r") as f:
-        grp_dc = f[tg + "/data/datacubes/"]
-        grp_cdc = f[tg + "/data/counted_datacubes/"]
-        grp_ds = f[tg + "/data/diffractionslices/"]
-        grp_rs = f[tg + "/data/realslices/"]
-        grp_pl = f[tg + "/data/pointlists/"]
-        grp_pla = f[tg + "/data/pointlistarrays/"]
-        grp_coords = f[tg + "/data/coordinates/"]
-        grps = [grp_dc, grp_cdc, grp_ds, grp_rs, grp_pl, grp_pla, grp_coords]
-
-        Ns = np.cumsum([len(grp.keys()) for grp in grps])
-        i = np.nonzero(data_id < Ns)[0][0]
-        grp = grps[i]
-        N = data_id - Ns[i]
-        name = sorted(grp.keys())[N]
-
-        group_name = grp.name + "/" + name
-
-        if mem == "RAM":
-            grp_data = f[group_name]
-            data = get_data_from_grp(
-                grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
+    if mem == "RAM":
+        with open_py4DSTEM_file(filepath) as f:
+            return _get_data_from_int_open(
+                f, tg, data_id, mem=mem, binfactor=binfactor, bindtype=bindtype
             )
 
-    if mem == "MEMMAP":
-        f = h5py.File(filepath, "r")
-        grp_data = f[group_name]
-        data = get_data_from_grp(
-            grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
-        )
-    # ADDING STUFF IN HERE,
-    # I need to change datacube and counted datacube
-    elif mem == "DASK":
-        f = h5py.File(filepath, "r")
-        grp_data = f[group_name]
-        data = get_data_from_grp(
-            grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
-        )
+    # if using MEMMAP, file cannot be accessed from the context manager
+    # or else it will be closed before the data is accessed
+    f = open_py4DSTEM_file(filepath)
+    return _get_data_from_int_open(
+        f, tg, data_id, mem=mem, binfactor=binfactor, bindtype=bindtype
+    )
 
-    return data
+
+def _get_data_from_int_open(f, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
+    """Accepts an open py4DSTEM h5py File and an integer specifying data, and returns the data."""
+    names, Ns, group_paths = get_dataobject_listing(f.filename, tg, GROUP_NAMES)
+
+    i = bisect_right(Ns, data_id)
+    grp_data = f[group_paths[i] + "/" + names[data_id]]
+    return get_data_from_grp(grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype)
 
 
 def get_data_from_str(filepath, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
     """Accepts a filepath to a valid py4DSTEM file and a string specifying data, and returns the data."""
     assert isinstance(data_id, str)
-    with h5py.File(filepath, "r") as f:
-        grp_dc = f[tg + "/data/datacubes/"]
-        grp_cdc = f[tg + "/data/counted_datacubes/"]
-        grp_ds = f[tg + "/data/diffractionslices/"]
-        grp_rs = f[tg + "/data/realslices/"]
-        grp_pl = f[tg + "/data/pointlists/"]
-        grp_pla = f[tg + "/data/pointlistarrays/"]
-        grp_coords = f[tg + "/data/coordinates/"]
-        grps = [grp_dc, grp_cdc, grp_ds, grp_rs, grp_pl, grp_pla, grp_coords]
-
-        l_dc = list(grp_dc.keys())
-        l_cdc = list(grp_cdc.keys())
-        l_ds = list(grp_ds.keys())
-        l_rs = list(grp_rs.keys())
-        l_pl = list(grp_pl.keys())
-        l_pla = list(grp_pla.keys())
-        l_coords = list(grp_coords.keys())
-        names = l_dc + l_cdc + l_ds + l_rs + l_pl + l_pla + l_coords
-
-        inds = [i for i, name in enumerate(names) if name == data_id]
-        assert len(inds) != 0, "Error: no data named {} found.".format(data_id)
-        assert len(inds) < 2, "Error: multiple data blocks named {} found.".format(
-            data_id
-        )
-        ind = inds[0]
+    if mem == "RAM":
+        with open_py4DSTEM_file(filepath) as f:
+            return _get_data_from_str_open(
+                f, tg, data_id, mem=mem, binfactor=binfactor, bindtype=bindtype
+            )
 
-        Ns = np.cumsum([len(grp.keys()) for grp in grps])
-        i_grp = np.nonzero(ind < Ns)[0][0]
-        grp = grps[i_grp]
-        group_name = grp.name + "/" + data_id
+    # if using MEMMAP, file cannot be accessed from the context manager
+    # or else it will be closed before the data is accessed
+    f = open_py4DSTEM_file(filepath)
+    return _get_data_from_str_open(
+        f, tg, data_id, mem=mem, binfactor=binfactor, bindtype=bindtype
+    )
 
-        if mem == "RAM":
-            grp_data = f[group_name]
-            data = get_data_from_grp(
-                grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
-            )
 
-    if mem == "MEMMAP":
-        f = h5py.File(filepath, "r")
-        grp_data = f[group_name]
-        data = get_data_from_grp(
-            grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
-        )
-    elif mem == "DASK":
-        f = h5py.File(filepath, "r")
-        grp_data = f[group_name]
-        data = get_data_from_grp(
-            grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype
-        )
+def _get_data_from_str_open(f, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
+    """Accepts an open py4DSTEM h5py File and a string specifying data, and returns the data."""
+    names, Ns, group_paths = get_dataobject_listing(f.filename, tg, GROUP_NAMES)
 
-    return data
+    inds = [i for i, name in enumerate(names) if name == data_id]
+    assert len(inds) != 0, "Error: no data named {} found.".format(data_id)
+    assert len(inds) < 2, "Error: multiple data blocks named {} found.".format(data_id)
+    ind = inds[0]
+
+    i_grp = bisect_right(Ns, ind)
+    grp_data = f[group_paths[i_grp] + "/" + data_id]
+    return get_data_from_grp(grp_data, mem=mem, binfactor=binfactor, bindtype=bindtype)
 
 
 def get_data_from_list(filepath, tg, data_id, mem="RAM", binfactor=1, bindtype=None):
     """Accepts a filepath to a valid py4DSTEM file and a list or tuple specifying data, and returns the data."""
     assert isinstance(data_id, (list, tuple))
     assert all([isinstance(d, (int, np.int_, str)) for d in data_id])
-    data = []
-    for el in data_id:
-        if isinstance(el, (int, np.int_)):
-            data.append(
-                get_data_from_int(
-                    filepath,
-                    tg,
-                    data_id=el,
-                    mem=mem,
-                    binfactor=binfactor,
-                    bindtype=bindtype,
+    # open the file once for the whole list
+    f = open_py4DSTEM_file(filepath)
+    try:
+        data = []
+        for el in data_id:
+            if isinstance(el, (int, np.int_)):
+                data.append(
+                    _get_data_from_int_open(
+                        f,
+                        tg,
+                        data_id=el,
+                        mem=mem,
+                        binfactor=binfactor,
+                        bindtype=bindtype,
+                    )
                 )
-            )
-        elif isinstance(el, str):
-            data.append(
-                get_data_from_str(
-                    filepath,
-                    tg,
-                    data_id=el,
-                    mem=mem,
-                    binfactor=binfactor,
-                    bindtype=bindtype,
+            elif isinstance(el, str):
+                data.append(
+                    _get_data_from_str_open(
+                        f,
+                        tg,
+                        data_id=el,
+                        mem=mem,
+                        binfactor=binfactor,
+                        bindtype=bindtype,
+                    )
                 )
-            )
-        else:
-            raise Exception("Data must be specified with strings or integers only.")
+            else:
+                raise Exception("Data must be specified with strings or integers only.")
+    finally:
+        # if using MEMMAP, the file must stay open for the data to be accessed
+        if mem == "RAM":
+            f.close()
     return data
 
 
@@ -321,12 +295,15 @@ def print_py4DSTEM_file(filepath, tg):
 
     print("{:10}{:18}{:24}{:54}".format("Index", "Type", "Shape", "Name"))
     print("{:10}{:18}{:24}{:54}".format("-----", "----", "-----", "----"))
-    for el in info:
-        print(
-            "  {:8}{:18}{:24}{:54}".format(
+    if len(info) > 0:
+        # build the table as one string and write it in a single call
+        rows = [
+            "  {:8}{:18}{:24}{:54}\n".format(
                 str(el["index"]), str(el["type"]), str(el["shape"]), str(el["name"])
             )
-        )
+            for el in info
+        ]
+        print("".join(rows), end="")
     return
 
 
@@ -339,15 +316,20 @@ def get_datacube_from_grp(g, mem="RAM", binfactor=1, bindtype=None):
     """Accepts an h5py Group corresponding to a single datacube in an open, correctly formatted H5 file,
     and returns a DataCube.
     """
-    # TODO: add binning
-    assert binfactor == 1, "Bin on load is currently unsupported for EMD files."
-
     if (mem, binfactor) == ("RAM", 1):
-        stack_pointer = g["data"]
-        data = np.array(g["data"])
+        data = read_dataset(g["data"], max_workers=READ_WORKERS)
     elif (mem, binfactor) == ("MEMMAP", 1):
-        data = g["data"]
-        stack_pointer = None
+        # map contiguous datasets straight from disk, otherwise read lazily through h5py
+        data = memmap_dataset(g["data"])
+        if data is None:
+            data = g["data"]
+    elif mem == "RAM":
+        data = read_binned_datacube(g["data"], binfactor, dtype=bindtype)
+    else:
+        raise Exception(
+            "Memory mapping and on-load binning together is not supported.  Either set binfactor=1 or mem='RAM'."
+        )
+
     name = g.name.split("/")[-1]
     return DataCube(data=data, name=name)
 
@@ -356,17 +338,13 @@ def get_diffractionslice_from_grp(g):
     """Accepts an h5py Group corresponding to a diffractionslice in an open, correctly formatted H5 file,
     and returns a DiffractionSlice.
     """
-    data = np.array(g["data"])
+    data = read_dataset(g["data"])
     name = g.name.split("/")[-1]
     Q_Nx, Q_Ny = data.shape[:2]
     if len(data.shape) == 2:
         return DiffractionSlice(data=data, name=name)
     else:
-        lbls = g["dim3"]
-        if "S" in lbls.dtype.str:  # Checks if dim3 is composed of fixed width C strings
-            with lbls.astype("S64"):
-                lbls = lbls[:]
-            lbls = [lbl.decode("UTF-8") for lbl in lbls]
+        lbls = read_dim3_labels(g)
         return DiffractionSlice(data=data, name=name, slicelabels=lbls)
 
 
@@ -374,17 +352,13 @@ def get_realslice_from_grp(g):
     """Accepts an h5py Group corresponding to a realslice in an open, correctly formatted H5 file,
     and returns a RealSlice.
     """
-    data = np.array(g["data"])
+    data = read_dataset(g["data"])
     name = g.name.split("/")[-1]
     R_Nx, R_Ny = data.shape[:2]
     if len(data.shape) == 2:
         return RealSlice(data=data, name=name)
     else:
-        lbls = g["dim3"]
-        if "S" in lbls.dtype.str:  # Checks if dim3 is composed of fixed width C strings
-            with lbls.astype("S64"):
-                lbls = lbls[:]
-            lbls = [lbl.decode("UTF-8") for lbl in lbls]
+        lbls = read_dim3_labels(g)
         return RealSlice(data=data, name=name, slicelabels=lbls)
 
 
@@ -393,19 +367,18 @@ def get_pointlist_from_grp(g):
     and returns a PointList.
     """
     name = g.name.split("/")[-1]
-    coordinates = []
     coord_names = list(g.keys())
-    length = len(g[coord_names[0] + "/data"])
+    dsets = {coord: g[coord + "/data"] for coord in coord_names}
+    length = dsets[coord_names[0]].shape[0]
     if length == 0:
-        for coord in coord_names:
-            coordinates.append((coord, None))
+        coordinates = [(coord, None) for coord in coord_names]
     else:
-        for coord in coord_names:
-            dtype = type(g[coord + "/data"][0])
-            coordinates.append((coord, dtype))
+        coordinates = [
+            (coord, dsets[coord].dtype.newbyteorder("=")) for coord in coord_names
+        ]
     data = np.zeros(length, dtype=coordinates)
     for coord in coord_names:
-        data[coord] = np.array(g[coord + "/data"])
+        data[coord] = dsets[coord][...]
     return PointList(data=data, name=name)
 
 
@@ -418,11 +391,13 @@ def get_pointlistarray_from_grp(g):
     shape = dset.shape
     coordinates = h5py.check_vlen_dtype(dset.dtype)
     pla = PointListArray(dtype=coordinates, shape=shape, name=name)
+    # read all the cells at once, then distribute them in memory
+    cells = dset[...]
     for i, j in tqdmnd(
         shape[0], shape[1], desc="Reading PointListArray", unit="PointList"
     ):
         try:
-            pla.get_pointlist(i, j).data = dset[i, j]
+            pla.get_pointlist(i, j).data = cells[i, j]
         except ValueError:
             pass
     return pla
@@ -76,15 +76,19 @@ def v13_to_14(v13tree, v13cal):
 
 
 def _populate_tree(node13, node14, root14):
-    for key in node13.tree.keys():
-        newnode13 = node13.tree[key]
-        newnode14 = _v13_to_14_cls(newnode13)
-        # skip calibrations and metadata
-        if isinstance(newnode14, Metadata):
-            pass
-        else:
-            node14.tree(newnode14, force=True)
-        _populate_tree(newnode13, newnode14, root14)
+    # walk the tree with an explicit stack, so that deeply nested files
+    # don't exhaust the recursion limit
+    stack = [(node13, node14)]
+    while stack:
+        node13, node14 = stack.pop()
+        tree13 = node13.tree
+        for key in tree13.keys():
+            newnode13 = tree13[key]
+            newnode14 = _v13_to_14_cls(newnode13)
+            # skip calibrations and metadata
+            if not isinstance(newnode14, Metadata):
+                node14.tree(newnode14, force=True)
+            stack.append((newnode13, newnode14))
 
 
 def _v13_to_14_cls(obj):
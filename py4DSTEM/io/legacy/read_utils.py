@@ -2,6 +2,42 @@
 
 import h5py
 import numpy as np
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import product
+from os.path import getmtime
+
+# Cache sizes used when opening files for reading. The raw data chunk cache is
+# large enough to hold several multi-MB datacube chunks; nslots is prime, per the
+# HDF5 group's recommendation.
+RDCC_NBYTES = 256 * 1024**2
+RDCC_NSLOTS = 1048573
+MDC_NBYTES = 128 * 1024**2
+
+# Number of threads used to decompress datacube chunks
+READ_WORKERS = 4
+
+
+def open_py4DSTEM_file(filepath):
+    """Opens a py4DSTEM file read-only, with enlarged raw data chunk and metadata
+    caches, and returns the h5py File.
+    """
+    f = h5py.File(
+        filepath,
+        "r",
+        rdcc_nbytes=RDCC_NBYTES,
+        rdcc_nslots=RDCC_NSLOTS,
+        rdcc_w0=0.75,
+    )
+    config = f.id.get_mdc_config()
+    config.set_initial_size = True
+    config.initial_size = MDC_NBYTES
+    config.min_size = MDC_NBYTES
+    config.max_size = MDC_NBYTES
+    f.id.set_mdc_config(config)
+    return f
 
 
 def get_py4DSTEM_topgroups(filepath):
@@ -104,3 +140,175 @@ def get_N_dataobjects(filepath, topgroup="4DSTEM_experiment"):
             N_coords = 0
         N_do = N_dc + N_cdc + N_ds + N_rs + N_pl + N_pla + N_coords
         return N_dc, N_cdc, N_ds, N_rs, N_pl, N_pla, N_coords, N_do
+
+
+def read_dataset(dset, max_workers=1):
+    """Reads an h5py Dataset into a newly allocated numpy array, avoiding the
+    intermediate copy made by np.array(dset). Data is read directly into the output
+    in tiles along the first axis, sized to fit the raw data chunk cache.
+
+    If max_workers > 1 and the dataset is chunked and gzip compressed, chunks are
+    instead decompressed concurrently on up to max_workers threads (capped at the
+    number of CPUs). h5py serializes
+    all HDF5 calls, so only the raw chunk reads are made through h5py and the
+    decompression, which releases the GIL, is done with zlib.
+    """
+    data = np.empty(dset.shape, dtype=dset.dtype)
+    if dset.size == 0:
+        return data
+    max_workers = min(max_workers, os.cpu_count() or 1)
+    if max_workers > 1 and _is_gzip_only(dset):
+        _read_gzip_chunks(dset, data, max_workers)
+        return data
+    if dset.ndim == 0:
+        dset.read_direct(data)
+        return data
+    tile = get_tile_size(dset)
+    for i0 in range(0, dset.shape[0], tile):
+        i1 = min(i0 + tile, dset.shape[0])
+        dset.read_direct(data, np.s_[i0:i1], np.s_[i0:i1])
+    return data
+
+
+def _is_gzip_only(dset):
+    """Returns True if gzip is the only filter applied to the chunks of dset."""
+    if dset.chunks is None or dset.compression != "gzip":
+        return False
+    return dset.id.get_create_plist().get_nfilters() == 1
+
+
+def _read_gzip_chunks(dset, data, max_workers):
+    """Reads a chunked, gzip compressed h5py Dataset into data, decompressing the
+    chunks concurrently.
+    """
+    chunks = dset.chunks
+    offsets = list(product(*[range(0, n, c) for n, c in zip(dset.shape, chunks)]))
+
+    def read_chunk(offset):
+        sl = tuple(
+            slice(o, min(o + c, n)) for o, c, n in zip(offset, chunks, dset.shape)
+        )
+        try:
+            filter_mask, raw = dset.id.read_direct_chunk(offset)
+        except (KeyError, ValueError, OSError, RuntimeError):
+            # unallocated chunks hold the fill value; let HDF5 supply it
+            dset.read_direct(data, sl, sl)
+            return
+        if filter_mask & 1 == 0:
+            raw = zlib.decompress(raw)
+        chunk = np.frombuffer(raw, dtype=dset.dtype).reshape(chunks)
+        data[sl] = chunk[tuple(slice(0, s.stop - s.start) for s in sl)]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as executor:
+        list(executor.map(read_chunk, offsets))
+
+
+def memmap_dataset(dset):
+    """Returns a read-only numpy memmap onto an h5py Dataset, or None if the
+    dataset isn't stored contiguously and uncompressed in the file (in which
+    case its bytes can't be mapped directly).
+    """
+    if dset.chunks is not None or dset.compression is not None:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(
+        dset.file.filename,
+        mode="r",
+        dtype=dset.dtype,
+        shape=dset.shape,
+        offset=offset,
+    )
+
+
+def read_dim3_labels(g):
+    """Returns the slice labels stored in the 'dim3' dataset of a 3D DiffractionSlice
+    or RealSlice group, as a list. String labels are decoded in a single bulk read.
+    """
+    lbls = g["dim3"]
+    if h5py.check_string_dtype(lbls.dtype) is not None:
+        return list(lbls.asstr("utf-8")[...])
+    return list(lbls[...])
+
+
+def get_tile_size(dset, nbytes=RDCC_NBYTES):
+    """Returns the number of leading-axis slices of an h5py Dataset which fit in
+    nbytes, so that tiled reads line up with the raw data chunk cache.
+    """
+    slice_nbytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+    return int(np.clip(nbytes // max(slice_nbytes, 1), 1, max(dset.shape[0], 1)))
+
+
+def read_binned_datacube(dset, binfactor, dtype=None):
+    """Reads a 4D datacube from an h5py Dataset, binning it in diffraction space by
+    binfactor as it's read. Data is read in tiles of scan rows, so that the full
+    sized datacube is never held in memory. Diffraction space edges which don't
+    divide evenly by binfactor are cropped. The binned sums are cast to dtype, which
+    defaults to the raw data's dtype, so integer sums which overflow it wrap around;
+    pass a wider dtype to avoid this.
+    """
+    if dtype is None:
+        dtype = dset.dtype
+    R_Nx, R_Ny, Q_Nx, Q_Ny = dset.shape
+    Q_Nx_bin, Q_Ny_bin = Q_Nx // binfactor, Q_Ny // binfactor
+    data = np.empty((R_Nx, R_Ny, Q_Nx_bin, Q_Ny_bin), dtype=dtype)
+
+    tile = get_tile_size(dset)
+    buf = np.empty((tile, R_Ny, Q_Nx, Q_Ny), dtype=dset.dtype)
+    for rx0 in range(0, R_Nx, tile):
+        rx1 = min(rx0 + tile, R_Nx)
+        tile_buf = buf[: rx1 - rx0]
+        dset.read_direct(tile_buf, np.s_[rx0:rx1])
+        data[rx0:rx1] = (
+            tile_buf[:, :, : Q_Nx_bin * binfactor, : Q_Ny_bin * binfactor]
+            .reshape(rx1 - rx0, R_Ny, Q_Nx_bin, binfactor, Q_Ny_bin, binfactor)
+            .sum(axis=(3, 5))
+            .astype(dtype)
+        )
+    return data
+
+
+def get_dataobject_listing(filepath, topgroup, group_names):
+    """Returns a listing of the dataobjects in a py4DSTEM file as a 3-tuple
+    (names, Ns, group_paths). names holds the sorted names of the dataobjects in
+    each of the groups topgroup/data/<group_name>, in turn, so that names[i] is the
+    dataobject with index i; Ns[i] is the total number of dataobjects in groups 0
+    through i; and group_paths[i] is the path to group i.
+
+    Listings are cached by filepath and modification time, so that repeated reads
+    from the same file don't re-walk its groups.
+    """
+    return _get_dataobject_listing(
+        str(filepath), topgroup, tuple(group_names), getmtime(filepath)
+    )
+
+
+@lru_cache(maxsize=32)
+def _get_dataobject_listing(filepath, topgroup, group_names, mtime):
+    group_paths = tuple(topgroup + "/data/" + name for name in group_names)
+    names = []
+    Ns = []
+    with h5py.File(filepath, "r") as f:
+        for group_path in group_paths:
+            names.extend(sorted(f[group_path].keys()))
+            Ns.append(len(names))
+    return tuple(names), tuple(Ns), group_paths
+
+
+def get_dataobject_shape(g, type_name):
+    """Returns the shape to report for the dataobject stored in h5py Group g, whose
+    type is type_name.
+    """
+    if type_name == "PointList":
+        coordinates = list(g.keys())
+        length = g[coordinates[0] + "/data"].shape[0]
+        return (len(coordinates), length)
+    elif type_name == "PointListArray":
+        ar_shape = g["data"].shape
+        N_coords = len(h5py.check_vlen_dtype(g["data"].dtype))
+        return (ar_shape[0], ar_shape[1], N_coords, -1)
+    elif type_name == "Coordinates":
+        return 0  # TODO?
+    else:
+        return g["data"].shape
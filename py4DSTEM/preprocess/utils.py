@@ -1,13 +1,25 @@
 # Preprocessing utility functions
 
+from bisect import bisect_left
+from functools import lru_cache
+
 import numpy as np
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import correlate1d
 
 try:
     import cupy as cp
 except (ModuleNotFoundError, ImportError):
     cp = np
 
+try:
+    import numba as nb
+except (ModuleNotFoundError, ImportError):
+    nb = None
+
+# Above this many maxima, get_spaced_maxima_mask switches from a pairwise
+# distance matrix to a grid of cells
+SPACED_MAXIMA_MATRIX_MAX = 256
+
 
 def bin2D(array, factor, dtype=np.float64):
     """
@@ -120,6 +132,43 @@ def get_shifted_ar(ar, xshift, yshift, periodic=True, bilinear=False, device="cp
     return shifted_ar
 
 
+@lru_cache(maxsize=32)
+def get_gaussian_kernel_1D(sigma, truncate=4.0):
+    """
+    Returns the (read-only) normalized 1D gaussian kernel with standard
+    deviation `sigma`, truncated at `truncate` standard deviations, as used
+    by scipy.ndimage.gaussian_filter. Kernels are cached, so repeated calls
+    with the same sigma do not recompute them.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / (sigma * sigma) * x**2)
+    kernel = kernel / kernel.sum()
+    kernel.setflags(write=False)
+    return kernel
+
+
+def gaussian_filter_2D(ar, sigma, output=None):
+    """
+    Applies a gaussian filter with standard deviation `sigma` along the last
+    two axes of `ar`, i.e. to each 2D slice of a stack independently, as two
+    separable 1D passes with a cached kernel. Equivalent to
+    scipy.ndimage.gaussian_filter(ar, (0,...,0,sigma,sigma)).
+
+    Args:
+        ar (array): a 2D array or stack of 2D arrays
+        sigma (float): the gaussian standard deviation, in pixels
+        output (array or None): if not None, the result is written here;
+            this may be `ar` itself
+
+    Returns:
+        (array) the filtered array
+    """
+    kernel = get_gaussian_kernel_1D(float(sigma))
+    output = correlate1d(ar, kernel, axis=-2, output=output, mode="reflect")
+    return correlate1d(output, kernel, axis=-1, output=output, mode="reflect")
+
+
 def get_maxima_2D(
     ar,
     subpixel="poly",
@@ -163,73 +212,82 @@ def get_maxima_2D(
     assert subpixel in subpixel_modes, er
 
     # gaussian filtering
-    ar = ar if sigma <= 0 else gaussian_filter(ar, sigma)
-
-    # local pixelwise maxima
-    maxima_bool = (
-        (ar >= np.roll(ar, (-1, 0), axis=(0, 1)))
-        & (ar > np.roll(ar, (1, 0), axis=(0, 1)))
-        & (ar >= np.roll(ar, (0, -1), axis=(0, 1)))
-        & (ar > np.roll(ar, (0, 1), axis=(0, 1)))
-        & (ar >= np.roll(ar, (-1, -1), axis=(0, 1)))
-        & (ar > np.roll(ar, (-1, 1), axis=(0, 1)))
-        & (ar >= np.roll(ar, (1, -1), axis=(0, 1)))
-        & (ar > np.roll(ar, (1, 1), axis=(0, 1)))
-    )
+    ar = ar if sigma <= 0 else gaussian_filter_2D(ar, sigma)
 
     # remove edges
     assert isinstance(edgeBoundary, (int, np.integer))
     if edgeBoundary < 1:
         edgeBoundary = 1
-    maxima_bool[:edgeBoundary, :] = False
-    maxima_bool[-edgeBoundary:, :] = False
-    maxima_bool[:, :edgeBoundary] = False
-    maxima_bool[:, -edgeBoundary:] = False
 
-    # get indices
-    # sort by intensity
-    maxima_x, maxima_y = np.nonzero(maxima_bool)
-    dtype = np.dtype([("x", float), ("y", float), ("intensity", float)])
-    maxima = np.zeros(len(maxima_x), dtype=dtype)
-    maxima["x"] = maxima_x
-    maxima["y"] = maxima_y
-    maxima["intensity"] = ar[maxima_x, maxima_y]
-    maxima = np.sort(maxima, order="intensity")[::-1]
+    # local pixelwise maxima, compared against the 8 neighbors of each
+    # pixel away from the edges using shifted views of the array
+    e = edgeBoundary
+    nx, ny = ar.shape
+    if nx <= 2 * e or ny <= 2 * e:
+        maxima_bool = np.zeros((0, 0), dtype=bool)
+    else:
 
-    if len(maxima) == 0:
-        return maxima
+        def shifted(dx, dy):
+            return ar[e + dx : nx - e + dx, e + dy : ny - e + dy]
+
+        center = shifted(0, 0)
+        maxima_bool = center >= shifted(1, 0)
+        maxima_bool &= center > shifted(-1, 0)
+        maxima_bool &= center >= shifted(0, 1)
+        maxima_bool &= center > shifted(0, -1)
+        maxima_bool &= center >= shifted(1, 1)
+        maxima_bool &= center > shifted(1, -1)
+        maxima_bool &= center >= shifted(-1, 1)
+        maxima_bool &= center > shifted(-1, -1)
+
+    # get indices and intensities as separate columns, sorted by decreasing
+    # intensity, with ties broken by decreasing x then y
+    maxima_x, maxima_y = np.nonzero(maxima_bool)
+    maxima_x += e
+    maxima_y += e
+    maxima_intensity = ar[maxima_x, maxima_y].astype(np.float64)
+    order = np.lexsort((maxima_y, maxima_x, maxima_intensity))[::-1]
+    maxima_x = maxima_x[order]
+    maxima_y = maxima_y[order]
+    maxima_intensity = maxima_intensity[order]
 
     # filter
-    maxima = filter_2D_maxima(
-        maxima,
-        minAbsoluteIntensity=minAbsoluteIntensity,
-        minRelativeIntensity=minRelativeIntensity,
-        relativeToPeak=relativeToPeak,
-        minSpacing=minSpacing,
-        edgeBoundary=edgeBoundary,
-        maxNumPeaks=maxNumPeaks,
-    )
-
-    if subpixel == "pixel":
-        return maxima
-
-    # Parabolic subpixel refinement
-    for i in range(len(maxima)):
-        Ix1_ = ar[int(maxima["x"][i]) - 1, int(maxima["y"][i])].astype(np.float64)
-        Ix0 = ar[int(maxima["x"][i]), int(maxima["y"][i])].astype(np.float64)
-        Ix1 = ar[int(maxima["x"][i]) + 1, int(maxima["y"][i])].astype(np.float64)
-        Iy1_ = ar[int(maxima["x"][i]), int(maxima["y"][i]) - 1].astype(np.float64)
-        Iy0 = ar[int(maxima["x"][i]), int(maxima["y"][i])].astype(np.float64)
-        Iy1 = ar[int(maxima["x"][i]), int(maxima["y"][i]) + 1].astype(np.float64)
-        deltax = (Ix1 - Ix1_) / (4 * Ix0 - 2 * Ix1 - 2 * Ix1_)
-        deltay = (Iy1 - Iy1_) / (4 * Iy0 - 2 * Iy1 - 2 * Iy1_)
-        maxima["x"][i] += deltax
-        maxima["y"][i] += deltay
-        maxima["intensity"][i] = linear_interpolation_2D(
-            ar, maxima["x"][i], maxima["y"][i]
+    if len(order) > 0:
+        inds = _get_filtered_maxima_inds(
+            maxima_x,
+            maxima_y,
+            maxima_intensity,
+            minAbsoluteIntensity=minAbsoluteIntensity,
+            minRelativeIntensity=minRelativeIntensity,
+            relativeToPeak=relativeToPeak,
+            minSpacing=minSpacing,
+            maxNumPeaks=maxNumPeaks,
+            _sorted=True,
         )
+        maxima_x = maxima_x[inds]
+        maxima_y = maxima_y[inds]
+        maxima_intensity = maxima_intensity[inds]
+
+    # Parabolic subpixel refinement, for all maxima at once
+    if subpixel != "pixel" and len(maxima_x) > 0:
+        x, y = maxima_x, maxima_y
+        Ix1_ = ar[x - 1, y].astype(np.float64)
+        I0 = maxima_intensity
+        Ix1 = ar[x + 1, y].astype(np.float64)
+        Iy1_ = ar[x, y - 1].astype(np.float64)
+        Iy1 = ar[x, y + 1].astype(np.float64)
+        maxima_x = x + (Ix1 - Ix1_) / (4 * I0 - 2 * Ix1 - 2 * Ix1_)
+        maxima_y = y + (Iy1 - Iy1_) / (4 * I0 - 2 * Iy1 - 2 * Iy1_)
+        maxima_intensity = linear_interpolation_2D(ar, maxima_x, maxima_y)
+
+    # pack the columns into a structured array
+    dtype = np.dtype([("x", float), ("y", float), ("intensity", float)])
+    maxima = np.empty(len(maxima_x), dtype=dtype)
+    maxima["x"] = maxima_x
+    maxima["y"] = maxima_y
+    maxima["intensity"] = maxima_intensity
 
-    if subpixel == "poly":
+    if subpixel != "multicorr":
         return maxima
 
     # Fourier upsampling
@@ -258,6 +316,7 @@ def filter_2D_maxima(
     minSpacing=0,
     edgeBoundary=1,
     maxNumPeaks=1,
+    _sorted=False,
 ):
     """
     Args:
@@ -270,53 +329,213 @@ def filter_2D_maxima(
             another, delete the less intense of the two
         edgeBoundary : delete peaks within this distance of the image edge
         maxNumPeaks : an integer. defaults to 1
+        _sorted : if True, `maxima` must already be sorted by decreasing
+            intensity, and the intensity thresholds are applied by truncating
+            at a cutoff found with a binary search
 
     Returns:
         a numpy structured array with fields 'x', 'y', 'intensity'
     """
 
+    inds = _get_filtered_maxima_inds(
+        maxima["x"],
+        maxima["y"],
+        maxima["intensity"],
+        minAbsoluteIntensity=minAbsoluteIntensity,
+        minRelativeIntensity=minRelativeIntensity,
+        relativeToPeak=relativeToPeak,
+        minSpacing=minSpacing,
+        maxNumPeaks=maxNumPeaks,
+        _sorted=_sorted,
+    )
+    return maxima[inds]
+
+
+def _get_filtered_maxima_inds(
+    x,
+    y,
+    intensity,
+    minAbsoluteIntensity=0,
+    minRelativeIntensity=0,
+    relativeToPeak=0,
+    minSpacing=0,
+    maxNumPeaks=1,
+    _sorted=False,
+):
+    """
+    Applies the filters of `filter_2D_maxima` to maxima stored as separate
+    `x`, `y`, and `intensity` columns, so that each filter only reads the
+    columns it needs. Returns the indices of the maxima to keep, in order.
+    """
+    inds = np.arange(len(intensity))
+
     # Remove maxima which are too dim
     if minAbsoluteIntensity > 0:
-        deletemask = maxima["intensity"] < minAbsoluteIntensity
-        maxima = maxima[~deletemask]
+        if _sorted:
+            cutoff = bisect_left(
+                intensity,
+                True,
+                hi=len(inds),
+                key=lambda I: I < minAbsoluteIntensity,
+            )
+            inds = inds[:cutoff]
+        else:
+            deletemask = intensity[inds] < minAbsoluteIntensity
+            inds = inds[~deletemask]
 
     # Remove maxima which are too dim, compared to the n-th brightest
-    if (minRelativeIntensity > 0) & (len(maxima) > relativeToPeak):
+    if (minRelativeIntensity > 0) & (len(inds) > relativeToPeak):
         assert isinstance(relativeToPeak, (int, np.integer))
-        deletemask = (
-            maxima["intensity"] / maxima["intensity"][relativeToPeak]
-            < minRelativeIntensity
-        )
-        maxima = maxima[~deletemask]
+        reference = intensity[inds[relativeToPeak]]
+        if _sorted and reference > 0:
+            cutoff = bisect_left(
+                intensity,
+                True,
+                hi=len(inds),
+                key=lambda I: I / reference < minRelativeIntensity,
+            )
+            inds = inds[:cutoff]
+        else:
+            deletemask = intensity[inds] / reference < minRelativeIntensity
+            inds = inds[~deletemask]
 
     # Remove maxima which are too close
     if minSpacing > 0:
-        deletemask = np.zeros(len(maxima), dtype=bool)
-        for i in range(len(maxima)):
-            if deletemask[i] == False:  # noqa: E712
-                tooClose = (
-                    (maxima["x"] - maxima["x"][i]) ** 2
-                    + (maxima["y"] - maxima["y"][i]) ** 2
-                ) < minSpacing**2
-                tooClose[: i + 1] = False
-                deletemask[tooClose] = True
-        maxima = maxima[~deletemask]
+        keepmask = get_spaced_maxima_mask(
+            x[inds], y[inds], minSpacing, maxNumPeaks=maxNumPeaks
+        )
+        inds = inds[keepmask]
 
     # Remove maxima in excess of maxNumPeaks
     if maxNumPeaks is not None:
-        if len(maxima) > maxNumPeaks:
-            maxima = maxima[:maxNumPeaks]
+        inds = inds[:maxNumPeaks]
 
-    return maxima
+    return inds
+
+
+def get_spaced_maxima_mask(x, y, minSpacing, maxNumPeaks=None):
+    """
+    Walks through the maxima at positions (x,y), which must be sorted by
+    decreasing intensity, and keeps each one that is not within `minSpacing`
+    of an already kept maximum. For up to SPACED_MAXIMA_MATRIX_MAX maxima,
+    all pairwise distances are tested at once; beyond that, kept maxima are
+    binned into a grid of `minSpacing`-sized cells, so that each maximum is
+    only compared against those in its own and the 8 neighboring cells.
+    If numba is installed, a compiled loop is used instead.
+
+    Args:
+        x,y (1D arrays): the maxima positions
+        minSpacing (number): the minimum allowed spacing between maxima
+        maxNumPeaks (int or None): if not None, stops once this many maxima
+            have been kept, discarding all the rest
+
+    Returns:
+        (bool array) True for the maxima to keep
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    minSpacing2 = minSpacing**2
+
+    # with numba, a compiled walk over the kept maxima
+    if nb is not None:
+        return _get_spaced_maxima_mask_loop(
+            np.ascontiguousarray(x, dtype=np.float64),
+            np.ascontiguousarray(y, dtype=np.float64),
+            float(minSpacing2),
+            -1 if maxNumPeaks is None else int(maxNumPeaks),
+        )
+
+    # few maxima: vectorized upper-triangular distance test
+    if len(x) <= SPACED_MAXIMA_MATRIX_MAX:
+        tooClose = (x[:, None] - x[None, :]) ** 2 + (
+            y[:, None] - y[None, :]
+        ) ** 2 < minSpacing2
+        keepmask = np.ones(len(x), dtype=bool)
+        N = 0
+        for i in range(len(x)):
+            if keepmask[i]:
+                N += 1
+                if maxNumPeaks is not None and N >= maxNumPeaks:
+                    keepmask[i + 1 :] = False
+                    break
+                keepmask[i + 1 :] &= ~tooClose[i, i + 1 :]
+        return keepmask
+
+    # many maxima: grid of cells
+    keepmask = np.zeros(len(x), dtype=bool)
+    cells_x = np.floor(x / minSpacing).astype(int).tolist()
+    cells_y = np.floor(y / minSpacing).astype(int).tolist()
+    x, y = x.tolist(), y.tolist()
+    grid = {}
+    N = 0
+    for i in range(len(x)):
+        if maxNumPeaks is not None and N >= maxNumPeaks:
+            break
+        xi, yi, cx, cy = x[i], y[i], cells_x[i], cells_y[i]
+        tooClose = any(
+            (x[j] - xi) ** 2 + (y[j] - yi) ** 2 < minSpacing2
+            for c in (
+                (cx - 1, cy - 1),
+                (cx - 1, cy),
+                (cx - 1, cy + 1),
+                (cx, cy - 1),
+                (cx, cy),
+                (cx, cy + 1),
+                (cx + 1, cy - 1),
+                (cx + 1, cy),
+                (cx + 1, cy + 1),
+            )
+            for j in grid.get(c, ())
+        )
+        if not tooClose:
+            keepmask[i] = True
+            grid.setdefault((cx, cy), []).append(i)
+            N += 1
+    return keepmask
+
+
+def _get_spaced_maxima_mask_loop(x, y, minSpacing2, maxNumPeaks):
+    """
+    Loop implementation of get_spaced_maxima_mask, comparing each maximum
+    against all those already kept. Compiled with numba when available.
+    `maxNumPeaks` is -1 for no limit.
+    """
+    N = x.shape[0]
+    keepmask = np.zeros(N, dtype=np.bool_)
+    kept = np.empty(N, dtype=np.int64)
+    K = 0
+    for i in range(N):
+        if maxNumPeaks >= 0 and K >= maxNumPeaks:
+            break
+        tooClose = False
+        for k in range(K):
+            j = kept[k]
+            if (x[j] - x[i]) ** 2 + (y[j] - y[i]) ** 2 < minSpacing2:
+                tooClose = True
+                break
+        if not tooClose:
+            keepmask[i] = True
+            kept[K] = i
+            K += 1
+    return keepmask
+
+
+if nb is not None:
+    _get_spaced_maxima_mask_loop = nb.njit(cache=True, nogil=True)(
+        _get_spaced_maxima_mask_loop
+    )
 
 
 def linear_interpolation_2D(ar, x, y):
     """
     Calculates the 2D linear interpolation of array ar at position x,y using the four
-    nearest array elements.
+    nearest array elements. x and y may be numbers or same-shaped arrays.
     """
-    x0, x1 = int(np.floor(x)), int(np.ceil(x))
-    y0, y1 = int(np.floor(y)), int(np.ceil(y))
+    if np.ndim(x) == 0:
+        x0, x1 = int(np.floor(x)), int(np.ceil(x))
+        y0, y1 = int(np.floor(y)), int(np.ceil(y))
+    else:
+        x0, x1 = np.floor(x).astype(int), np.ceil(x).astype(int)
+        y0, y1 = np.floor(y).astype(int), np.ceil(y).astype(int)
     dx = x - x0
     dy = y - y0
     return (
@@ -1,19 +1,76 @@
 # Functions for creating flowline maps from diffraction spots
 
+import functools
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
-from scipy.ndimage import gaussian_filter1d
+from scipy import fft as sp_fft
+from scipy.ndimage import correlate1d
 from scipy.optimize import curve_fit
+from scipy.sparse import csr_matrix
 
 from matplotlib.colors import hsv_to_rgb
-from matplotlib.colors import rgb_to_hsv
 from matplotlib.colors import ListedColormap
 
 from emdfile import tqdmnd, PointList, PointListArray
 
+from py4DSTEM.preprocess.utils import get_gaussian_kernel_1D
+
+try:
+    import numba as nb
+
+    _prange = nb.prange
+except (ModuleNotFoundError, ImportError):
+    nb = None
+    _prange = range
+
+try:
+    import cupy as cp
+    import cupyx
+    from cupyx.scipy.ndimage import correlate1d as cp_correlate1d
+except (ModuleNotFoundError, ImportError):
+    cp = None
+
+# theta smoothing kernels longer than this are applied with FFTs
+THETA_FFT_KERNEL_SIZE = 32
+
+# approximate working set (in bytes) of each batch of ring pair correlations,
+# about half of a typical L3 cache
+CORRELATION_CHUNK_BYTES = 8 * 2**20
+
+
+def _make_orient_cmap():
+    """
+    Custom divergent colormap for plot_orientation_correlation, running from
+    dark blue, light blue, white, red to dark red.
+    """
+    N = 256
+    cvals = np.zeros((N, 4))
+    cvals[:, 3] = 1
+    c = np.linspace(0.0, 1.0, int(N / 4))
+
+    cvals[0 : int(N / 4), 1] = c * 0.4 + 0.3
+    cvals[0 : int(N / 4), 2] = 1
+
+    cvals[int(N / 4) : int(N / 2), 0] = c
+    cvals[int(N / 4) : int(N / 2), 1] = c * 0.3 + 0.7
+    cvals[int(N / 4) : int(N / 2), 2] = 1
+
+    cvals[int(N / 2) : int(N * 3 / 4), 0] = 1
+    cvals[int(N / 2) : int(N * 3 / 4), 1] = 1 - c
+    cvals[int(N / 2) : int(N * 3 / 4), 2] = 1 - c
+
+    cvals[int(N * 3 / 4) : N, 0] = 1 - 0.5 * c
+    return ListedColormap(cvals)
+
+
+_ORIENT_CMAP = _make_orient_cmap()
+
 
 def make_orientation_histogram(
     bragg_peaks=None,
@@ -31,6 +88,8 @@ def make_orientation_histogram(
     normalize_intensity_image: bool = False,
     normalize_intensity_stack: bool = True,
     progress_bar: bool = True,
+    device: str = "cpu",
+    dtype: np.dtype = np.float32,
 ):
     """
     Create an 3D or 4D orientation histogram from a braggpeaks PointListArray
@@ -52,6 +111,10 @@ def make_orientation_histogram(
         normalize_intensity_image (bool):   Normalize to max peak intensity = 1, per image
         normalize_intensity_stack (bool):   Normalize to max peak intensity = 1, all images
         progress_bar (bool):                Enable progress bar
+        device (str):                       'cpu' or 'gpu'. On 'gpu', Bragg peaks are accumulated
+                                            and smoothed with cupy. The result is returned on the cpu.
+        dtype (np.dtype):                   Data type of the histogram. make_flowline_map keeps
+                                            this type for the flowline arrays.
 
     Returns:
         orient_hist (array):                4D array containing Bragg peak intensity histogram
@@ -86,178 +149,133 @@ def make_orientation_histogram(
     ).astype("int")
 
     # output init
-    orient_hist = np.zeros([num_radii, size_output[0], size_output[1], num_theta_bins])
-
-    # Loop over all probe positions
-    for a0 in range(num_radii):
-        t = "Generating histogram " + str(a0)
-        # for rx, ry in tqdmnd(
-        #         *bragg_peaks.shape, desc=t,unit=" probe positions", disable=not progress_bar
-        #     ):
-        for rx, ry in tqdmnd(
-            *size_input, desc=t, unit=" probe positions", disable=not progress_bar
-        ):
-            x = (rx + 0.5) * upsample_factor - 0.5
-            y = (ry + 0.5) * upsample_factor - 0.5
-            x = np.clip(x, 0, size_output[0] - 2)
-            y = np.clip(y, 0, size_output[1] - 2)
+    orient_hist = np.zeros(
+        [num_radii, size_output[0], size_output[1], num_theta_bins], dtype=dtype
+    )
 
-            xF = np.floor(x).astype("int")
-            yF = np.floor(y).astype("int")
-            dx = x - xF
-            dy = y - yF
+    # bilinear interpolation coordinates of each probe row and column
+    x = np.clip(
+        (np.arange(size_input[0]) + 0.5) * upsample_factor - 0.5,
+        0,
+        size_output[0] - 2,
+    )
+    y = np.clip(
+        (np.arange(size_input[1]) + 0.5) * upsample_factor - 0.5,
+        0,
+        size_output[1] - 2,
+    )
+    xF = np.floor(x).astype("int")
+    yF = np.floor(y).astype("int")
+    dx = x - xF
+    dy = y - yF
 
-            add_data = False
+    if device == "gpu":
+        assert cp is not None, "device='gpu' requires cupy"
+
+    if orientation_map is None and device == "gpu":
+        # scatter all peaks into the histogram on the gpu
+        orient_hist = _make_orientation_histogram_gpu(
+            *_get_bragg_peaks_csr(bragg_peaks, size_input),
+            xF,
+            dx,
+            yF,
+            dy,
+            radial_ranges_2,
+            dtheta,
+            orient_hist.shape,
+            orient_hist.dtype,
+        )
+    elif orientation_map is None and nb is not None:
+        # compiled loop over all probe positions and radial bins
+        qx, qy, intensity, offsets = _get_bragg_peaks_csr(bragg_peaks, size_input)
+        _make_orientation_histogram_loop(
+            qx,
+            qy,
+            intensity,
+            offsets,
+            xF,
+            dx,
+            yF,
+            dy,
+            radial_ranges_2,
+            dtheta,
+            orient_hist,
+        )
+    else:
+        if orientation_map is None:
+            # gather all Bragg peaks once, and compute their radial bin masks
+            # and angles
+            qx, qy, intensity_all, offsets = _get_bragg_peaks_csr(
+                bragg_peaks, size_input
+            )
+            r2_all = qx**2 + qy**2
+            sub_all = np.logical_and(
+                r2_all[None, :] >= radial_ranges_2[:, 0, None],
+                r2_all[None, :] < radial_ranges_2[:, 1, None],
+            )
+            t_all = np.arctan2(qy, qx) / dtheta
+        else:
+            # orientation angles of all probes, and the radial bin of each
+            # growth angle
+            angles = (
+                orientation_map.angles[:, :, orientation_ind, 0]
+                + orientation_map.angles[:, :, orientation_ind, 2]
+            )
+            if orientation_flip_sign:
+                angles = -angles
+            t_all = angles / dtheta
+            corr = orientation_map.corr[:, :, orientation_ind]
+            if orientation_separate_bins is False:
+                radial_inds = np.zeros(num_angles, dtype="int")
+            else:
+                radial_inds = np.arange(num_angles)
 
+        # Loop over all probe positions, accumulating into all radial bins
+        for rx, ry in tqdmnd(
+            *size_input,
+            desc="Generating histogram",
+            unit=" probe positions",
+            disable=not progress_bar,
+        ):
             if orientation_map is None:
-                p = bragg_peaks.cal[rx, ry]
-                r2 = p.data["qx"] ** 2 + p.data["qy"] ** 2
-                sub = np.logical_and(
-                    r2 >= radial_ranges_2[a0, 0], r2 < radial_ranges_2[a0, 1]
-                )
-                if np.any(sub):
-                    add_data = True
-                    intensity = p.data["intensity"][sub]
-                    t = np.arctan2(p.data["qy"][sub], p.data["qx"][sub]) / dtheta
+                i = rx * size_input[1] + ry
+                peaks = slice(offsets[i], offsets[i + 1])
+                radial_inds, inds_peaks = np.nonzero(sub_all[:, peaks])
+                if len(inds_peaks) == 0:
+                    continue
+                intensity = intensity_all[peaks][inds_peaks]
+                t = t_all[peaks][inds_peaks]
             else:
-                if orientation_map.corr[rx, ry, orientation_ind] > 0:
-                    if orientation_separate_bins is False:
-                        if orientation_flip_sign:
-                            t = (
-                                np.array(
-                                    [
-                                        (
-                                            -orientation_map.angles[
-                                                rx, ry, orientation_ind, 0
-                                            ]
-                                            - orientation_map.angles[
-                                                rx, ry, orientation_ind, 2
-                                            ]
-                                        )
-                                        / dtheta
-                                    ]
-                                )
-                                + orientation_growth_angles
-                            )
-                        else:
-                            t = (
-                                np.array(
-                                    [
-                                        (
-                                            orientation_map.angles[
-                                                rx, ry, orientation_ind, 0
-                                            ]
-                                            + orientation_map.angles[
-                                                rx, ry, orientation_ind, 2
-                                            ]
-                                        )
-                                        / dtheta
-                                    ]
-                                )
-                                + orientation_growth_angles
-                            )
-                        intensity = (
-                            np.ones(num_angles)
-                            * orientation_map.corr[rx, ry, orientation_ind]
-                        )
-                        add_data = True
-                    else:
-                        if orientation_flip_sign:
-                            t = (
-                                np.array(
-                                    [
-                                        (
-                                            -orientation_map.angles[
-                                                rx, ry, orientation_ind, 0
-                                            ]
-                                            - orientation_map.angles[
-                                                rx, ry, orientation_ind, 2
-                                            ]
-                                        )
-                                        / dtheta
-                                    ]
-                                )
-                                + orientation_growth_angles[a0]
-                            )
-                        else:
-                            t = (
-                                np.array(
-                                    [
-                                        (
-                                            orientation_map.angles[
-                                                rx, ry, orientation_ind, 0
-                                            ]
-                                            + orientation_map.angles[
-                                                rx, ry, orientation_ind, 2
-                                            ]
-                                        )
-                                        / dtheta
-                                    ]
-                                )
-                                + orientation_growth_angles[a0]
-                            )
-                        intensity = orientation_map.corr[rx, ry, orientation_ind]
-                        add_data = True
-
-            if add_data:
-                tF = np.floor(t).astype("int")
-                dt = t - tF
-
-                orient_hist[a0, xF, yF, :] = orient_hist[a0, xF, yF, :] + np.bincount(
-                    np.mod(tF, num_theta_bins),
-                    weights=(1 - dx) * (1 - dy) * (1 - dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-                orient_hist[a0, xF, yF, :] = orient_hist[a0, xF, yF, :] + np.bincount(
-                    np.mod(tF + 1, num_theta_bins),
-                    weights=(1 - dx) * (1 - dy) * (dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-
-                orient_hist[a0, xF + 1, yF, :] = orient_hist[
-                    a0, xF + 1, yF, :
-                ] + np.bincount(
-                    np.mod(tF, num_theta_bins),
-                    weights=(dx) * (1 - dy) * (1 - dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-                orient_hist[a0, xF + 1, yF, :] = orient_hist[
-                    a0, xF + 1, yF, :
-                ] + np.bincount(
-                    np.mod(tF + 1, num_theta_bins),
-                    weights=(dx) * (1 - dy) * (dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-
-                orient_hist[a0, xF, yF + 1, :] = orient_hist[
-                    a0, xF, yF + 1, :
-                ] + np.bincount(
-                    np.mod(tF, num_theta_bins),
-                    weights=(1 - dx) * (dy) * (1 - dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-                orient_hist[a0, xF, yF + 1, :] = orient_hist[
-                    a0, xF, yF + 1, :
-                ] + np.bincount(
-                    np.mod(tF + 1, num_theta_bins),
-                    weights=(1 - dx) * (dy) * (dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-
-                orient_hist[a0, xF + 1, yF + 1, :] = orient_hist[
-                    a0, xF + 1, yF + 1, :
-                ] + np.bincount(
-                    np.mod(tF, num_theta_bins),
-                    weights=(dx) * (dy) * (1 - dt) * intensity,
-                    minlength=num_theta_bins,
-                )
-                orient_hist[a0, xF + 1, yF + 1, :] = orient_hist[
-                    a0, xF + 1, yF + 1, :
-                ] + np.bincount(
-                    np.mod(tF + 1, num_theta_bins),
-                    weights=(dx) * (dy) * (dt) * intensity,
-                    minlength=num_theta_bins,
-                )
+                if corr[rx, ry] <= 0:
+                    continue
+                t = t_all[rx, ry] + orientation_growth_angles
+                intensity = np.ones(num_angles) * corr[rx, ry]
+
+            tF = np.floor(t).astype("int")
+            dt = t - tF
+
+            # accumulate the bilinear (x,y) and linear theta weights for all
+            # 8 neighboring bins with a single bincount, indexed by
+            # (radial bin, x corner, y corner, theta bin)
+            w_xy = np.array(
+                [
+                    (1 - dx[rx]) * (1 - dy[ry]),
+                    (1 - dx[rx]) * (dy[ry]),
+                    (dx[rx]) * (1 - dy[ry]),
+                    (dx[rx]) * (dy[ry]),
+                ]
+            )
+            w_t = np.stack((1 - dt, dt))
+            inds = np.mod(tF + np.array([[0], [1]]), num_theta_bins) + (
+                4 * num_theta_bins * radial_inds
+            )
+            inds = inds[None, :, :] + num_theta_bins * np.arange(4)[:, None, None]
+            weights = w_xy[:, None, None] * w_t[None, :, :] * intensity
+            orient_hist[:, xF[rx] : xF[rx] + 2, yF[ry] : yF[ry] + 2, :] += np.bincount(
+                inds.ravel(),
+                weights=weights.ravel(),
+                minlength=num_radii * 4 * num_theta_bins,
+            ).reshape((num_radii, 2, 2, num_theta_bins))
 
     # smoothing / interpolation
     if (sigma_x is not None) or (sigma_y is not None) or (sigma_theta is not None):
@@ -265,31 +283,47 @@ def make_orientation_histogram(
             print("Interpolating orientation matrices ...", end="")
         else:
             print("Interpolating orientation matrix ...", end="")
-        if sigma_x is not None and sigma_x > 0:
-            orient_hist = gaussian_filter1d(
-                orient_hist,
-                sigma_x * upsample_factor,
-                mode="nearest",
-                axis=1,
-                truncate=3.0,
-            )
-        if sigma_y is not None and sigma_y > 0:
-            orient_hist = gaussian_filter1d(
-                orient_hist,
-                sigma_y * upsample_factor,
-                mode="nearest",
-                axis=2,
-                truncate=3.0,
-            )
-        if sigma_theta is not None and sigma_theta > 0:
-            orient_hist = gaussian_filter1d(
-                orient_hist, sigma_theta / dtheta_deg, mode="wrap", axis=3, truncate=2.0
+        if device == "gpu":
+            orient_hist = _smooth_orientation_histogram_gpu(
+                cp.asarray(orient_hist),
+                sigma_x,
+                sigma_y,
+                sigma_theta,
+                upsample_factor,
+                dtheta_deg,
             )
+        else:
+            if sigma_x is not None and sigma_x > 0:
+                correlate1d(
+                    orient_hist,
+                    get_gaussian_kernel_1D(sigma_x * upsample_factor, truncate=3.0),
+                    mode="nearest",
+                    axis=1,
+                    output=orient_hist,
+                )
+            if sigma_y is not None and sigma_y > 0:
+                correlate1d(
+                    orient_hist,
+                    get_gaussian_kernel_1D(sigma_y * upsample_factor, truncate=3.0),
+                    mode="nearest",
+                    axis=2,
+                    output=orient_hist,
+                )
+            if sigma_theta is not None and sigma_theta > 0:
+                kernel = get_gaussian_kernel_1D(sigma_theta / dtheta_deg, truncate=2.0)
+                if kernel.shape[0] > THETA_FFT_KERNEL_SIZE:
+                    _correlate_wrap_fft(orient_hist, kernel, axis=3)
+                else:
+                    correlate1d(
+                        orient_hist, kernel, mode="wrap", axis=3, output=orient_hist
+                    )
         print(" done.")
+    if device == "gpu":
+        orient_hist = cp.asnumpy(orient_hist)
 
     # normalization
     if normalize_intensity_stack is True:
-        orient_hist = orient_hist / np.max(orient_hist)
+        orient_hist /= np.max(orient_hist)
     elif normalize_intensity_image is True:
         for a0 in range(num_radii):
             orient_hist[a0, :, :, :] = orient_hist[a0, :, :, :] / np.max(
@@ -308,6 +342,7 @@ def make_flowline_map(
     sep_xy=6.0,
     sep_theta=5.0,
     sort_seeds="intensity",
+    max_seeds=None,
     linewidth=2.0,
     step_size=0.5,
     min_steps=4,
@@ -335,6 +370,8 @@ def make_flowline_map(
                                         None - no sorting
                                         'intensity' - sort by histogram intensity
                                         'random' - random order
+        max_seeds (int):            If not None, only grow flowlines from the max_seeds
+                                    most intense seeds in each radial bin.
         linewidth (float):          Thickness of the flowlines in pixels.
         step_size (float):          Step size for flowline growth in pixels.
         min_steps (int):            Minimum number of steps for a flowline to be drawn.
@@ -363,10 +400,9 @@ def make_flowline_map(
     # Default seed separation
     if sep_seeds is None:
         sep_seeds = np.round(np.min(sep_xy) / 2 + 0.5).astype("int")
-    else:
-        sep_seeds = np.atleast_1d(sep_seeds).astype("int")
-        if num_radii > 1 and len(sep_seeds) == 1:
-            sep_seeds = (np.ones(num_radii) * sep_seeds).astype("int")
+    sep_seeds = np.atleast_1d(sep_seeds).astype("int")
+    if num_radii > 1 and len(sep_seeds) == 1:
+        sep_seeds = (np.ones(num_radii) * sep_seeds).astype("int")
 
     # coordinates
     theta = np.linspace(0, np.pi, orient_hist.shape[3], endpoint=False)
@@ -390,16 +426,19 @@ def make_flowline_map(
         * np.exp(at**2 / (-2 * sigma_theta**2))
     )
     k = k / np.sum(k)
-    vx = vx[:, None, None].astype("int")
-    vy = vy[None, :, None].astype("int")
-    vt = vt[None, None, :].astype("int")
+    vx = vx.astype("int")
+    vy = vy.astype("int")
+    vt = vt.astype("int")
 
     # initalize flowline array
-    orient_flowlines = np.zeros_like(orient_hist)
+    orient_flowlines = np.zeros(orient_hist.shape, dtype=orient_hist.dtype)
 
-    # initialize output
-    xy_t_int = np.zeros((max_steps + 1, 4))
-    xy_t_int_rev = np.zeros((max_steps + 1, 4))
+    # scratch buffers for the steps of each flowline, reused for all seeds
+    xy_t_int = np.empty((max_steps + 1, 4))
+    xy_t_int_rev = np.empty((max_steps + 1, 4))
+
+    # grow flowlines with the compiled scalar kernel if numba is available
+    grow_flowline = _grow_flowline_loop if nb is not None else _grow_flowline_numpy
 
     # Loop over radial bins
     for a0 in range(num_radii):
@@ -407,16 +446,21 @@ def make_flowline_map(
         cr = np.arange(-np.ceil(sep_xy[a0]), np.ceil(sep_xy[a0]) + 1)
         ct = np.arange(-np.ceil(sep_theta[a0]), np.ceil(sep_theta[a0]) + 1)
         ay, ax, at = np.meshgrid(cr, cr, ct)
-        c_mask = (
-            (ax**2 + ay**2) / sep_xy[a0] ** 2 + at**2 / sep_theta[a0] ** 2
-            <= (1 + 1 / sep_xy[a0]) ** 2
-        )[None, :, :, :]
-        cx = cr[None, :, None, None].astype("int")
-        cy = cr[None, None, :, None].astype("int")
-        ct = ct[None, None, None, :].astype("int")
+        c_mask = (ax**2 + ay**2) / sep_xy[a0] ** 2 + at**2 / sep_theta[
+            a0
+        ] ** 2 <= (1 + 1 / sep_xy[a0]) ** 2
+        # keep only the offsets of the voxels inside the collision mask
+        cx = ax[c_mask].astype("int")
+        cy = ay[c_mask].astype("int")
+        ct = at[c_mask].astype("int")
 
         # Find all seed locations
-        orient = orient_hist[a0, :, :, :]
+        orient = np.ascontiguousarray(orient_hist[a0, :, :, :])
+        # edge padded copy, so that the (vx,vy) stencil around any rounded
+        # flowline position 0 <= x <= Nx, 0 <= y <= Ny is in bounds
+        orient_pad = np.pad(
+            orient, ((-vx[0], vx[-1] + 1), (-vy[0], vy[-1] + 1), (0, 0)), mode="edge"
+        )
         sub_seeds = np.logical_and(
             np.logical_and(
                 orient >= np.roll(orient, 1, axis=2),
@@ -425,15 +469,30 @@ def make_flowline_map(
             orient >= thresh_seed,
         )
 
-        # Separate seeds
-        if sep_seeds > 0:
-            for a1 in range(sep_seeds - 1):
-                sub_seeds[a1::sep_seeds, :, :] = False
-                sub_seeds[:, a1::sep_seeds, :] = False
+        # Separate seeds, keeping every sep_seeds'th row and column
+        if sep_seeds[a0] > 0:
+            keep_x = np.zeros(orient.shape[0], dtype="bool")
+            keep_y = np.zeros(orient.shape[1], dtype="bool")
+            keep_x[sep_seeds[a0] - 1 :: sep_seeds[a0]] = True
+            keep_y[sep_seeds[a0] - 1 :: sep_seeds[a0]] = True
+            sub_seeds &= keep_x[:, None, None] & keep_y[None, :, None]
 
         # Index seeds
         x_inds, y_inds, t_inds = np.where(sub_seeds)
-        if sort_seeds is not None:
+        if max_seeds is not None and max_seeds < x_inds.shape[0]:
+            # partition out the brightest seeds rather than sorting all of them
+            seed_vals = orient[x_inds, y_inds, t_inds]
+            inds_keep = np.argpartition(-seed_vals, max_seeds - 1)[:max_seeds]
+            if sort_seeds == "intensity":
+                inds_sort = inds_keep[np.argsort(seed_vals[inds_keep])[::-1]]
+            elif sort_seeds == "random":
+                inds_sort = np.random.permutation(inds_keep)
+            else:
+                inds_sort = np.sort(inds_keep)
+            x_inds = x_inds[inds_sort]
+            y_inds = y_inds[inds_sort]
+            t_inds = t_inds[inds_sort]
+        elif sort_seeds is not None:
             if sort_seeds == "intensity":
                 inds_sort = np.argsort(orient[sub_seeds])[::-1]
             elif sort_seeds == "random":
@@ -448,187 +507,93 @@ def make_flowline_map(
             range(0, x_inds.shape[0]), desc=t, unit=" seeds", disable=not progress_bar
         ):
             # initial coordinate and intensity
-            xy0 = np.array((x_inds[a1], y_inds[a1]))
+            x0 = int(x_inds[a1])
+            y0 = int(y_inds[a1])
             t0 = theta[t_inds[a1]]
 
             # init theta
-            inds_theta = np.mod(
-                np.round(t0 / dtheta).astype("int") + vt, orient.shape[2]
-            )
+            inds_theta = np.mod(round(t0 / dtheta) + vt, orient.shape[2])
             orient_crop = (
                 k
-                * orient[
-                    np.clip(
-                        np.round(xy0[0]).astype("int") + vx, 0, orient.shape[0] - 1
-                    ),
-                    np.clip(
-                        np.round(xy0[1]).astype("int") + vy, 0, orient.shape[1] - 1
-                    ),
+                * orient_pad[
+                    x0 + vx[:, None, None] - vx[0],
+                    y0 + vy[None, :, None] - vy[0],
                     inds_theta,
                 ]
             )
             theta_crop = theta[inds_theta]
             t0 = np.sum(orient_crop * theta_crop) / np.sum(orient_crop)
 
-            # forward direction
-            t = t0
-            v0 = np.array((-np.sin(t), np.cos(t)))
-            v = v0 * step_size
-            xy = xy0
-            int_val = get_intensity(orient, xy0[0], xy0[1], t0 / dtheta)
-            xy_t_int[0, 0:2] = xy0
-            xy_t_int[0, 2] = t / dtheta
-            xy_t_int[0, 3] = int_val
-            # main loop
-            grow = True
-            count = 0
-            while grow is True:
-                count += 1
-
-                # update position and intensity
-                xy = xy + v
-                int_val = get_intensity(orient, xy[0], xy[1], t / dtheta)
-
-                # check for collision
-                flow_crop = orient_flowlines[
-                    a0,
-                    np.clip(np.round(xy[0]).astype("int") + cx, 0, orient.shape[0] - 1),
-                    np.clip(np.round(xy[1]).astype("int") + cy, 0, orient.shape[1] - 1),
-                    np.mod(np.round(t / dtheta).astype("int") + ct, orient.shape[2]),
-                ]
-                int_flow = np.max(flow_crop[c_mask])
-
-                if (
-                    xy[0] < 0
-                    or xy[1] < 0
-                    or xy[0] > orient.shape[0]
-                    or xy[1] > orient.shape[1]
-                    or int_val < thresh_grow
-                    or int_flow > thresh_collision
-                ):
-                    grow = False
-                else:
-                    # update direction
-                    inds_theta = np.mod(
-                        np.round(t / dtheta).astype("int") + vt, orient.shape[2]
-                    )
-                    orient_crop = (
-                        k
-                        * orient[
-                            np.clip(
-                                np.round(xy[0]).astype("int") + vx,
-                                0,
-                                orient.shape[0] - 1,
-                            ),
-                            np.clip(
-                                np.round(xy[1]).astype("int") + vy,
-                                0,
-                                orient.shape[1] - 1,
-                            ),
-                            inds_theta,
-                        ]
-                    )
-                    theta_crop = theta[inds_theta]
-                    t = np.sum(orient_crop * theta_crop) / np.sum(orient_crop)
-                    v = np.array((-np.sin(t), np.cos(t))) * step_size
-
-                    xy_t_int[count, 0:2] = xy
-                    xy_t_int[count, 2] = t / dtheta
-                    xy_t_int[count, 3] = int_val
-
-                    if count > max_steps - 1:
-                        grow = False
-
-            # reverse direction
-            t = t0 + np.pi
-            v0 = np.array((-np.sin(t), np.cos(t)))
-            v = v0 * step_size
-            xy = xy0
-            int_val = get_intensity(orient, xy0[0], xy0[1], t0 / dtheta)
-            xy_t_int_rev[0, 0:2] = xy0
-            xy_t_int_rev[0, 2] = t / dtheta
-            xy_t_int_rev[0, 3] = int_val
-            # main loop
-            grow = True
-            count_rev = 0
-            while grow is True:
-                count_rev += 1
-
-                # update position and intensity
-                xy = xy + v
-                int_val = get_intensity(orient, xy[0], xy[1], t / dtheta)
-
-                # check for collision
-                flow_crop = orient_flowlines[
-                    a0,
-                    np.clip(np.round(xy[0]).astype("int") + cx, 0, orient.shape[0] - 1),
-                    np.clip(np.round(xy[1]).astype("int") + cy, 0, orient.shape[1] - 1),
-                    np.mod(np.round(t / dtheta).astype("int") + ct, orient.shape[2]),
-                ]
-                int_flow = np.max(flow_crop[c_mask])
-
-                if (
-                    xy[0] < 0
-                    or xy[1] < 0
-                    or xy[0] > orient.shape[0]
-                    or xy[1] > orient.shape[1]
-                    or int_val < thresh_grow
-                    or int_flow > thresh_collision
-                ):
-                    grow = False
-                else:
-                    # update direction
-                    inds_theta = np.mod(
-                        np.round(t / dtheta).astype("int") + vt, orient.shape[2]
-                    )
-                    orient_crop = (
-                        k
-                        * orient[
-                            np.clip(
-                                np.round(xy[0]).astype("int") + vx,
-                                0,
-                                orient.shape[0] - 1,
-                            ),
-                            np.clip(
-                                np.round(xy[1]).astype("int") + vy,
-                                0,
-                                orient.shape[1] - 1,
-                            ),
-                            inds_theta,
-                        ]
-                    )
-                    theta_crop = theta[inds_theta]
-                    t = np.sum(orient_crop * theta_crop) / np.sum(orient_crop) + np.pi
-                    v = np.array((-np.sin(t), np.cos(t))) * step_size
-
-                    xy_t_int_rev[count_rev, 0:2] = xy
-                    xy_t_int_rev[count_rev, 2] = t / dtheta
-                    xy_t_int_rev[count_rev, 3] = int_val
-
-                    if count_rev > max_steps - 1:
-                        grow = False
+            # forward and reverse directions
+            count = grow_flowline(
+                orient,
+                orient_pad,
+                orient_flowlines[a0, :, :, :],
+                xy_t_int,
+                x0,
+                y0,
+                t0,
+                0.0,
+                theta,
+                dtheta,
+                k,
+                vx,
+                vy,
+                vt,
+                cx,
+                cy,
+                ct,
+                step_size,
+                thresh_grow,
+                thresh_collision,
+                max_steps,
+            )
+            count_rev = grow_flowline(
+                orient,
+                orient_pad,
+                orient_flowlines[a0, :, :, :],
+                xy_t_int_rev,
+                x0,
+                y0,
+                t0,
+                np.pi,
+                theta,
+                dtheta,
+                k,
+                vx,
+                vy,
+                vt,
+                cx,
+                cy,
+                ct,
+                step_size,
+                thresh_grow,
+                thresh_collision,
+                max_steps,
+            )
 
-            # write into output array
+            # write into output array (in place, skipping empty flowlines)
             if count + count_rev > min_steps:
-                if count > 0:
-                    orient_flowlines[a0, :, :, :] = set_intensity(
-                        orient_flowlines[a0, :, :, :], xy_t_int[1:count, :]
-                    )
-                if count_rev > 1:
-                    orient_flowlines[a0, :, :, :] = set_intensity(
-                        orient_flowlines[a0, :, :, :], xy_t_int_rev[1:count_rev, :]
-                    )
+                for xy_t_int_dir, count_dir in (
+                    (xy_t_int, count),
+                    (xy_t_int_rev, count_rev),
+                ):
+                    if count_dir > 1:
+                        set_intensity(
+                            orient_flowlines[a0, :, :, :], xy_t_int_dir[1:count_dir, :]
+                        )
 
     # normalize to step size
-    orient_flowlines = orient_flowlines * step_size
+    orient_flowlines *= step_size
 
     # linewidth
     if linewidth > 1.0:
         s = linewidth - 1.0
 
-        orient_flowlines = gaussian_filter1d(orient_flowlines, s, axis=1, truncate=3.0)
-        orient_flowlines = gaussian_filter1d(orient_flowlines, s, axis=2, truncate=3.0)
-        orient_flowlines = orient_flowlines * (s**2)
+        kernel = get_gaussian_kernel_1D(s, truncate=3.0)
+        correlate1d(orient_flowlines, kernel, axis=1, output=orient_flowlines)
+        correlate1d(orient_flowlines, kernel, axis=2, output=orient_flowlines)
+        orient_flowlines *= s**2
 
     return orient_flowlines
 
@@ -750,24 +715,28 @@ def make_flowline_rainbow_image(
             if power_scaling != 1:
                 sig = sig**power_scaling
 
-            im_flowline[a0, :, :, :] = (
-                np.sum(sig * b0[None, None, :], axis=2)[:, :, None] * c0[None, None, :]
-                + np.sum(sig * b1[None, None, :], axis=2)[:, :, None]
-                * c1[None, None, :]
-                + np.sum(sig * b2[None, None, :], axis=2)[:, :, None]
-                * c2[None, None, :]
+            # project all theta bins onto RGB with a single matrix product
+            proj = b0[:, None] * c0 + b1[:, None] * c1 + b2[:, None] * c2
+            im_flowline[a0, :, :, :] = (sig.reshape(-1, size_input[3]) @ proj).reshape(
+                size_input[1], size_input[2], 3
             )
 
             # clip limits
-            im_flowline[a0, :, :, :] = np.clip(im_flowline[a0, :, :, :], 0, 1)
+            np.clip(im_flowline[a0], 0, 1, out=im_flowline[a0])
 
-            # contrast flip
+            # contrast flip - equivalent to setting S = V and V = 1 in HSV space
             if white_background is True:
-                im = rgb_to_hsv(im_flowline[a0])
-                im_v = im[:, :, 2]
-                im[:, :, 1] = im_v
-                im[:, :, 2] = 1
-                im_flowline[a0] = hsv_to_rgb(im)
+                im = im_flowline[a0]
+                im_v = np.max(im, axis=2)
+                im_c = im_v - np.min(im, axis=2)
+                sub = im_c > 0
+                scale = np.zeros_like(im_v)
+                scale[sub] = im_v[sub] / im_c[sub]
+                im -= im_v[:, :, None]
+                im *= scale[:, :, None]
+                im += 1
+                # grey pixels have zero hue, which maps to red
+                im[~sub, 1:] -= im_v[~sub, None]
 
     if sum_radial_bins is True:
         if white_background is False:
@@ -835,20 +804,16 @@ def make_flowline_rainbow_legend(
     # mask
     mask = np.logical_and(ra > radial_range[0], ra < radial_range[1])
 
-    # rgb image
-    z = mask * np.exp(1j * ta_sym)
+    # rgb image, with the hue given by the wrapped angle inside the ring
     hue_start = -90
-    amp = np.abs(z)
-    vmin = np.min(amp)
-    vmax = np.max(amp)
-    ph = np.angle(z, deg=1) + hue_start
+    ph = np.rad2deg(np.mod(ta_sym + np.pi, 2 * np.pi) - np.pi) + hue_start
     h = (ph % 360) / 360
-    s = 0.85 * np.ones_like(h)
-    v = (amp - vmin) / (vmax - vmin)
+    s = np.full_like(h, 0.85)
+    v = mask.astype("float")
     im_legend = hsv_to_rgb(np.dstack((h, s, v)))
 
     if white_background is True:
-        im_legend[im_legend.sum(2) == 0] = 1
+        im_legend[~mask] = 1
 
     # plotting
     if plot_legend:
@@ -964,6 +929,8 @@ def orientation_correlation(
     orient_hist,
     radius_max=None,
     progress_bar=True,
+    fast_fft_size=True,
+    dtype=np.float64,
 ):
     """
     Take in the 4D orientation histogram, and compute the distance-angle (auto)correlations
@@ -972,12 +939,17 @@ def orientation_correlation(
         orient_hist (array):    3D or 4D histogram of all orientations with coordinates [x y radial_bin theta]
         radius_max (float):     Maximum radial distance for correlogram calculation. If set to None, the maximum
                                 radius will be set to min(orient_hist.shape[0],orient_hist.shape[1])/2.
+        fast_fft_size (bool):   If True, the real space zero padding is increased to the next size which
+                                the FFT handles efficiently. The results only change by floating point rounding.
+        dtype (dtype):          Real floating point precision of the FFTs and of the output. np.float32 roughly
+                                halves the time and memory of the correlations, at single precision accuracy.
 
     Returns:
         orient_corr (array):          3D or 4D array containing correlation images as function of (dr,dtheta)
     """
 
     # Array sizes
+    orient_hist = np.asarray(orient_hist, dtype=dtype)
     size_input = np.array(orient_hist.shape)
     if radius_max is None:
         radius_max = np.ceil(np.min(orient_hist.shape[1:3]) / 2).astype("int")
@@ -987,47 +959,27 @@ def orientation_correlation(
             np.maximum(2 * size_input[2], 2 * radius_max),
         ]
     )
+    if fast_fft_size:
+        size_corr = np.array(
+            [sp_fft.next_fast_len(int(n), real=True) for n in size_corr]
+        )
 
-    # Initialize orientation histogram
-    orient_hist_pad = np.zeros(
-        (
-            size_input[0],
-            size_corr[0],
-            size_corr[1],
-            size_input[3],
-        ),
-        dtype="complex",
-    )
-    orient_norm_pad = np.zeros(
-        (
-            size_input[0],
-            size_corr[0],
-            size_corr[1],
-        ),
-        dtype="complex",
+    # Real FFTs of the histogram and its theta sum, zero padded in real space
+    size_fft = (size_corr[0], size_corr[1], size_input[3])
+    orient_hist_pad = sp_fft.rfftn(orient_hist, s=size_fft, axes=(1, 2, 3), workers=-1)
+    orient_norm_pad = sp_fft.rfftn(
+        np.sum(orient_hist, axis=3) / np.sqrt(size_input[3]),
+        s=size_fft[:2],
+        axes=(1, 2),
+        workers=-1,
     )
+    orient_hist_conj = np.conj(orient_hist_pad)
+    orient_norm_conj = np.conj(orient_norm_pad)
 
-    # Pad the histogram in real space
-    x_inds = np.arange(size_input[1])
-    y_inds = np.arange(size_input[2])
-    orient_hist_pad[:, x_inds[:, None], y_inds[None, :], :] = orient_hist
-    orient_norm_pad[:, x_inds[:, None], y_inds[None, :]] = np.sum(
-        orient_hist, axis=3
-    ) / np.sqrt(size_input[3])
-    orient_hist_pad = np.fft.fftn(orient_hist_pad, axes=(1, 2, 3))
-    orient_norm_pad = np.fft.fftn(orient_norm_pad, axes=(1, 2))
-
-    # Radial coordinates for integration
-    x = (
-        np.mod(np.arange(size_corr[0]) + size_corr[0] / 2, size_corr[0])
-        - size_corr[0] / 2
-    )
-    y = (
-        np.mod(np.arange(size_corr[1]) + size_corr[1] / 2, size_corr[1])
-        - size_corr[1] / 2
-    )
-    ya, xa = np.meshgrid(y, x)
-    ra = np.sqrt(xa**2 + ya**2)
+    # Radial coordinates for integration, rounded to remove fftfreq roundoff
+    x = np.rint(np.fft.fftfreq(size_corr[0]) * size_corr[0])
+    y = np.rint(np.fft.fftfreq(size_corr[1]) * size_corr[1])
+    ra = np.hypot(x[:, None], y[None, :])
 
     # coordinate subset
     sub0 = ra <= radius_max
@@ -1039,6 +991,19 @@ def orientation_correlation(
     inds = np.concatenate((rF0, rF1 + 1))
     weights = np.concatenate((1 - dr0, dr1))
 
+    # sparse linear interpolation from correlation pixels onto radial bins.
+    # Only the pixels inside radius_max are gathered, so the columns index
+    # into flat_idx (sub1 is a subset of sub0). The CSR rows store the
+    # entries of each radial bin contiguously, i.e. a sorted segmented sum.
+    flat_idx = np.flatnonzero(sub0)
+    inds_pixels = np.concatenate(
+        (np.arange(flat_idx.shape[0]), np.flatnonzero(sub1[sub0]))
+    )
+    radial_proj = csr_matrix(
+        (weights.astype(dtype), (inds, inds_pixels)),
+        shape=(radius_max + 1, flat_idx.shape[0]),
+    )
+
     # init output
     num_corr = (0.5 * size_input[0] * (size_input[0] + 1)).astype("int")
     orient_corr = np.zeros(
@@ -1046,59 +1011,84 @@ def orientation_correlation(
             num_corr,
             (size_input[3] / 2 + 1).astype("int"),
             radius_max + 1,
-        )
+        ),
+        dtype=dtype,
     )
 
-    # Main correlation calculation
-    ind_output = 0
-    for a0, a1 in tqdmnd(
-        range(size_input[0]),
-        range(size_input[0]),
-        desc="Calculate correlation plots",
-        unit=" probe positions",
-        disable=not progress_bar,
-    ):
-        # for a0 in range(size_input[0]):
-        #     for a1 in range(size_input[0]):
-        if a0 <= a1:
-            # Correlation
-            c = np.real(
-                np.fft.ifftn(
-                    orient_hist_pad[a0, :, :, :]
-                    * np.conj(orient_hist_pad[a1, :, :, :]),
-                    axes=(0, 1, 2),
-                )
-            )
+    # Correlations of all pairs a0 <= a1, with batched inverse transforms of
+    # num_chunk pairs at a time, sized to keep each batch in cache.
+    # The products stay Hermitian in the half length theta layout of rfftn,
+    # so irfftn returns the real correlations directly.
+    inds_a0, inds_a1 = _get_pair_inds(int(size_input[0]))
+    num_chunk = max(
+        1,
+        CORRELATION_CHUNK_BYTES
+        // (int(np.prod(size_fft)) * np.dtype(orient_corr.dtype).itemsize),
+    )
 
-            # Loop over all angles from 0 to pi/2  (half of indices)
-            for a2 in range((size_input[3] / 2 + 1).astype("int")):
-                orient_corr[ind_output, a2, :] = np.bincount(
-                    inds,
-                    weights=weights
-                    * np.concatenate((c[:, :, a2][sub0], c[:, :, a2][sub1])),
-                    minlength=radius_max,
-                )
+    def correlate_chunk(ind_start, workers):
+        chunk = slice(ind_start, ind_start + num_chunk)
+        corr = sp_fft.irfftn(
+            orient_hist_pad[inds_a0[chunk]] * orient_hist_conj[inds_a1[chunk]],
+            s=size_fft,
+            axes=(1, 2, 3),
+            workers=workers,
+        )
+        corr_norm = sp_fft.irfftn(
+            orient_norm_pad[inds_a0[chunk]] * orient_norm_conj[inds_a1[chunk]],
+            s=size_fft[:2],
+            axes=(1, 2),
+            workers=workers,
+        )
+        for ind_chunk in range(corr.shape[0]):
+            # radial integration of all angles from 0 to pi/2 (half of indices)
+            c = corr[ind_chunk].reshape(-1, size_input[3])
+            c = c[flat_idx, : orient_corr.shape[1]]
+            orient_corr[ind_start + ind_chunk, :, :] = (radial_proj @ c).T
 
             # normalize
-            c_norm = np.real(
-                np.fft.ifftn(
-                    orient_norm_pad[a0, :, :] * np.conj(orient_norm_pad[a1, :, :]),
-                    axes=(0, 1),
-                )
-            )
-            sig_norm = np.bincount(
-                inds,
-                weights=weights * np.concatenate((c_norm[sub0], c_norm[sub1])),
-                minlength=radius_max,
-            )
-            orient_corr[ind_output, :, :] /= sig_norm[None, :]
-
-            # increment output index
-            ind_output += 1
+            sig_norm = radial_proj @ corr_norm[ind_chunk].ravel()[flat_idx]
+            orient_corr[ind_start + ind_chunk, :, :] /= sig_norm[None, :]
+
+    # Main correlation calculation. With many more chunks than cores, the
+    # chunks are run in parallel threads with single threaded FFTs, otherwise
+    # one chunk at a time with multithreaded FFTs.
+    chunk_starts = range(0, num_corr, num_chunk)
+    num_cores = os.cpu_count() or 1
+    if num_cores > 1 and len(chunk_starts) >= 2 * num_cores:
+        with ThreadPoolExecutor(max_workers=num_cores) as executor:
+            futures = [executor.submit(correlate_chunk, i, 1) for i in chunk_starts]
+            for future in tqdmnd(
+                futures,
+                desc="Calculate correlation plots",
+                unit=" chunks",
+                disable=not progress_bar,
+            ):
+                future.result()
+    else:
+        for ind_start in tqdmnd(
+            chunk_starts,
+            desc="Calculate correlation plots",
+            unit=" chunks",
+            disable=not progress_bar,
+        ):
+            correlate_chunk(ind_start, -1)
 
     return orient_corr
 
 
+@functools.lru_cache(maxsize=16)
+def _get_pair_inds(num_rings):
+    """
+    Returns the (2, num_rings*(num_rings+1)/2) read-only array of the ring
+    pairs a0 <= a1 correlated by orientation_correlation, in output order.
+    Row 0 is the first diffraction ring and row 1 is the second.
+    """
+    pair_inds = np.vstack(np.triu_indices(num_rings))
+    pair_inds.flags.writeable = False
+    return pair_inds
+
+
 def plot_orientation_correlation(
     orient_corr,
     prob_range=[0.1, 10.0],
@@ -1164,10 +1154,7 @@ def plot_orientation_correlation(
     # Get the pair indices
     size_input = orient_corr.shape
     num_corr = (np.sqrt(8 * size_input[0] + 1) / 2 - 1 / 2).astype("int")
-    ya, xa = np.meshgrid(np.arange(num_corr), np.arange(num_corr))
-    keep = ya >= xa
-    # row 0 is the first diff ring, row 1 is the second diff ring
-    pair_inds = np.vstack((xa[keep], ya[keep]))
+    pair_inds = _get_pair_inds(int(num_corr))
 
     if inds_plot is None:
         inds_plot = np.arange(size_input[0])
@@ -1176,30 +1163,7 @@ def plot_orientation_correlation(
     else:
         inds_plot = np.array(inds_plot)
 
-    # Custom divergent colormap:
-    # dark blue
-    # light blue
-    # white
-    # red
-    # dark red
-    N = 256
-    cvals = np.zeros((N, 4))
-    cvals[:, 3] = 1
-    c = np.linspace(0.0, 1.0, int(N / 4))
-
-    cvals[0 : int(N / 4), 1] = c * 0.4 + 0.3
-    cvals[0 : int(N / 4), 2] = 1
-
-    cvals[int(N / 4) : int(N / 2), 0] = c
-    cvals[int(N / 4) : int(N / 2), 1] = c * 0.3 + 0.7
-    cvals[int(N / 4) : int(N / 2), 2] = 1
-
-    cvals[int(N / 2) : int(N * 3 / 4), 0] = 1
-    cvals[int(N / 2) : int(N * 3 / 4), 1] = 1 - c
-    cvals[int(N / 2) : int(N * 3 / 4), 2] = 1 - c
-
-    cvals[int(N * 3 / 4) : N, 0] = 1 - 0.5 * c
-    new_cmap = ListedColormap(cvals)
+    new_cmap = _ORIENT_CMAP
 
     if calculate_coefs:
         # Perform fitting
@@ -1214,11 +1178,19 @@ def plot_orientation_correlation(
     num_plot = inds_plot.shape[0]
     fig, ax = plt.subplots(num_plot, 1, figsize=(figsize[0], num_plot * figsize[1]))
 
+    # log scaled images of all plotted pairs, clipped to the plotting range
+    log_corr = np.clip(
+        orient_corr[inds_plot].astype("float", copy=False),
+        prob_range[0],
+        prob_range[1],
+    )
+    np.log10(log_corr, out=log_corr)
+
     # loop over indices
     for count, ind in enumerate(inds_plot):
         if num_plot > 1:
             p = ax[count].imshow(
-                np.log10(orient_corr[ind, :, :]),
+                log_corr[count],
                 vmin=np.log10(prob_range[0]),
                 vmax=np.log10(prob_range[1]),
                 aspect="auto",
@@ -1227,7 +1199,7 @@ def plot_orientation_correlation(
             ax_handle = ax[count]
         else:
             p = ax.imshow(
-                np.log10(orient_corr[ind, :, :]),
+                log_corr[count],
                 vmin=np.log10(prob_range[0]),
                 vmax=np.log10(prob_range[1]),
                 aspect="auto",
@@ -1396,6 +1368,19 @@ def plot_orientation_correlation(
 def get_intensity(orient, x, y, t):
     # utility function to get histogram intensites
 
+    if nb is not None:
+        # compiled loop over all points
+        x, y, t = np.broadcast_arrays(
+            np.asarray(x, dtype="float"),
+            np.asarray(y, dtype="float"),
+            np.asarray(t, dtype="float"),
+        )
+        int_vals = np.empty(x.shape)
+        _get_intensity_points_loop(
+            orient, x.ravel(), y.ravel(), t.ravel(), int_vals.reshape(-1)
+        )
+        return int_vals[()]
+
     x = np.clip(x, 0, orient.shape[0] - 2)
     y = np.clip(y, 0, orient.shape[1] - 2)
 
@@ -1423,7 +1408,12 @@ def get_intensity(orient, x, y, t):
 
 
 def set_intensity(orient, xy_t_int):
-    # utility function to set flowline intensites
+    # utility function to set flowline intensites, adding the trilinear
+    # weights of every step, including steps that share a voxel
+
+    if nb is not None:
+        _set_intensity_loop(orient, xy_t_int)
+        return orient
 
     xF = np.floor(xy_t_int[:, 0]).astype("int")
     yF = np.floor(xy_t_int[:, 1]).astype("int")
@@ -1432,53 +1422,492 @@ def set_intensity(orient, xy_t_int):
     dy = xy_t_int[:, 1] - yF
     dt = xy_t_int[:, 2] - tF
 
-    inds_1D = np.ravel_multi_index(
-        [xF, yF, tF], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (1 - dx) * (
-        1 - dy
-    ) * (1 - dt)
-    inds_1D = np.ravel_multi_index(
-        [xF, yF, tF + 1], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (1 - dx) * (
-        1 - dy
-    ) * (dt)
-    inds_1D = np.ravel_multi_index(
-        [xF, yF + 1, tF], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (1 - dx) * (
-        dy
-    ) * (1 - dt)
-    inds_1D = np.ravel_multi_index(
-        [xF, yF + 1, tF + 1], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (1 - dx) * (
-        dy
-    ) * (dt)
-    inds_1D = np.ravel_multi_index(
-        [xF + 1, yF, tF], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (dx) * (
-        1 - dy
-    ) * (1 - dt)
-    inds_1D = np.ravel_multi_index(
-        [xF + 1, yF, tF + 1], orient.shape[0:3], mode=["clip", "clip", "wrap"]
-    )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (dx) * (
-        1 - dy
-    ) * (dt)
-    inds_1D = np.ravel_multi_index(
-        [xF + 1, yF + 1, tF], orient.shape[0:3], mode=["clip", "clip", "wrap"]
+    x = np.clip(np.stack((xF, xF + 1)), 0, orient.shape[0] - 1)
+    y = np.clip(np.stack((yF, yF + 1)), 0, orient.shape[1] - 1)
+    t = np.mod(np.stack((tF, tF + 1)), orient.shape[2])
+    w_x = np.stack((1 - dx, dx)) * xy_t_int[:, 3]
+    w_y = np.stack((1 - dy, dy))
+    w_t = np.stack((1 - dt, dt))
+
+    np.add.at(
+        orient,
+        (
+            x[:, None, None, :],
+            y[None, :, None, :],
+            t[None, None, :, :],
+        ),
+        w_x[:, None, None, :] * w_y[None, :, None, :] * w_t[None, None, :, :],
     )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (dx) * (dy) * (
-        1 - dt
+
+    return orient
+
+
+def _grow_flowline_numpy(
+    orient,
+    orient_pad,
+    orient_flowline,
+    xy_t_int,
+    x0,
+    y0,
+    t0,
+    t_offset,
+    theta,
+    dtheta,
+    k,
+    vx,
+    vy,
+    vt,
+    cx,
+    cy,
+    ct,
+    step_size,
+    thresh_grow,
+    thresh_collision,
+    max_steps,
+):
+    """
+    Grows a single flowline from the seed (x0,y0) at angle t0 + t_offset, where
+    t_offset is 0 for the forward direction and pi for the reverse direction.
+    The positions, angles and intensities of each step are written to the rows
+    of xy_t_int. Growth stops on leaving the array, when the intensity drops
+    below thresh_grow, when an existing flowline in orient_flowline exceeds
+    thresh_collision at any of the collision offsets (cx,cy,ct), or after
+    max_steps. Returns the number of steps taken. orient_pad is orient padded
+    in x and y as in make_flowline_map, for the direction stencil (vx,vy,vt).
+    """
+    Nx, Ny, Nt = orient.shape
+    # flat indices of the (x,y) stencil around (0,0) in orient_pad
+    Ny_pad = orient_pad.shape[1]
+    orient_pad_flat = orient_pad.reshape(-1)
+    stencil_xy = (((vx[:, None] - vx[0]) * Ny_pad + vy[None, :] - vy[0]) * Nt)[
+        :, :, None
+    ]
+
+    t = t0 + t_offset
+    vel_x = -math.sin(t) * step_size
+    vel_y = math.cos(t) * step_size
+    x = float(x0)
+    y = float(y0)
+    int_val = _get_intensity_loop(orient, x0, y0, t0 / dtheta)
+    xy_t_int[0, 0] = x
+    xy_t_int[0, 1] = y
+    xy_t_int[0, 2] = t / dtheta
+    xy_t_int[0, 3] = int_val
+    # main loop
+    grow = True
+    count = 0
+    while grow is True:
+        count += 1
+
+        # update position and intensity
+        x += vel_x
+        y += vel_y
+        int_val = _get_intensity_loop(orient, x, y, t / dtheta)
+
+        # check for collision
+        xr = round(x)
+        yr = round(y)
+        tr = round(t / dtheta)
+        int_flow = np.max(
+            orient_flowline[
+                np.clip(xr + cx, 0, Nx - 1),
+                np.clip(yr + cy, 0, Ny - 1),
+                np.mod(tr + ct, Nt),
+            ]
+        )
+
+        if (
+            x < 0
+            or y < 0
+            or x > Nx
+            or y > Ny
+            or int_val < thresh_grow
+            or int_flow > thresh_collision
+        ):
+            grow = False
+        else:
+            # update direction
+            inds_theta = np.mod(tr + vt, Nt)
+            inds = (xr * Ny_pad + yr) * Nt + stencil_xy + inds_theta
+            orient_crop = k * orient_pad_flat[inds]
+            theta_crop = theta[inds_theta]
+            t = float(np.sum(orient_crop * theta_crop) / np.sum(orient_crop)) + t_offset
+            vel_x = -math.sin(t) * step_size
+            vel_y = math.cos(t) * step_size
+
+            xy_t_int[count, 0] = x
+            xy_t_int[count, 1] = y
+            xy_t_int[count, 2] = t / dtheta
+            xy_t_int[count, 3] = int_val
+
+            if count > max_steps - 1:
+                grow = False
+
+    return count
+
+
+# Scalar loop implementations of the flowline growth, which are compiled
+# with numba when it is installed, replacing the numpy implementation above
+
+
+def _wrap_theta_index(i, Nt):
+    # periodic theta bin index; a single bitwise AND when Nt is a power of 2
+    if Nt & (Nt - 1) == 0:
+        return i & (Nt - 1)
+    return i % Nt
+
+
+def _get_intensity_loop(orient, x, y, t):
+    # scalar version of get_intensity
+    x = min(max(x, 0.0), orient.shape[0] - 2)
+    y = min(max(y, 0.0), orient.shape[1] - 2)
+
+    xF = int(math.floor(x))
+    yF = int(math.floor(y))
+    tF = int(math.floor(t))
+    dx = x - xF
+    dy = y - yF
+    dt = t - tF
+    t1 = _wrap_theta_index(tF, orient.shape[2])
+    t2 = _wrap_theta_index(tF + 1, orient.shape[2])
+
+    return (
+        orient[xF, yF, t1] * ((1 - dx) * (1 - dy) * (1 - dt))
+        + orient[xF, yF, t2] * ((1 - dx) * (1 - dy) * (dt))
+        + orient[xF, yF + 1, t1] * ((1 - dx) * (dy) * (1 - dt))
+        + orient[xF, yF + 1, t2] * ((1 - dx) * (dy) * (dt))
+        + orient[xF + 1, yF, t1] * ((dx) * (1 - dy) * (1 - dt))
+        + orient[xF + 1, yF, t2] * ((dx) * (1 - dy) * (dt))
+        + orient[xF + 1, yF + 1, t1] * ((dx) * (dy) * (1 - dt))
+        + orient[xF + 1, yF + 1, t2] * ((dx) * (dy) * (dt))
     )
-    inds_1D = np.ravel_multi_index(
-        [xF + 1, yF + 1, tF + 1], orient.shape[0:3], mode=["clip", "clip", "wrap"]
+
+
+def _get_intensity_points_loop(orient, x, y, t, int_vals):
+    # get_intensity for 1D arrays of points, in parallel
+    for i in _prange(x.shape[0]):
+        int_vals[i] = _get_intensity_loop(orient, x[i], y[i], t[i])
+
+
+def _get_flowline_collision_loop(
+    orient_flowline, xr, yr, tr, cx, cy, ct, thresh_collision
+):
+    # True if any voxel of orient_flowline at the offsets (cx,cy,ct) around
+    # (xr,yr,tr) exceeds thresh_collision, returning as soon as one is found
+    Nx, Ny, Nt = orient_flowline.shape
+    for i in range(cx.shape[0]):
+        x = min(max(xr + cx[i], 0), Nx - 1)
+        y = min(max(yr + cy[i], 0), Ny - 1)
+        t = _wrap_theta_index(tr + ct[i], Nt)
+        if orient_flowline[x, y, t] > thresh_collision:
+            return True
+    return False
+
+
+def _get_flowline_theta_loop(orient_pad, xr, yr, tr, theta, k, vx, vy, vt):
+    # the k-weighted mean angle around (xr,yr,tr), read from the padded array
+    Nt = orient_pad.shape[2]
+    num = 0.0
+    den = 0.0
+    for i in range(vx.shape[0]):
+        x = xr + vx[i] - vx[0]
+        for j in range(vy.shape[0]):
+            y = yr + vy[j] - vy[0]
+            for m in range(vt.shape[0]):
+                it = _wrap_theta_index(tr + vt[m], Nt)
+                w = k[i, j, m] * orient_pad[x, y, it]
+                num += w * theta[it]
+                den += w
+    return num / den
+
+
+def _grow_flowline_loop(
+    orient,
+    orient_pad,
+    orient_flowline,
+    xy_t_int,
+    x0,
+    y0,
+    t0,
+    t_offset,
+    theta,
+    dtheta,
+    k,
+    vx,
+    vy,
+    vt,
+    cx,
+    cy,
+    ct,
+    step_size,
+    thresh_grow,
+    thresh_collision,
+    max_steps,
+):
+    # scalar version of _grow_flowline_numpy
+    Nx, Ny, Nt = orient.shape
+    t = t0 + t_offset
+    vel_x = -math.sin(t) * step_size
+    vel_y = math.cos(t) * step_size
+    x = float(x0)
+    y = float(y0)
+    xy_t_int[0, 0] = x
+    xy_t_int[0, 1] = y
+    xy_t_int[0, 2] = t / dtheta
+    xy_t_int[0, 3] = _get_intensity_loop(orient, x, y, t0 / dtheta)
+    count = 0
+    while True:
+        count += 1
+
+        # update position and intensity
+        x += vel_x
+        y += vel_y
+        int_val = _get_intensity_loop(orient, x, y, t / dtheta)
+        if x < 0 or y < 0 or x > Nx or y > Ny or int_val < thresh_grow:
+            break
+
+        # check for collision
+        xr = int(np.rint(x))
+        yr = int(np.rint(y))
+        tr = int(np.rint(t / dtheta))
+        if _get_flowline_collision_loop(
+            orient_flowline, xr, yr, tr, cx, cy, ct, thresh_collision
+        ):
+            break
+
+        # update direction
+        t = _get_flowline_theta_loop(orient_pad, xr, yr, tr, theta, k, vx, vy, vt)
+        t += t_offset
+        vel_x = -math.sin(t) * step_size
+        vel_y = math.cos(t) * step_size
+
+        xy_t_int[count, 0] = x
+        xy_t_int[count, 1] = y
+        xy_t_int[count, 2] = t / dtheta
+        xy_t_int[count, 3] = int_val
+
+        if count > max_steps - 1:
+            break
+
+    return count
+
+
+def _correlate_wrap_fft(ar, kernel, axis):
+    """
+    In place equivalent of correlate1d(ar, kernel, mode="wrap", axis=axis),
+    computed as a circular convolution with real FFTs. For long kernels this
+    is cheaper than the direct sum over the kernel.
+    """
+    N = ar.shape[axis]
+    r = kernel.shape[0] // 2
+    kernel_wrap = np.zeros(N)
+    np.add.at(kernel_wrap, np.arange(r, -r - 1, -1) % N, kernel)
+    shape = [1] * ar.ndim
+    shape[axis] = -1
+    ar_ft = sp_fft.rfft(ar, axis=axis, workers=-1)
+    ar_ft *= sp_fft.rfft(kernel_wrap.astype(ar.dtype)).reshape(shape)
+    ar[...] = sp_fft.irfft(ar_ft, n=N, axis=axis, workers=-1)
+    return ar
+
+
+def _set_intensity_loop(orient, xy_t_int):
+    # scalar version of set_intensity
+    Nx, Ny, Nt = orient.shape
+    for i in range(xy_t_int.shape[0]):
+        xF = math.floor(xy_t_int[i, 0])
+        yF = math.floor(xy_t_int[i, 1])
+        tF = math.floor(xy_t_int[i, 2])
+        dx = xy_t_int[i, 0] - xF
+        dy = xy_t_int[i, 1] - yF
+        dt = xy_t_int[i, 2] - tF
+        x1 = min(max(int(xF), 0), Nx - 1)
+        x2 = min(max(int(xF) + 1, 0), Nx - 1)
+        y1 = min(max(int(yF), 0), Ny - 1)
+        y2 = min(max(int(yF) + 1, 0), Ny - 1)
+        t1 = _wrap_theta_index(int(tF), Nt)
+        t2 = _wrap_theta_index(int(tF) + 1, Nt)
+        w = xy_t_int[i, 3]
+
+        orient[x1, y1, t1] += w * ((1 - dx) * (1 - dy) * (1 - dt))
+        orient[x1, y1, t2] += w * ((1 - dx) * (1 - dy) * (dt))
+        orient[x1, y2, t1] += w * ((1 - dx) * (dy) * (1 - dt))
+        orient[x1, y2, t2] += w * ((1 - dx) * (dy) * (dt))
+        orient[x2, y1, t1] += w * ((dx) * (1 - dy) * (1 - dt))
+        orient[x2, y1, t2] += w * ((dx) * (1 - dy) * (dt))
+        orient[x2, y2, t1] += w * ((dx) * (dy) * (1 - dt))
+        orient[x2, y2, t2] += w * ((dx) * (dy) * (dt))
+
+
+def _make_orientation_histogram_gpu(
+    qx,
+    qy,
+    intensity,
+    offsets,
+    xF,
+    dx,
+    yF,
+    dy,
+    radial_ranges_2,
+    dtheta,
+    shape,
+    dtype,
+):
+    """
+    Accumulates the Bragg peaks gathered by _get_bragg_peaks_csr into a new
+    cupy orientation histogram of the given shape and dtype, adding the 8 bilinear
+    (x,y) and linear theta weights of every peak with atomic scatter adds.
+    xF, dx, yF and dy are the interpolation coordinates of each probe row and
+    column, as in make_orientation_histogram.
+    """
+    num_radii, Nx, Ny, Nt = shape
+    num_probes_y = yF.shape[0]
+
+    # probe row and column of every peak
+    probe = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    rx = cp.asarray(probe // num_probes_y)
+    ry = cp.asarray(probe % num_probes_y)
+
+    qx = cp.asarray(qx)
+    qy = cp.asarray(qy)
+    intensity = cp.asarray(intensity)
+    r2 = qx**2 + qy**2
+    t = cp.arctan2(qy, qx) / dtheta
+    tF = cp.floor(t).astype("int")
+    dt = t - tF
+    xF = cp.asarray(xF)[rx]
+    dx = cp.asarray(dx)[rx]
+    yF = cp.asarray(yF)[ry]
+    dy = cp.asarray(dy)[ry]
+
+    orient_hist = cp.zeros(num_radii * Nx * Ny * Nt, dtype=dtype)
+    for a0 in range(num_radii):
+        sub = cp.logical_and(
+            r2 >= radial_ranges_2[a0, 0],
+            r2 < radial_ranges_2[a0, 1],
+        )
+        for ox in range(2):
+            w_x = intensity[sub] * (dx[sub] if ox else 1 - dx[sub])
+            for oy in range(2):
+                w_xy = w_x * (dy[sub] if oy else 1 - dy[sub])
+                ind_xy = (a0 * Nx + xF[sub] + ox) * Ny + yF[sub] + oy
+                for ot in range(2):
+                    cupyx.scatter_add(
+                        orient_hist,
+                        ind_xy * Nt + (tF[sub] + ot) % Nt,
+                        w_xy * (dt[sub] if ot else 1 - dt[sub]),
+                    )
+
+    return orient_hist.reshape(shape)
+
+
+def _smooth_orientation_histogram_gpu(
+    orient_hist,
+    sigma_x,
+    sigma_y,
+    sigma_theta,
+    upsample_factor,
+    dtheta_deg,
+):
+    """
+    The gaussian smoothing of make_orientation_histogram, for a cupy array.
+    """
+    if sigma_x is not None and sigma_x > 0:
+        orient_hist = cp_correlate1d(
+            orient_hist,
+            cp.asarray(get_gaussian_kernel_1D(sigma_x * upsample_factor, truncate=3.0)),
+            mode="nearest",
+            axis=1,
+        )
+    if sigma_y is not None and sigma_y > 0:
+        orient_hist = cp_correlate1d(
+            orient_hist,
+            cp.asarray(get_gaussian_kernel_1D(sigma_y * upsample_factor, truncate=3.0)),
+            mode="nearest",
+            axis=2,
+        )
+    if sigma_theta is not None and sigma_theta > 0:
+        orient_hist = cp_correlate1d(
+            orient_hist,
+            cp.asarray(get_gaussian_kernel_1D(sigma_theta / dtheta_deg, truncate=2.0)),
+            mode="wrap",
+            axis=3,
+        )
+    return orient_hist
+
+
+def _get_bragg_peaks_csr(bragg_peaks, size_input):
+    """
+    Gathers the calibrated Bragg peaks of all probe positions into flat qx, qy
+    and intensity arrays, in C order over the scan. The peaks of probe position
+    (rx,ry) are at indices offsets[i]:offsets[i+1], where i = rx*size_input[1]+ry.
+    """
+    return bragg_peaks.cal.all()
+
+
+def _make_orientation_histogram_loop(
+    qx,
+    qy,
+    intensity,
+    offsets,
+    xF,
+    dx,
+    yF,
+    dy,
+    radial_ranges_2,
+    dtheta,
+    orient_hist,
+):
+    # Scalar loop version of the Bragg peak histogram accumulation in
+    # make_orientation_histogram. Parallelized over the rows of the output,
+    # so that each row is only written by a single thread.
+    num_radii, Nx, Ny, Nt = orient_hist.shape
+    Rx = xF.shape[0]
+    Ry = yF.shape[0]
+    for X in _prange(Nx):
+        for rx in range(Rx):
+            wx = 0.0
+            if xF[rx] == X:
+                wx = 1 - dx[rx]
+            elif xF[rx] + 1 == X:
+                wx = dx[rx]
+            else:
+                continue
+            for ry in range(Ry):
+                Y = yF[ry]
+                wy0 = 1 - dy[ry]
+                wy1 = dy[ry]
+                i = rx * Ry + ry
+                for p in range(offsets[i], offsets[i + 1]):
+                    r2 = qx[p] ** 2 + qy[p] ** 2
+                    t = math.atan2(qy[p], qx[p]) / dtheta
+                    tF = int(math.floor(t))
+                    dt = t - tF
+                    t1 = _wrap_theta_index(tF, Nt)
+                    t2 = _wrap_theta_index(tF + 1, Nt)
+                    for a0 in range(num_radii):
+                        if r2 >= radial_ranges_2[a0, 0] and r2 < radial_ranges_2[a0, 1]:
+                            orient_hist[a0, X, Y, t1] += (
+                                wx * wy0 * (1 - dt) * intensity[p]
+                            )
+                            orient_hist[a0, X, Y, t2] += wx * wy0 * (dt) * intensity[p]
+                            orient_hist[a0, X, Y + 1, t1] += (
+                                wx * wy1 * (1 - dt) * intensity[p]
+                            )
+                            orient_hist[a0, X, Y + 1, t2] += (
+                                wx * wy1 * (dt) * intensity[p]
+                            )
+
+
+if nb is not None:
+    _wrap_theta_index = nb.njit(cache=True, inline="always")(_wrap_theta_index)
+    _get_intensity_loop = nb.njit(cache=True, inline="always")(_get_intensity_loop)
+    _get_intensity_points_loop = nb.njit(cache=True, parallel=True)(
+        _get_intensity_points_loop
     )
-    orient.ravel()[inds_1D] = orient.ravel()[inds_1D] + xy_t_int[:, 3] * (dx) * (dy) * (
-        dt
+    _get_flowline_collision_loop = nb.njit(cache=True)(_get_flowline_collision_loop)
+    _get_flowline_theta_loop = nb.njit(cache=True)(_get_flowline_theta_loop)
+    _grow_flowline_loop = nb.njit(cache=True)(_grow_flowline_loop)
+    _set_intensity_loop = nb.njit(cache=True)(_set_intensity_loop)
+    _make_orientation_histogram_loop = nb.njit(cache=True, parallel=True)(
+        _make_orientation_histogram_loop
     )
-
-    return orient
@@ -3,6 +3,7 @@
 import numpy as np
 from emdfile import PointList, PointListArray, tqdmnd
 from numpy.linalg import lstsq
+from scipy.spatial import cKDTree
 from py4DSTEM.data import RealSlice
 
 
@@ -118,6 +119,12 @@ def add_indices_to_braggvectors(
 
     calstate = braggpeaks.calstate
 
+    # a tree of the lattice points, shifted into the braggpeaks' frame, to find
+    # the nearest lattice point to all the peaks of a scan position at once
+    lattice_tree = cKDTree(
+        np.stack((lattice.data["qx"] - qx_shift, lattice.data["qy"] - qy_shift), axis=1)
+    )
+
     # loop over all the scan positions
     for Rx, Ry in tqdmnd(mask.shape[0], mask.shape[1]):
         if mask[Rx, Ry]:
@@ -129,21 +136,22 @@ def add_indices_to_braggvectors(
                 rotate=calstate["rotate"],
                 pixel=False,
             )
-            for i in range(pl.data.shape[0]):
-                r2 = (pl.data["qx"][i] - lattice.data["qx"] + qx_shift) ** 2 + (
-                    pl.data["qy"][i] - lattice.data["qy"] + qy_shift
-                ) ** 2
-                ind = np.argmin(r2)
-                if r2[ind] <= maxPeakSpacing**2:
-                    indexed_braggpeaks[Rx, Ry].add_data_by_field(
-                        (
-                            pl.data["qx"][i],
-                            pl.data["qy"][i],
-                            pl.data["intensity"][i],
-                            lattice.data["g1_ind"][ind],
-                            lattice.data["g2_ind"][ind],
-                        )
-                    )
+            _, ind = lattice_tree.query(
+                np.stack((pl.data["qx"], pl.data["qy"]), axis=1), k=1
+            )
+            r2 = (pl.data["qx"] - lattice.data["qx"][ind] + qx_shift) ** 2 + (
+                pl.data["qy"] - lattice.data["qy"][ind] + qy_shift
+            ) ** 2
+            sub = r2 <= maxPeakSpacing**2
+            indexed_braggpeaks[Rx, Ry].add_data_by_field(
+                (
+                    pl.data["qx"][sub],
+                    pl.data["qy"][sub],
+                    pl.data["intensity"][sub],
+                    lattice.data["g1_ind"][ind[sub]],
+                    lattice.data["g2_ind"][ind[sub]],
+                )
+            )
 
     return indexed_braggpeaks
 
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
 from matplotlib.collections import PatchCollection
 import numpy as np
+from scipy.spatial import cKDTree
 from py4DSTEM import PointList, PointListArray, tqdmnd
 from py4DSTEM.braggvectors import BraggVectors
 from py4DSTEM.data import Data, RealSlice
@@ -580,8 +581,15 @@ class StrainMap(RealSlice, Data):
         )
 
         # loop over all the scan positions
-        # and perform indexing, excluding peaks outside of max_peak_spacing
+        # and perform indexing, excluding peaks outside of max_peak_spacing,
+        # finding the nearest bragg direction to all peaks at once with a tree
         calstate = self.braggvectors.calstate
+        braggdirections_tree = cKDTree(
+            np.stack(
+                (self.braggdirections.data["qx"], self.braggdirections.data["qy"]),
+                axis=1,
+            )
+        )
         for Rx, Ry in tqdmnd(
             mask.shape[0],
             mask.shape[1],
@@ -598,22 +606,23 @@ class StrainMap(RealSlice, Data):
                     rotate=calstate["rotate"],
                     pixel=False,
                 )
-                for i in range(pl.data.shape[0]):
-                    r = np.hypot(
-                        pl.data["qx"][i] - self.braggdirections.data["qx"],
-                        pl.data["qy"][i] - self.braggdirections.data["qy"],
+                _, ind = braggdirections_tree.query(
+                    np.stack((pl.data["qx"], pl.data["qy"]), axis=1), k=1
+                )
+                r = np.hypot(
+                    pl.data["qx"] - self.braggdirections.data["qx"][ind],
+                    pl.data["qy"] - self.braggdirections.data["qy"][ind],
+                )
+                sub = r <= self.max_peak_spacing
+                indexed_braggpeaks[Rx, Ry].add_data_by_field(
+                    (
+                        pl.data["qx"][sub],
+                        pl.data["qy"][sub],
+                        pl.data["intensity"][sub],
+                        self.braggdirections.data["g1_ind"][ind[sub]],
+                        self.braggdirections.data["g2_ind"][ind[sub]],
                     )
-                    ind = np.argmin(r)
-                    if r[ind] <= self.max_peak_spacing:
-                        indexed_braggpeaks[Rx, Ry].add_data_by_field(
-                            (
-                                pl.data["qx"][i],
-                                pl.data["qy"][i],
-                                pl.data["intensity"][i],
-                                self.braggdirections.data["g1_ind"][ind],
-                                self.braggdirections.data["g2_ind"][ind],
-                            )
-                        )
+                )
         self.bragg_vectors_indexed = indexed_braggpeaks
 
         # fit bragg vectors
@@ -36,15 +36,34 @@ def get_cross_correlation_FT(ar, template_FT, corrPower=1, _returnval="real"):
     """
     assert _returnval in ("real", "fourier")
     m = np.fft.fft2(ar) * template_FT
-    if corrPower != 1:
-        cc = np.abs(m) ** (corrPower) * np.exp(1j * np.angle(m))
-    else:
-        cc = m
+    cc = apply_correlation_power(m, corrPower)
     if _returnval == "real":
         cc = np.maximum(np.real(np.fft.ifft2(cc)), 0)
     return cc
 
 
+def apply_correlation_power(m, corrPower=1):
+    """
+    Given the product `m` of two Fourier transforms, returns the Fourier
+    space cross (corrPower=1), phase (corrPower=0) or hybrid correlation,
+    i.e. `np.abs(m)**corrPower * np.exp(1j*np.angle(m))`.
+
+    Cross correlations return `m` as is. Otherwise `m` is overwritten with
+    the result, which is computed as m * |m|**(corrPower-1), or m/|m| for a
+    phase correlation, to avoid evaluating angles and complex exponentials.
+    Zero valued elements map to zero, as in the CUDA hybrid_correlation kernel.
+    """
+    if corrPower == 1:
+        return m
+    mag = np.abs(m)
+    nonzero = mag > 0
+    if corrPower == 0:
+        np.divide(m, mag, out=m, where=nonzero)
+    else:
+        m *= np.power(mag, corrPower - 1, out=np.zeros_like(mag), where=nonzero)
+    return m
+
+
 def get_shift(ar1, ar2, corrPower=1):
     """
         Determine the relative shift between a pair of arrays giving the best overlap.
@@ -0,0 +1,21 @@
+import numpy as np
+from py4DSTEM.braggvectors import BraggVectors
+
+
+def make_braggvectors(Rshape, get_vectors, Qshape=(128, 128)):
+    """
+    Returns BraggVectors of shape Rshape holding, at each scan position
+    (rx,ry), the uncalibrated vectors (qx,qy,intensity) returned by
+    get_vectors(rx,ry). Scan positions given empty arrays hold no vectors.
+    """
+    braggvectors = BraggVectors(Rshape, Qshape)
+    for rx, ry in np.ndindex(*Rshape):
+        qx, qy, intensity = get_vectors(rx, ry)
+        data = np.zeros(
+            len(qx), dtype=[("qx", float), ("qy", float), ("intensity", float)]
+        )
+        data["qx"] = qx
+        data["qy"] = qy
+        data["intensity"] = intensity
+        braggvectors._v_uncal[rx, ry].add(data)
+    return braggvectors
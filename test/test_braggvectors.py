@@ -1,6 +1,7 @@
 import py4DSTEM
 import numpy as np
 from os.path import join
+from synthetic import make_braggvectors
 
 # set filepath
 path = join(py4DSTEM._TESTPATH, "test_io/legacy_v0.9_simAuNanoplatelet_bin.h5")
@@ -90,3 +91,177 @@ class TestDiskDetectionBasic:
                 rotate=False,
             )
         )
+
+
+def make_calibrated_braggvectors(Rx=9, Ry=11, seed=0):
+    """
+    Synthetic bragg vectors with a per-position origin and ellipse, a pixel
+    size and a QR rotation, and a handful of empty scan positions
+    """
+    rng = np.random.default_rng(seed)
+
+    def get_vectors(rx, ry):
+        n = 0 if (rx + 2 * ry) % 7 == 0 else rng.integers(1, 12)
+        return 64 + rng.normal(0, 30, n), 60 + rng.normal(0, 30, n), rng.random(n)
+
+    braggvectors = make_braggvectors((Rx, Ry), get_vectors)
+
+    c = braggvectors.calibration
+    c.set_origin((64 + rng.random((Rx, Ry)), 60 + rng.random((Rx, Ry))))
+    c.set_ellipse(
+        (
+            1.1 + 0.1 * rng.random((Rx, Ry)),
+            1.0 + 0.05 * rng.random((Rx, Ry)),
+            rng.random((Rx, Ry)),
+        )
+    )
+    c.set_Q_pixel_size(0.013)
+    c.set_QR_rotation_degrees(23.0)
+    return braggvectors
+
+
+def test_BraggVectors_raw_all():
+    braggvectors = make_calibrated_braggvectors()
+    qx, qy, I, offsets = braggvectors.raw.all()
+    Rx, Ry = braggvectors.Rshape
+    assert len(offsets) == Rx * Ry + 1
+    for rx in range(Rx):
+        for ry in range(Ry):
+            i = rx * Ry + ry
+            data = braggvectors.raw[rx, ry].data
+            assert np.array_equal(data["qx"], qx[offsets[i] : offsets[i + 1]])
+            assert np.array_equal(data["qy"], qy[offsets[i] : offsets[i + 1]])
+            assert np.array_equal(data["intensity"], I[offsets[i] : offsets[i + 1]])
+
+
+def test_BraggVectors_cal_all():
+    import itertools
+
+    braggvectors = make_calibrated_braggvectors()
+    Rx, Ry = braggvectors.Rshape
+    for flip in (False, True):
+        braggvectors.calibration.set_QR_flip(flip)
+        for center, ellipse, pixel, rotate in itertools.product(
+            (False, True), repeat=4
+        ):
+            braggvectors.setcal(
+                center=center, ellipse=ellipse, pixel=pixel, rotate=rotate
+            )
+            qx, qy, I, offsets = braggvectors.cal.all()
+            assert len(offsets) == Rx * Ry + 1
+            for rx in range(Rx):
+                for ry in range(Ry):
+                    i = rx * Ry + ry
+                    data = braggvectors.cal[rx, ry].data
+                    assert len(data) == offsets[i + 1] - offsets[i]
+                    np.testing.assert_allclose(
+                        qx[offsets[i] : offsets[i + 1]], data["qx"], rtol=0, atol=1e-14
+                    )
+                    np.testing.assert_allclose(
+                        qy[offsets[i] : offsets[i + 1]], data["qy"], rtol=0, atol=1e-14
+                    )
+                    assert np.array_equal(
+                        I[offsets[i] : offsets[i + 1]], data["intensity"]
+                    )
+
+
+def test_BraggVectors_uncalibrated_readonly():
+    braggvectors = make_calibrated_braggvectors()
+    braggvectors.setcal(center=False, ellipse=False, pixel=False, rotate=False)
+    raw = braggvectors.raw[1, 1].data.copy()
+    for data in (
+        braggvectors.cal[1, 1].data,
+        braggvectors.get_vectors(1, 1, False, False, False, False).data,
+    ):
+        assert np.array_equal(data, raw)
+        assert not data.flags.writeable
+        try:
+            data["intensity"] *= 2
+        except ValueError:
+            pass
+        assert np.array_equal(braggvectors.raw[1, 1].data, raw)
+
+
+def make_disk_datacube(Rx=4, Ry=5, Q=32, seed=0):
+    """
+    Synthetic datacube of gaussian disks on a jittered square lattice, with
+    a gaussian template
+    """
+    rng = np.random.default_rng(seed)
+    qx, qy = np.meshgrid(np.arange(Q), np.arange(Q), indexing="ij")
+    data = np.zeros((Rx, Ry, Q, Q), dtype=np.float32)
+    for rx in range(Rx):
+        for ry in range(Ry):
+            for x0 in (8, 16, 24):
+                for y0 in (8, 16, 24):
+                    x0_ = x0 + rng.normal(0, 0.3)
+                    y0_ = y0 + rng.normal(0, 0.3)
+                    data[rx, ry] += (1 + rng.random()) * np.exp(
+                        -((qx - x0_) ** 2 + (qy - y0_) ** 2) / 4
+                    )
+    template = np.exp(-((qx - Q / 2) ** 2 + (qy - Q / 2) ** 2) / 4)
+    template = np.fft.ifftshift(template)
+    return data, template
+
+
+def test_find_Bragg_disks_num_jobs(tmp_path):
+    import h5py
+
+    data, template = make_disk_datacube()
+    with h5py.File(tmp_path / "datacube.h5", "w") as f:
+        f.create_dataset("data", data=data, chunks=(1, 1) + data.shape[2:])
+
+    detect_params = {
+        "template": template,
+        "corrPower": 1.0,
+        "sigma": 0,
+        "edgeBoundary": 2,
+        "minRelativeIntensity": 0,
+        "minAbsoluteIntensity": 0,
+        "minPeakSpacing": 4,
+        "subpixel": "poly",
+        "maxNumPeaks": 20,
+    }
+    with h5py.File(tmp_path / "datacube.h5", "r") as f:
+        for source in (data, f["data"]):
+            datacube = py4DSTEM.DataCube(data=source)
+            expected = datacube.find_Bragg_disks(num_jobs=1, **detect_params)
+            for num_jobs in (2, None):
+                braggvectors = datacube.find_Bragg_disks(
+                    num_jobs=num_jobs, **detect_params
+                )
+                for rx in range(data.shape[0]):
+                    for ry in range(data.shape[1]):
+                        assert len(expected.raw[rx, ry].data) == 9
+                        assert np.array_equal(
+                            braggvectors.raw[rx, ry].data, expected.raw[rx, ry].data
+                        )
+
+
+def test_find_Bragg_disks_CPU_block_spawn():
+    from mpire import WorkerPool
+    from py4DSTEM.braggvectors.diskdetection import (
+        _find_Bragg_disks_CPU_block,
+        _get_scan_blocks,
+    )
+
+    data, template = make_disk_datacube()
+    datacube = py4DSTEM.DataCube(data=data)
+    kwargs = {
+        "template": np.conj(np.fft.fft2(template)),
+        "minAbsoluteIntensity": 0,
+        "minPeakSpacing": 4,
+        "edgeBoundary": 2,
+        "subpixel": "poly",
+        "_template_space": "fourier",
+    }
+    blocks = [(block,) for block in _get_scan_blocks(*data.shape[:2], 3)]
+    shared = (datacube, False, kwargs)
+    expected = [_find_Bragg_disks_CPU_block(shared, *block) for block in blocks]
+
+    # spawned workers must unpickle the worker function and shared objects
+    with WorkerPool(n_jobs=2, shared_objects=shared, start_method="spawn") as pool:
+        results = pool.map(_find_Bragg_disks_CPU_block, blocks)
+    for (positions, peaks), (positions_, peaks_) in zip(results, expected):
+        assert positions == positions_
+        assert all(np.array_equal(p, p_) for p, p_ in zip(peaks, peaks_))
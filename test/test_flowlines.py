@@ -0,0 +1,140 @@
+import numpy as np
+from py4DSTEM.process.diffraction.flowlines import (
+    make_flowline_map,
+    make_orientation_histogram,
+    orientation_correlation,
+    set_intensity,
+)
+from synthetic import make_braggvectors
+
+
+def make_ring_braggvectors(Rx=12, Ry=14, seed=0):
+    """
+    Synthetic, centered bragg vectors in two rings, with an orientation that
+    rotates smoothly over the scan
+    """
+    rng = np.random.default_rng(seed)
+
+    def get_vectors(rx, ry):
+        phi = 0.3 * rx + 0.1 * ry + 0.2 * np.sin(ry / 3)
+        n = rng.integers(0, 9)
+        r = np.concatenate([rng.normal(30, 2, n), rng.normal(50, 3, n)])
+        a = np.concatenate(
+            [
+                phi + np.pi * (np.arange(n) % 2),
+                phi + 0.5 + np.pi * (np.arange(n) % 2),
+            ]
+        ) + rng.normal(0, 0.05, 2 * n)
+        return r * np.cos(a), r * np.sin(a), rng.random(2 * n) + 0.5
+
+    return make_braggvectors((Rx, Ry), get_vectors)
+
+
+class TestFlowlines:
+    # setup/teardown
+    def setup_class(cls):
+        cls.braggvectors = make_ring_braggvectors()
+        cls.histogram_params = {
+            "radial_ranges": np.array([[20, 40], [40, 60]]),
+            "upsample_factor": 2,
+            "theta_step_deg": 3,
+            "progress_bar": False,
+        }
+        cls.orient_hist = make_orientation_histogram(
+            cls.braggvectors,
+            dtype=np.float64,
+            **cls.histogram_params,
+        )
+
+    # tests
+
+    def test_orientation_histogram_dtype(self):
+        orient_hist_32 = make_orientation_histogram(
+            self.braggvectors,
+            dtype=np.float32,
+            **self.histogram_params,
+        )
+        assert self.orient_hist.dtype == np.float64
+        assert orient_hist_32.dtype == np.float32
+        assert np.allclose(orient_hist_32, self.orient_hist, rtol=0, atol=1e-6)
+
+        orient_flowlines = make_flowline_map(orient_hist_32, progress_bar=False)
+        assert orient_flowlines.dtype == np.float32
+
+    def test_flowline_map_max_seeds(self):
+        orient_flowlines = make_flowline_map(self.orient_hist, progress_bar=False)
+        assert np.any(orient_flowlines > 0)
+
+        # more seeds allowed than there are is the same as no limit
+        num_voxels = self.orient_hist[0].size
+        orient_flowlines_all = make_flowline_map(
+            self.orient_hist, max_seeds=num_voxels, progress_bar=False
+        )
+        assert np.array_equal(orient_flowlines_all, orient_flowlines)
+
+        # no seeds
+        orient_flowlines_none = make_flowline_map(
+            self.orient_hist, max_seeds=0, progress_bar=False
+        )
+        assert orient_flowlines_none.shape == orient_flowlines.shape
+        assert not np.any(orient_flowlines_none)
+
+        # the single brightest seed of each radial bin, which is also the
+        # only seed left when the seed threshold is that bin's maximum
+        orient_hist = self.orient_hist / np.max(
+            self.orient_hist, axis=(1, 2, 3), keepdims=True
+        )
+        orient_flowlines_one = make_flowline_map(
+            orient_hist, sep_seeds=1, max_seeds=1, progress_bar=False
+        )
+        orient_flowlines_max = make_flowline_map(
+            orient_hist, sep_seeds=1, thresh_seed=1.0, progress_bar=False
+        )
+        assert np.any(orient_flowlines_one > 0)
+        assert np.array_equal(orient_flowlines_one, orient_flowlines_max)
+
+    def test_set_intensity_duplicate_steps(self):
+        # steps which land in the same voxels add up, rather than the last
+        # step's weight overwriting the earlier ones
+        orient = np.zeros((6, 7, 8))
+        xy_t_int = np.array(
+            [
+                [2.0, 3.0, 4.0, 1.0],
+                [2.0, 3.0, 4.0, 0.5],
+                [2.25, 3.5, 4.0, 1.0],
+                [2.25, 3.5, 4.0, 1.0],
+            ]
+        )
+        set_intensity(orient, xy_t_int)
+
+        assert np.isclose(orient.sum(), 3.5)
+        assert np.isclose(orient[2, 3, 4], 1.5 + 2 * 0.75 * 0.5)
+        assert np.isclose(orient[3, 3, 4], 2 * 0.25 * 0.5)
+        assert np.isclose(orient[2, 4, 4], 2 * 0.75 * 0.5)
+        assert np.isclose(orient[3, 4, 4], 2 * 0.25 * 0.5)
+
+        # steps on the edge fold their clipped weights into the edge voxels,
+        # and theta wraps around
+        orient = np.zeros((6, 7, 8))
+        set_intensity(orient, np.array([[5.0, 6.0, 7.5, 2.0], [5.0, 6.0, 7.5, 2.0]]))
+        assert np.isclose(orient[5, 6, 7], 2.0)
+        assert np.isclose(orient[5, 6, 0], 2.0)
+        assert np.isclose(orient.sum(), 4.0)
+
+    def test_orientation_correlation_fast_fft_size(self):
+        # sizes for which the padded FFT size changes
+        orient_hist = np.random.default_rng(1).random((2, 13, 17, 30))
+        orient_corr = orientation_correlation(
+            orient_hist, progress_bar=False, fast_fft_size=False
+        )
+        orient_corr_fast = orientation_correlation(
+            orient_hist, progress_bar=False, fast_fft_size=True
+        )
+        assert orient_corr_fast.shape == orient_corr.shape
+        assert np.allclose(orient_corr_fast, orient_corr, rtol=1e-10, atol=1e-12)
+
+        orient_corr_32 = orientation_correlation(
+            orient_hist, progress_bar=False, dtype=np.float32
+        )
+        assert orient_corr_32.dtype == np.float32
+        assert np.allclose(orient_corr_32, orient_corr, rtol=1e-4, atol=1e-5)
@@ -22,3 +22,20 @@ def test_datacube_copy():
     x = py4DSTEM.DataCube(data=np.zeros((3, 3, 4, 4)))
     y = x.copy()
     assert isinstance(y, py4DSTEM.DataCube)
+
+
+def test_apply_correlation_power():
+    """tests apply_correlation_power, including zero bins"""
+    from py4DSTEM.process.utils.cross_correlate import apply_correlation_power
+
+    rng = np.random.default_rng(0)
+    m = rng.normal(size=(6, 7)) + 1j * rng.normal(size=(6, 7))
+    m[2, 3] = 0
+    m[4, 1] = -0.0
+    zero = m == 0
+    for corrPower in (0, 0.5, 1):
+        expected = np.abs(m) ** corrPower * np.exp(1j * np.angle(m))
+        expected[zero] = 0
+        cc = apply_correlation_power(m.copy(), corrPower)
+        assert np.allclose(cc, expected, rtol=1e-12, atol=0)
+        assert np.all(cc[zero] == 0)
@@ -0,0 +1,67 @@
+import h5py
+import numpy as np
+from py4DSTEM import read, DataCube
+
+
+def write_legacy_datacube(filepath, data, version_minor, **dataset_kwargs):
+    """Writes `data` as the only datacube in a minimal legacy v0.<version_minor> file"""
+    with h5py.File(filepath, "w") as f:
+        tg = f.create_group("4DSTEM_experiment")
+        tg.attrs["emd_group_type"] = 2
+        tg.attrs["version_major"] = 0
+        tg.attrs["version_minor"] = version_minor
+        for name in (
+            "datacubes",
+            "counted_datacubes",
+            "diffractionslices",
+            "realslices",
+            "pointlists",
+            "pointlistarrays",
+            "coordinates",
+        ):
+            tg.create_group("data/" + name)
+        tg.create_dataset("data/datacubes/datacube/data", data=data, **dataset_kwargs)
+
+
+def bin_reference(data, binfactor, dtype):
+    R_Nx, R_Ny, Q_Nx, Q_Ny = data.shape
+    Q_Nx, Q_Ny = Q_Nx // binfactor, Q_Ny // binfactor
+    return (
+        data[:, :, : Q_Nx * binfactor, : Q_Ny * binfactor]
+        .astype(np.int64)
+        .reshape(R_Nx, R_Ny, Q_Nx, binfactor, Q_Ny, binfactor)
+        .sum(axis=(3, 5))
+        .astype(dtype)
+    )
+
+
+def test_read_legacy_binfactor(tmp_path):
+    # Q shapes which don't divide evenly by the binfactors, and counts large
+    # enough for binned uint16 sums to overflow
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 2**16, (3, 4, 13, 11), dtype=np.uint16)
+    storage = {
+        "contiguous": {},
+        "chunked": {"chunks": (1, 1, 13, 11)},
+        "gzip": {"chunks": (1, 2, 13, 11), "compression": "gzip"},
+    }
+    for version_minor in (9, 12):
+        for kind, dataset_kwargs in storage.items():
+            filepath = tmp_path / f"v0_{version_minor}_{kind}.h5"
+            write_legacy_datacube(filepath, data, version_minor, **dataset_kwargs)
+            for binfactor in (2, 3):
+                datacube = read(
+                    filepath, data_id="datacube", binfactor=binfactor, dtype=np.uint32
+                )
+                assert isinstance(datacube, DataCube)
+                assert datacube.data.dtype == np.uint32
+                assert np.array_equal(
+                    datacube.data, bin_reference(data, binfactor, np.uint32)
+                )
+
+                # by default the binned data keeps the raw dtype, so sums wrap
+                datacube = read(filepath, data_id="datacube", binfactor=binfactor)
+                assert datacube.data.dtype == np.uint16
+                assert np.array_equal(
+                    datacube.data, bin_reference(data, binfactor, np.uint16)
+                )
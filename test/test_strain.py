@@ -2,6 +2,10 @@ import py4DSTEM
 from py4DSTEM import StrainMap
 from os.path import join
 from numpy import zeros
+import numpy as np
+from emdfile import PointList
+from synthetic import make_braggvectors
+from py4DSTEM.process.strain.latticevectors import add_indices_to_braggvectors
 
 
 # set filepath
@@ -25,3 +29,80 @@ class TestStrainMap:
         assert isinstance(strainmap, StrainMap)
         assert strainmap.calibration is not None
         assert strainmap.calibration is strainmap.braggvectors.calibration
+
+
+def test_add_indices_to_braggvectors():
+    # a square lattice, shifted by an exactly representable offset so that
+    # peaks halfway between two lattice points are exact ties
+    qx_shift, qy_shift = 0.5, -0.25
+    h, k = np.meshgrid(np.arange(-4, 5), np.arange(-4, 5), indexing="ij")
+    lattice = PointList(
+        np.zeros(
+            h.size,
+            dtype=[("qx", float), ("qy", float), ("g1_ind", int), ("g2_ind", int)],
+        )
+    )
+    lattice.data["qx"] = 10.0 * h.ravel()
+    lattice.data["qy"] = 10.0 * k.ravel()
+    lattice.data["g1_ind"] = h.ravel()
+    lattice.data["g2_ind"] = k.ravel()
+    lattice_qx = lattice.data["qx"] - qx_shift
+    lattice_qy = lattice.data["qy"] - qy_shift
+
+    # peaks near lattice points, at ties, and out of tolerance
+    maxPeakSpacing = 5.0
+    origin = (64.0, 60.0)
+    rng = np.random.default_rng(0)
+    Rshape = (5, 6)
+
+    def get_vectors(rx, ry):
+        if rx == ry:
+            return [], [], []
+        ind = rng.integers(0, h.size, 8)
+        qx = lattice_qx[ind] + rng.normal(0, 3, 8)
+        qy = lattice_qy[ind] + rng.normal(0, 3, 8)
+        qx = np.append(qx, [lattice_qx[40] + 5.0, lattice_qx[40] + 5.0])
+        qy = np.append(qy, [lattice_qy[40], lattice_qy[40] + 5.0])
+        return qx + origin[0], qy + origin[1], rng.random(len(qx))
+
+    braggvectors = make_braggvectors(Rshape, get_vectors)
+    braggvectors.calibration.set_origin(origin)
+    braggvectors.setcal(center=True, ellipse=False, pixel=False, rotate=False)
+
+    mask = np.ones(Rshape, dtype=bool)
+    mask[0, 1] = False
+    indexed = add_indices_to_braggvectors(
+        braggvectors,
+        lattice,
+        maxPeakSpacing,
+        qx_shift=qx_shift,
+        qy_shift=qy_shift,
+        mask=mask,
+    )
+
+    # compare with a brute force search over all the lattice points
+    for rx in range(Rshape[0]):
+        for ry in range(Rshape[1]):
+            result = indexed[rx, ry].data
+            if not mask[rx, ry] or rx == ry:
+                assert len(result) == 0
+                continue
+            pl = braggvectors.cal[rx, ry].data
+            r2 = (pl["qx"][:, None] - lattice_qx[None, :]) ** 2 + (
+                pl["qy"][:, None] - lattice_qy[None, :]
+            ) ** 2
+            r2_min = r2.min(axis=1)
+            sub = r2_min <= maxPeakSpacing**2
+            assert not sub[-1] and sub[-2]
+            assert len(result) == np.count_nonzero(sub)
+            assert np.array_equal(result["qx"], pl["qx"][sub])
+            assert np.array_equal(result["qy"], pl["qy"][sub])
+            assert np.array_equal(result["intensity"], pl["intensity"][sub])
+            # the matched lattice point is a nearest one, which may be either
+            # point of a tie
+            matched = (result["g1_ind"] + 4) * 9 + (result["g2_ind"] + 4)
+            assert np.array_equal(
+                r2[np.nonzero(sub)[0], matched], r2_min[sub]
+            ), "indexed peak not matched to a nearest lattice point"
+            unique = (r2[sub] == r2_min[sub, None]).sum(axis=1) == 1
+            assert np.array_equal(matched[unique], r2[sub].argmin(axis=1)[unique])